@@ -0,0 +1,326 @@
+### DEFAULT PYTHON 3.8.3 MODULES
+import argparse
+import os
+import sys
+import asyncio
+import subprocess
+import tempfile
+import time
+import json
+import platform
+import codec
+
+### Code to Pass Arguments to Benchmark Script through Linux Terminal
+parser = argparse.ArgumentParser(description = "Benchmarks for the file server: thread vs asyncio engines, segmented download speedup, load matrix!")
+parser.add_argument('--bench', metavar = 'bench', type = str, nargs = '?', default = 'engines', choices = ['engines', 'segments', 'load'])
+parser.add_argument('--ip', metavar = 'ip', type = str, nargs = '?', default = '127.0.0.1')
+parser.add_argument('--port', metavar = 'port', type = int, nargs = '?', default = 9100)
+parser.add_argument('--clients', metavar = 'clients', type = int, nargs = '?', default = None)
+parser.add_argument('--size', metavar = 'size', type = int, nargs = '?', default = None)
+parser.add_argument('--engines', metavar = 'engines', type = str, nargs = '?', default = 'thread,asyncio')
+parser.add_argument('--segments', metavar = 'segments', type = str, nargs = '?', default = '1,2,4,8')
+parser.add_argument('--repeat', metavar = 'repeat', type = int, nargs = '?', default = 3)
+parser.add_argument('--sizes', metavar = 'sizes', type = str, nargs = '?', default = '65536,1048576,16777216')
+parser.add_argument('--counts', metavar = 'counts', type = str, nargs = '?', default = '1,8')
+parser.add_argument('--modes', metavar = 'modes', type = str, nargs = '?', default = 'serial,parallel')
+parser.add_argument('--out', metavar = 'out', type = str, nargs = '?', default = None)
+parser.add_argument('--baseline', metavar = 'baseline', type = str, nargs = '?', default = None)
+parser.add_argument('--tolerance', metavar = 'tolerance', type = float, nargs = '?', default = 0.1)
+args = parser.parse_args()
+
+### CONNECTION PROTOCOL (SAME AS server.py)
+HEADER = codec.HEADER_SIZE
+BLOCK = 1048576             # Size of a block drained from a download reply at once
+STARTUP_TIMEOUT = 10        # Seconds a started server gets to accept connections
+FILE_LIST_MESSAGE = "!GET_FILE_LIST"
+RES_FILE_LIST_MESSAGE = "!RES_FILE_LIST"
+FILE_DOWNLOAD_MESSAGE = "!DOWNLOAD"
+RES_DOWNLOAD_MESSAGE = "!RES_DOWNLOAD"
+DISCONNECT_MESSAGE = "!DISCONNECT"
+for m in (FILE_LIST_MESSAGE, RES_FILE_LIST_MESSAGE, FILE_DOWNLOAD_MESSAGE, DISCONNECT_MESSAGE):
+    codec.register(m)
+codec.register(RES_DOWNLOAD_MESSAGE, payload='file_data')
+SERVER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'server.py')
+CLIENT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'client.py')
+
+### READ ONE WHOLE FRAME, RETURNS THE DECODED MESSAGE
+async def readFrame(reader):
+    name, _, body_len, payload_len = codec.unpackHeader(await reader.readexactly(HEADER))
+    body = await reader.readexactly(body_len)
+    return codec.decodeBody(name, body, await reader.readexactly(payload_len))
+
+### READ /proc STATUS FIELDS OF THE SERVER PROCESS (LINUX ONLY)
+def procStatus(pid):
+    status = {}
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                key, _, val = line.partition(':')
+                status[key] = val.split()[0] if val.split() else ''
+    except OSError:
+        pass
+    return status
+
+### READ /proc/<pid>/stat - RETURNS CPU SECONDS (USER + SYSTEM) USED BY THE SERVER PROCESS (LINUX ONLY)
+def procCpu(pid):
+    try:
+        with open(f'/proc/{pid}/stat') as f:
+            fields = f.read().rsplit(')', 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) / os.sysconf('SC_CLK_TCK')
+    except (OSError, ValueError, IndexError):
+        return 0
+
+### NEAREST RANK PERCENTILE OF A SORTED LIST
+def percentile(values, p):
+    return values[min(len(values)-1, int(len(values)*p))] if values else 0
+
+### ONE SIMULATED CLIENT - LIST, DOWNLOAD, THEN HOLD THE CONNECTION UNTIL EVERY CLIENT IS CONNECTED
+async def simClient(file_name, all_connected, latencies):
+    reader, writer = await asyncio.open_connection(args.ip, args.port)
+    try:
+        writer.write(codec.packed({'main':FILE_LIST_MESSAGE}))
+        await readFrame(reader)
+        start = time.time()
+        writer.write(codec.packed({'main':FILE_DOWNLOAD_MESSAGE, 'file_name':file_name}))
+        await readFrame(reader)
+        latencies.append(time.time() - start)
+        await all_connected.wait()
+        writer.write(codec.packed({'main':DISCONNECT_MESSAGE}))
+        await writer.drain()
+    finally:
+        writer.close()
+
+### RUN ALL CLIENTS AGAINST ONE SERVER, SAMPLE SERVER THREADS AND RSS WHILE THEY ARE CONNECTED
+async def load(pid, file_name):
+    all_connected = asyncio.Event()
+    latencies = []
+    tasks = [asyncio.ensure_future(simClient(file_name, all_connected, latencies)) for _ in range(args.clients)]
+    peak_threads = 0
+    while len(latencies) + sum(t.done() for t in tasks) < args.clients:
+        peak_threads = max(peak_threads, int(procStatus(pid).get('Threads', 0)))
+        await asyncio.sleep(.05)
+    peak_threads = max(peak_threads, int(procStatus(pid).get('Threads', 0)))
+    all_connected.set()
+    results = await asyncio.gather(*tasks, return_exceptions=True)
+    failures = sum(isinstance(r, Exception) for r in results)
+    return latencies, failures, peak_threads
+
+### CONNECT TO THE SERVER UNTIL IT ACCEPTS - RETURNS False IF IT EXITED OR DID NOT ACCEPT IN STARTUP_TIMEOUT SECONDS
+async def waitServer(proc):
+    deadline = time.time() + STARTUP_TIMEOUT
+    while proc.poll() is None and time.time() < deadline:
+        try:
+            reader, writer = await asyncio.open_connection(args.ip, args.port)
+        except OSError:
+            await asyncio.sleep(.05)
+            continue
+        writer.write(codec.packed({'main':DISCONNECT_MESSAGE}))
+        await writer.drain()
+        writer.close()
+        return True
+    return False
+
+### START server.py WITH AN ENGINE IN work_dir ONCE IT ACCEPTS CONNECTIONS - RETURNS THE PROCESS
+### Metrics are off (--metrics_port 0), so back to back servers or one already running never fight over the port.
+def startServer(work_dir, engine='thread'):
+    proc = subprocess.Popen([sys.executable, SERVER, '--ip', args.ip, '--port', str(args.port), '--dir', 'host', '--engine', engine,
+                             '--metrics_port', '0'], cwd=work_dir, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    if not asyncio.run(waitServer(proc)):
+        proc.terminate()
+        proc.wait()
+        raise RuntimeError(f'server.py did not start on {args.ip}:{args.port}')
+    return proc
+
+### START server.py WITH AN ENGINE, DRIVE IT AND REPORT
+def run(engine, work_dir, file_name):
+    proc = startServer(work_dir, engine)
+    try:
+        start = time.time()
+        latencies, failures, peak_threads = asyncio.run(load(proc.pid, file_name))
+        wall = time.time() - start
+        peak_rss = int(procStatus(proc.pid).get('VmHWM', 0))
+    finally:
+        proc.terminate()
+        proc.wait()
+    latencies.sort()
+    p50 = percentile(latencies, .5)
+    p99 = percentile(latencies, .99)
+    print(f'{engine:<10}{args.clients:<10}{failures:<10}{wall:<12.3f}{p50*1000:<12.2f}{p99*1000:<12.2f}{peak_threads:<10}{peak_rss:<12}')
+    args.port += 1
+
+### READ ONE DOWNLOAD REPLY, THE FILE IS DRAINED BLOCK BY BLOCK AND NEVER HELD - RETURNS FILE BYTES RECEIVED
+async def readDownload(reader):
+    _, _, body_len, payload_len = codec.unpackHeader(await reader.readexactly(HEADER), None)
+    await reader.readexactly(body_len)
+    left = payload_len
+    while left:
+        left -= len(await reader.readexactly(min(BLOCK, left)))
+    return payload_len
+
+### DOWNLOAD FILES ONE AFTER ANOTHER OVER ONE CONNECTION, RECORDING THE LATENCY OF EACH - RETURNS BYTES RECEIVED
+async def downloadFiles(files, latencies):
+    reader, writer = await asyncio.open_connection(args.ip, args.port)
+    got = 0
+    try:
+        for f in files:
+            start = time.time()
+            writer.write(codec.packed({'main':FILE_DOWNLOAD_MESSAGE, 'file_name':f}))
+            got += await readDownload(reader)
+            latencies.append(time.time() - start)
+        writer.write(codec.packed({'main':DISCONNECT_MESSAGE}))
+        await writer.drain()
+    finally:
+        writer.close()
+    return got
+
+### ONE LOAD CLIENT - SERIAL MODE USES ONE CONNECTION FOR ALL FILES, PARALLEL MODE ONE CONNECTION PER FILE (AS client.py)
+async def loadClient(files, mode, latencies):
+    if mode == 'serial':
+        return await downloadFiles(files, latencies)
+    return sum(await asyncio.gather(*[downloadFiles([f], latencies) for f in files]))
+
+### RUN --clients LOAD CLIENTS, SAMPLE SERVER RSS UNTIL THEY ARE ALL DONE
+async def loadCell(pid, files, mode):
+    latencies = []
+    start = time.time()
+    tasks = [asyncio.ensure_future(loadClient(files, mode, latencies)) for _ in range(args.clients)]
+    peak_rss = 0
+    pending = tasks
+    while pending:
+        peak_rss = max(peak_rss, int(procStatus(pid).get('VmRSS', 0)))
+        _, pending = await asyncio.wait(pending, timeout=.05)
+    wall = time.time() - start
+    results = await asyncio.gather(*tasks, return_exceptions=True)
+    failures = sum(isinstance(r, Exception) for r in results)
+    received = sum(r for r in results if not isinstance(r, Exception))
+    return latencies, failures, received, wall, peak_rss
+
+### START server.py WITH AN ENGINE, WARM IT UP AND DRIVE ONE CELL OF THE LOAD MATRIX - RETURNS THE CELL RESULT
+def runLoad(engine, work_dir, size, count, mode):
+    files = [f'load_{size}_{i}.bin' for i in range(count)]
+    proc = startServer(work_dir, engine)
+    try:
+        # one untimed pass so digests are cached and files are in the page cache
+        asyncio.run(downloadFiles(files, []))
+        cpu = procCpu(proc.pid)
+        latencies, failures, received, wall, peak_rss = asyncio.run(loadCell(proc.pid, files, mode))
+        cpu = procCpu(proc.pid) - cpu
+    finally:
+        proc.terminate()
+        proc.wait()
+    args.port += 1
+    latencies.sort()
+    return {'engine':engine, 'mode':mode, 'size':size, 'count':count, 'clients':args.clients,
+            'downloads':len(latencies), 'failures':failures, 'wall_s':round(wall, 4),
+            'throughput_mbps':round(received/wall/1e6, 2) if wall else 0,
+            'p50_ms':round(percentile(latencies, .5)*1000, 3), 'p95_ms':round(percentile(latencies, .95)*1000, 3),
+            'p99_ms':round(percentile(latencies, .99)*1000, 3), 'server_cpu_s':round(cpu, 3), 'server_rss_kb':peak_rss}
+
+### KEY OF A CELL OF THE LOAD MATRIX, CELLS OF TWO RUNS ARE COMPARED BY KEY
+def cellKey(r):
+    return (r['engine'], r['mode'], r['size'], r['count'], r['clients'])
+
+### COMPARE A RUN AGAINST A SAVED BASELINE - RETURNS A LIST OF REGRESSIONS BEYOND --tolerance
+def compare(results, baseline):
+    base = {cellKey(r): r for r in baseline['results']}
+    regressions = []
+    for r in results:
+        b = base.get(cellKey(r))
+        if b is None:
+            continue
+        cell = '/'.join(map(str, cellKey(r)))
+        if r['failures'] > b['failures']:
+            regressions.append(f'{cell}: failures {b["failures"]} -> {r["failures"]}')
+        if r['throughput_mbps'] < b['throughput_mbps'] * (1 - args.tolerance):
+            regressions.append(f'{cell}: throughput {b["throughput_mbps"]} -> {r["throughput_mbps"]} MB/s')
+        for p in ('p95_ms', 'p99_ms'):
+            if r[p] > b[p] * (1 + args.tolerance):
+                regressions.append(f'{cell}: {p} {b[p]} -> {r[p]}')
+    return regressions
+
+### RUN THE LOAD MATRIX (ENGINES x MODES x SIZES x COUNTS), REPORT AS JSON AND CHECK AGAINST --baseline
+### Returns the process exit status, 1 if a regression was found.
+def runMatrix(work_dir):
+    sizes = list(map(int, args.sizes.split(',')))
+    counts = list(map(int, args.counts.split(',')))
+    for size in sizes:
+        for i in range(max(counts)):
+            with open(os.path.join(work_dir, 'host', f'load_{size}_{i}.bin'), 'wb') as f:
+                for o in range(0, size, BLOCK):
+                    f.write(os.urandom(min(BLOCK, size - o)))
+    print(f'{"Engine":<10}{"Mode":<10}{"Size(B)":<12}{"Files":<7}{"Failed":<8}{"MB/s":<10}{"p50(ms)":<10}{"p95(ms)":<10}{"p99(ms)":<10}{"CPU(s)":<9}{"RSS(kB)":<10}')
+    results = []
+    for engine in args.engines.split(','):
+        for mode in args.modes.split(','):
+            for size in sizes:
+                for count in counts:
+                    r = runLoad(engine, work_dir, size, count, mode)
+                    results.append(r)
+                    print(f'{engine:<10}{mode:<10}{size:<12}{count:<7}{r["failures"]:<8}{r["throughput_mbps"]:<10}'
+                          f'{r["p50_ms"]:<10}{r["p95_ms"]:<10}{r["p99_ms"]:<10}{r["server_cpu_s"]:<9}{r["server_rss_kb"]:<10}')
+    report = {'meta':{'time':time.strftime('%Y-%m-%dT%H:%M:%S'), 'python':platform.python_version(),
+                      'platform':platform.platform(), 'clients':args.clients}, 'results':results}
+    if args.out:
+        with open(args.out, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f'\nResults saved to {args.out}')
+    else:
+        print(json.dumps(report, indent=2))
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f))
+        for line in regressions:
+            print(f'[REGRESSION] {line}')
+        print(f'{len(regressions)} regression(s) against {args.baseline} (tolerance {args.tolerance:.0%})')
+        return 1 if regressions else 0
+    return 0
+
+### DOWNLOAD ONE LARGE FILE WITH client.py IN PARALLEL MODE FOR EACH SEGMENT COUNT, BEST OF --repeat RUNS
+def runSegments(work_dir, file_name):
+    proc = startServer(work_dir)
+    print(f'{"Segments":<10}{"Size(B)":<14}{"Best(s)":<12}{"MB/s":<12}{"Speedup":<10}')
+    try:
+        base = None
+        for n in map(int, args.segments.split(',')):
+            best = None
+            for r in range(args.repeat):
+                down_dir = os.path.join(work_dir, f'down_{n}_{r}')
+                start = time.time()
+                subprocess.run([sys.executable, CLIENT, '--ip', args.ip, '--port', str(args.port), '--dir', down_dir,
+                                '--files', file_name, '--mode', '1', '--segments', str(n), '--segment_min', '0'],
+                               cwd=work_dir, stdout=subprocess.DEVNULL, check=True)
+                elapsed = time.time() - start
+                best = elapsed if best is None else min(best, elapsed)
+                os.remove(os.path.join(down_dir, file_name))
+            base = base or best
+            print(f'{n:<10}{args.size:<14}{best:<12.3f}{args.size/best/1e6:<12.1f}{base/best:<10.2f}')
+    finally:
+        proc.terminate()
+        proc.wait()
+
+### MAIN
+if __name__ == "__main__":
+    # every simulated client holds a descriptor in this process too
+    try:
+        import resource
+        _, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    except (ImportError, ValueError, OSError):
+        pass
+    if args.size is None:
+        args.size = 65536 if args.bench == 'engines' else 268435456
+    if args.clients is None:
+        args.clients = 8 if args.bench == 'load' else 1000
+    with tempfile.TemporaryDirectory() as work_dir:
+        os.makedirs(os.path.join(work_dir, 'host'))
+        if args.bench == 'load':
+            sys.exit(runMatrix(work_dir))
+        with open(os.path.join(work_dir, 'host', 'bench.bin'), 'wb') as f:
+            for i in range(0, args.size, 1048576):
+                f.write(os.urandom(min(1048576, args.size - i)))
+        if args.bench == 'segments':
+            runSegments(work_dir, 'bench.bin')
+        else:
+            print(f'{"Engine":<10}{"Clients":<10}{"Failed":<10}{"Wall(s)":<12}{"p50(ms)":<12}{"p99(ms)":<12}{"Threads":<10}{"RSS(kB)":<12}')
+            for engine in args.engines.split(','):
+                run(engine, work_dir, 'bench.bin')
@@ -2,38 +2,75 @@
 import socket
 from socket import timeout
 import argparse
-import pickle
 import os
 import hashlib
 import concurrent.futures
 import time
+import glob
+import select
+import threading
+import codec
 
 ### Code to Pass Arguments to Client Script through Linux Terminal
 parser = argparse.ArgumentParser(description = "This is the client for the multi threaded socket server!")
 parser.add_argument('--ip', metavar = 'ip', type = str, nargs = '?', default = socket.gethostbyname(socket.gethostname()))
 parser.add_argument('--port', metavar = 'port', type = int, nargs = '?', default = 9000)
 parser.add_argument('--dir', metavar = 'dir', type = str, nargs = '?', default = './downloads')
+parser.add_argument('--segments', metavar = 'segments', type = int, nargs = '?', default = 4)
+parser.add_argument('--segment_min', metavar = 'segment_min', type = int, nargs = '?', default = 16777216)
+parser.add_argument('--pool', metavar = 'pool', type = int, nargs = '?', default = 8)
+parser.add_argument('--idle', metavar = 'idle', type = int, nargs = '?', default = 30)
+parser.add_argument('--files', metavar = 'files', type = str, nargs = '?', default = None)
+parser.add_argument('--mode', metavar = 'mode', type = int, nargs = '?', default = None)
+parser.add_argument('--compress', metavar = 'compress', type = str, nargs = '?', default = 'zlib')
+parser.add_argument('--level', metavar = 'level', type = int, nargs = '?', default = 1)
+parser.add_argument('--window', metavar = 'window', type = int, nargs = '?', default = 8)
 args = parser.parse_args()
 
 ### CONNECTION PROTOCOL
 TIMEOUT_SECONDS = 10        # Timeout connection after defined seconds of inactivity
-HEADER = 64                 # Size of header
+HEADER = codec.HEADER_SIZE  # Size of frame header (see codec.py)
 PACKET = 2048               # Size of a packet, multiple packets are sent if message is larger than packet size.
+BLOCK = 65536               # Size of a block received and written to a partial file at once
+PAGE_SIZE = 1000            # Files requested per page of the file listing
 FORMAT = 'utf-8'            # Message format
+CODECS = [c for c in args.compress.split(',') if c in codec.COMPRESSORS]    # Codecs offered, 'none' offers none
 ADDR = (args.ip, args.port)  # Address socket server will bind to  
 
 ### DEFAULT MESSAGES
 FILE_LIST_MESSAGE = "!GET_FILE_LIST"
-FILE_DOWNLOAD_MESSAGE = "!DOWNLOAD "
+RES_FILE_LIST_MESSAGE = "!RES_FILE_LIST"      # {'file_list'}
+FILE_PAGE_MESSAGE = "!GET_FILE_PAGE"          # {'offset', 'limit'}
+RES_FILE_PAGE_MESSAGE = "!RES_FILE_PAGE"      # {'total', 'files':[{'name','size','mtime','md5'}]}
+FILE_DOWNLOAD_MESSAGE = "!DOWNLOAD"           # {'file_name'}
+RES_DOWNLOAD_MESSAGE = "!RES_DOWNLOAD"        # {'md5'}, file bytes follow as raw payload
+FILE_RANGE_MESSAGE = "!DOWNLOAD_RANGE"        # {'file_name', 'offset', 'length'}
+RES_RANGE_MESSAGE = "!RES_DOWNLOAD_RANGE"     # {'offset', 'total', 'md5'}, range bytes follow as raw payload
+COMPRESS_MESSAGE = "!COMPRESS"                # {'codecs', 'level'}, codecs in order of preference
+RES_COMPRESS_MESSAGE = "!RES_COMPRESS"        # {'codec', 'level'}, codec is None if none agreed
+BLOCK_MESSAGE = "!BLOCK"                      # compressed bytes as raw payload, an empty block ends the body
+FILE_MUX_MESSAGE = "!DOWNLOAD_MUX"            # {'file_name', 'offset', 'length'}, answered under its request id
+RES_MUX_MESSAGE = "!RES_DOWNLOAD_MUX"         # {'offset', 'total', 'md5', 'count'}, data frames follow
+MUX_DATA_MESSAGE = "!MUX_DATA"                # range bytes as raw payload, an empty frame ends the download
 DISCONNECT_MESSAGE = "!DISCONNECT"
 
+### REGISTER MESSAGES WITH THE BINARY FRAMING CODEC, FILE DATA TRAVELS AS RAW PAYLOAD
+for m in (FILE_LIST_MESSAGE, RES_FILE_LIST_MESSAGE, FILE_PAGE_MESSAGE, RES_FILE_PAGE_MESSAGE,
+          FILE_DOWNLOAD_MESSAGE, FILE_RANGE_MESSAGE, COMPRESS_MESSAGE, RES_COMPRESS_MESSAGE, FILE_MUX_MESSAGE,
+          RES_MUX_MESSAGE, DISCONNECT_MESSAGE):
+    codec.register(m)
+codec.register(RES_DOWNLOAD_MESSAGE, payload='file_data')
+codec.register(RES_RANGE_MESSAGE, payload='file_data')
+codec.register(BLOCK_MESSAGE, payload='data')
+codec.register(MUX_DATA_MESSAGE, payload='data')
+
 ### MAKE DIRECTORY TO DOWNLOAD FILES TO IF NOT MADE
 if not os.path.exists(args.dir):
     os.makedirs(args.dir)
     print(f'\n{args.dir} folder created. Files will be downloaded here.')
 
-### FUNCTION TO CREATE NEW SOCKET CONNECTIONS TO SERVER ON DEMAND
-def createSocket():
+### FUNCTION TO OPEN A SOCKET CONNECTION TO THE SERVER
+def connect():
     # define socket as a IPv4 and TCP type
     client = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     # set timeout to connections
@@ -42,48 +79,331 @@ def createSocket():
     client.connect_ex(ADDR)
     return client
 
-### FUNCTION TO SEND MESSAGES FROM SPECIFIED CLIENT TO THE SERVER ENCODED IN FORMAT
-def send(msg,client):
-    # message pickled into bytes and HEADER added to message
-    msg = pickle.dumps(msg)
-    msg = bytes(f'{len(msg):<{HEADER}}', FORMAT) + msg
-    client.send(msg)
+### FUNCTION TO CREATE NEW SOCKET CONNECTIONS TO SERVER ON DEMAND, OFFERING THE COMPRESSION CODECS FIRST
+### The server answers with the codec it picked and compresses replies only when the data shrinks.
+def createSocket():
+    client = connect()
+    if not CODECS:
+        return client
+    try:
+        send({'main':COMPRESS_MESSAGE, 'codecs':CODECS, 'level':args.level}, client)
+        reply = getMessage(client)
+    except OSError:
+        reply = "TIMEOUT"
+    # a late answer would be taken for the reply of the next request, start over without compression
+    if reply == "TIMEOUT":
+        client.close()
+        client = connect()
+    return client
+
+### FUNCTION TO SEND MESSAGES FROM SPECIFIED CLIENT TO THE SERVER ENCODED WITH THE CODEC
+def send(msg,client,rid=0):
+    codec.sendMsg(client, msg, rid)
+
+### FUNCTION TO RECEIVE EXACTLY n BYTES INTO A BUFFER, HANDLES SHORT READS
+def recvInto(client, view):
+    got = 0
+    while got < len(view):
+        try:
+            n = client.recv_into(view[got:], min(PACKET, len(view)-got))
+        except timeout:
+            return False
+        if not n:
+            return False
+        got += n
+    return True
+
+### FUNCTION TO RECEIVE A FRAME HEADER AND BODY - RETURNS (message, request id, payload length) OR "TIMEOUT"
+### The payload (if any) is left on the socket for the caller to stream where it belongs, a caller that
+### streams it to disk passes max_payload None.
+def getFrameHead(client, max_payload=codec.MAX_PAYLOAD):
+    header = bytearray(HEADER)
+    if not recvInto(client, memoryview(header)):
+        return "TIMEOUT"
+    name, rid, body_len, payload_len = codec.unpackHeader(header, max_payload)
+    body = bytearray(body_len)
+    if not recvInto(client, memoryview(body)):
+        return "TIMEOUT"
+    return codec.decodeBody(name, body), rid, payload_len
+
+### FUNCTION TO RECEIVE A FRAME HEADER AND BODY - RETURNS (message, payload length) OR "TIMEOUT"
+def getHead(client, max_payload=codec.MAX_PAYLOAD):
+    head = getFrameHead(client, max_payload)
+    if head == "TIMEOUT":
+        return "TIMEOUT"
+    msg, _, payload_len = head
+    return msg, payload_len
 
 ### FUNCTION TO RECEIVED MESSAGE FOR A SPECIFIED CLIENT FROM THE SERVER
 def getMessage(client):
-    full_msg = b''
-    new_msg = True
-    ## Loop to download full message body
-    while True:
-        # receive message packets or teminate if packets lost
+    head = getHead(client)
+    if head == "TIMEOUT":
+        return "TIMEOUT"
+    msg, payload_len = head
+    ## payloads of small messages are read into memory and attached under their registered key
+    if payload_len:
+        payload = bytearray(payload_len)
+        if not recvInto(client, memoryview(payload)):
+            return "TIMEOUT"
+        msg[codec.PAYLOADS[msg['main']]] = payload
+    return msg
+
+### FUNCTION TO FETCH THE FILE LISTING PAGE BY PAGE - RETURNS LIST OF FILE METADATA OR "TIMEOUT"
+def getFileList(client):
+    files = []
+    total = None
+    while total is None or len(files) < total:
+        send({'main':FILE_PAGE_MESSAGE, 'offset':len(files), 'limit':PAGE_SIZE}, client)
+        page = getMessage(client)
+        if page == "TIMEOUT":
+            return "TIMEOUT"
+        total = page['total']
+        files += page['files']
+        # files removed while paging shorten the listing
+        if not page['files']:
+            break
+    return files
+
+### FUNCTION TO REQUEST THE BYTE RANGE [offset, offset+length) OF A FILE, length -1 IS UP TO THE END OF FILE
+def sendRange(f, offset, length, client):
+    send({'main':FILE_RANGE_MESSAGE, 'file_name':f, 'offset':offset, 'length':length}, client)
+
+### FUNCTION TO RECEIVE A RANGE REPLY HEADER - RETURNS (count, total size, md5, encoding) OR "TIMEOUT"
+### The count bytes of the range follow on the socket, raw or compressed with encoding.
+def getRangeHeader(client):
+    # a whole file may follow, it is streamed to disk
+    head = getHead(client, None)
+    if head == "TIMEOUT":
+        return "TIMEOUT"
+    msg, count = head
+    encoding = msg.get('encoding')
+    if encoding:
+        count = msg['count']
+    return (count, msg['total'], msg['md5'], encoding)
+
+### FUNCTION TO RECEIVE THE count BYTES OF A REPLY BODY, CALLS write(data, position) FOR EACH BLOCK
+### A compressed body is a stream of block messages ended by an empty one, decompressed as it arrives
+### at most BLOCK bytes at a time. Returns the number of body bytes delivered, fewer than count on a timeout.
+def recvBody(client, count, encoding, write):
+    got = 0
+    if encoding:
+        decompressor = codec.DECOMPRESSORS[encoding]()
+        while True:
+            msg = getMessage(client)
+            if msg == "TIMEOUT" or not msg.get('data'):
+                break
+            for data in codec.inflate(decompressor, msg['data'], BLOCK):
+                # never write past the announced end, the md5 check rejects such a body anyway
+                data = data[:count-got]
+                if not data:
+                    break
+                write(data, got)
+                got += len(data)
+        return got
+    buf = bytearray(BLOCK)
+    view = memoryview(buf)
+    while got < count:
         try:
-            msg = client.recv(PACKET)
+            n = client.recv_into(view, min(BLOCK, count-got))
         except timeout:
-            full_msg = "TIMEOUT"
             break
-        
-        # get length of message from HEADER
-        if new_msg:
-            msg_len = int(msg[:HEADER])
-            new_msg = False
-        
-        full_msg += msg
-
-        # decode and break out of loop if full message is received
-        if len(full_msg)-HEADER == msg_len:
-            full_msg = pickle.loads(full_msg[HEADER:])
+        if not n:
             break
-    
-    ## Return the full message or terminated status to caller
-    return full_msg
+        write(view[:n], got)
+        got += n
+    return got
+
+### FUNCTION TO RECEIVE count BYTES STRAIGHT INTO AN OPEN FILE - RETURNS NUMBER OF BYTES WRITTEN
+### If md5 is given it is updated with every block written, so the file never has to be read back.
+def recvToFile(client, out, count, encoding=None, md5=None):
+    def write(data, _):
+        out.write(data)
+        # flush every block so whatever arrived survives a timeout or crash
+        out.flush()
+        if md5:
+            md5.update(data)
+    return recvBody(client, count, encoding, write)
+
+### FUNCTION TO FEED A FILE ON DISK INTO AN MD5 BLOCK BY BLOCK
+def hashFile(path, md5):
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(BLOCK), b''):
+            md5.update(block)
+    return md5
+
+### FUNCTION TO MD5 HASH A FILE ON DISK BLOCK BY BLOCK
+def fileDigest(path):
+    return hashFile(path, hashlib.md5()).hexdigest()
+
+### FUNCTION TO DOWNLOAD (OR RESUME) ONE FILE OVER A CONNECTION USING BYTE RANGES
+### Partial data is kept in "<name>.<md5>.part", so a retry only asks for the missing bytes and a
+### partial file of an older version of the file is never resumed. Bytes are hashed as they are
+### written, memory stays O(BLOCK) whatever the file size. Returns None or a failure reason.
+def fetchFile(f, client):
+    dest = os.path.join(args.dir, f)
+    parts = glob.glob(glob.escape(dest) + '.*.part')
+    offset = 0
+    ## if partial files exist, ask for size and md5 only (zero length range) to pick the one to resume
+    if parts:
+        sendRange(f, 0, 0, client)
+        head = getRangeHeader(client)
+        if head == "TIMEOUT":
+            return "TIMEOUT"
+        part = f'{dest}.{head[2]}.part'
+        for p in parts:
+            if p != part:
+                os.remove(p)
+        if os.path.exists(part):
+            offset = os.path.getsize(part)
+    ## request everything from offset to the end of the file
+    sendRange(f, offset, -1, client)
+    head = getRangeHeader(client)
+    if head == "TIMEOUT":
+        return "TIMEOUT"
+    count, total, md5_original, encoding = head
+    part = f'{dest}.{md5_original}.part'
+    with open(part, 'ab') as out:
+        # file changed on the server between the two requests, discard the reply and start over
+        if out.tell() != offset:
+            with open(os.devnull, 'wb') as null:
+                if recvToFile(client, null, count, encoding) < count:
+                    return "TIMEOUT"
+            return "CHANGED"
+        # a resumed part is hashed once up to offset, the rest is hashed on the way in
+        md5 = hashFile(part, hashlib.md5()) if offset else hashlib.md5()
+        if recvToFile(client, out, count, encoding, md5) < count:
+            return "TIMEOUT"
+    ## INTEGRITY CHECK OF THE WHOLE FILE - move into place on success, drop the part otherwise
+    if md5.hexdigest() != md5_original:
+        os.remove(part)
+        return "INTEGRITY"
+    os.replace(part, dest)
+    return None
+
+### BOUNDED POOL OF KEEP-ALIVE CONNECTIONS SHARED BY THE PARALLEL DOWNLOAD THREADS
+class ConnectionPool:
+
+    ## AT MOST size CONNECTIONS ARE CHECKED OUT OR IDLE AT ONCE
+    def __init__(self, size, idle_timeout):
+        self.idle_timeout = idle_timeout
+        self.slots = threading.BoundedSemaphore(size)
+        self.lock = threading.Lock()
+        self.idle = []      # (socket, time it was returned), most recently used last
+
+    ## AN IDLE CONNECTION IS HEALTHY ONLY IF NOTHING IS READABLE ON IT,
+    ## readable means the server closed it or bytes of an old reply are still pending
+    def healthy(self, c):
+        try:
+            readable, _, _ = select.select([c], [], [], 0)
+        except (OSError, ValueError):
+            return False
+        return not readable
+
+    ## CLOSE A CONNECTION, TELLING THE SERVER IF IT IS STILL USABLE
+    def discard(self, c, polite=True):
+        try:
+            if polite:
+                send({'main':DISCONNECT_MESSAGE}, c)
+        except OSError:
+            pass
+        c.close()
+
+    ## CHECK OUT A LIVE CONNECTION, EVICTING STALE ONES ON THE WAY
+    def get(self):
+        self.slots.acquire()
+        now = time.time()
+        while True:
+            with self.lock:
+                if not self.idle:
+                    break
+                c, returned = self.idle.pop()
+            if now - returned > self.idle_timeout:
+                self.discard(c)
+            elif self.healthy(c):
+                return c
+            else:
+                self.discard(c, polite=False)
+        # a connection that cannot be made gives its slot back, or the pool would shrink for good
+        try:
+            return createSocket()
+        except Exception:
+            self.slots.release()
+            raise
+
+    ## RETURN A CONNECTION, BROKEN ONES (TIMEOUTS, UNREAD DATA) ARE CLOSED INSTEAD
+    def put(self, c, reuse=True):
+        if reuse:
+            with self.lock:
+                self.idle.append((c, time.time()))
+        else:
+            self.discard(c, polite=False)
+        self.slots.release()
+
+    ## CLOSE EVERY IDLE CONNECTION
+    def close(self):
+        with self.lock:
+            idle, self.idle = self.idle, []
+        for c, _ in idle:
+            self.discard(c)
+
+POOL = ConnectionPool(args.pool, args.idle)
+
+### FUNCTION TO FETCH ONE SEGMENT [offset, offset+length) OVER A POOLED CONNECTION AND pwrite IT IN PLACE
+def fetchSegment(f, fd, offset, length, md5_original):
+    done = 0
+    tries = 3
+    ## a timed out segment resumes from its last written byte on a new connection
+    while done < length and tries:
+        c = POOL.get()
+        sendRange(f, offset+done, length-done, c)
+        head = getRangeHeader(c)
+        if head == "TIMEOUT" or head[2] != md5_original:
+            tries -= 1
+            POOL.put(c, reuse=False)
+            continue
+        count = head[0]
+        start = offset+done
+        got = recvBody(c, count, head[3], lambda data, at: os.pwrite(fd, data, start+at))
+        done += got
+        if got < count:
+            tries -= 1
+            POOL.put(c, reuse=False)
+            continue
+        POOL.put(c)
+    return done == length
+
+### FUNCTION TO DOWNLOAD ONE LARGE FILE AS N BYTE RANGE SEGMENTS OVER UP TO N CONNECTIONS
+### The output is preallocated to the full size and every segment is written in place with os.pwrite.
+def fetchSegmented(f, total, md5_original, segments):
+    dest = os.path.join(args.dir, f)
+    seg_file = f'{dest}.{md5_original}.seg'
+    fd = os.open(seg_file, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        os.ftruncate(fd, total)
+        size = -(-total // segments)
+        ranges = [(o, min(size, total-o)) for o in range(0, total, size)]
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(ranges)) as executor:
+            threads = [executor.submit(fetchSegment, f, fd, o, l, md5_original) for o, l in ranges]
+            ok = all(t.result() for t in threads)
+    finally:
+        os.close(fd)
+    if not ok:
+        os.remove(seg_file)
+        return "TIMEOUT"
+    ## INTEGRITY CHECK OF THE WHOLE FILE
+    if fileDigest(seg_file) != md5_original:
+        os.remove(seg_file)
+        return "INTEGRITY"
+    os.replace(seg_file, dest)
+    return None
 
 ### FUNCTION FOR USER TO INTERACT AND SELECT FILES TO DOWNLOAD FROM THE LIST
 def selectFilesFromList(file_list):
     ## Display list in console
     print("\nSelect files to download by index number. For multiple files seperate the index number with comma:\n")
-    print(f'{"Index":<8}{"File Name":<20}')
-    for f in file_list:
-        print(f'{file_list.index(f):<8}{f:<20}')
+    print(f'{"Index":<8}{"File Name":<20}{"Size (Bytes)":>14}')
+    for i, f in enumerate(file_list):
+        print(f'{i:<8}{f["name"]:<20}{f["size"]:>14}')
     ## Save user input
     li = list(map(int, input('\n').split(',')))
     dl = []
@@ -91,8 +411,8 @@ def selectFilesFromList(file_list):
     ## Check input for valid files
     for i in li:
         try:
-            if i == file_list.index(file_list[i]):
-                dl.append(file_list[i])
+            if i >= 0:
+                dl.append(file_list[i]['name'])
         # Inform of invalid inputs
         except IndexError:
             print(f'\nIndex no {i} not found!')
@@ -103,7 +423,7 @@ def selectFilesFromList(file_list):
 
 ### FUNCTION TO HANDLE SERIAL AND PARALLEL DOWNLOAD MODES   
 def download(file_list, mode, client):
-    ## takes list of files to download, mode and client
+    ## takes list of files to download, mode and client, returns failed files and the (possibly new) client
     fail_list = []
     
     ## SERIALLY DOWNLOAD
@@ -114,83 +434,161 @@ def download(file_list, mode, client):
             # make a list of failed downloads
             if fail:
                 fail_list.append(f)
-        return fail_list
+            # a timed out connection may still carry the rest of the old reply, continue on a new one
+            if fail == "TIMEOUT":
+                client.close()
+                client = createSocket()
+        return fail_list, client
     ## PARALLELY DOWNLOAD
+    elif mode == 2:
+        return downloadPipelined(file_list, client)
     elif mode == 1:
         # assign a thread for the download process and add it to list
-        with concurrent.futures.ThreadPoolExecutor() as executor:
+        # workers share the connection pool, so each connection carries several downloads
+        with concurrent.futures.ThreadPoolExecutor(max_workers=args.pool) as executor:
             threads = [executor.submit(downloadParallel,file_list.index(f),f) for f in file_list]
             # as sson as any download ends, take action
             for f in concurrent.futures.as_completed(threads):
                 fail = f.result() 
                 if fail:
                     fail_list.append(fail)
-        return fail_list
+        return fail_list, client
     ## case for wrong mode selected
     else:
         print("Invalid Input")
-        return file_list
+        return file_list, client
+
+### FUNCTION TO REPORT THE RESULT OF ONE FILE DOWNLOAD
+def report(f, fail, down_file_time):
+    if fail == "TIMEOUT":
+        print(f'\n{f} failed to download due to time out, trying again!')
+    elif fail:
+        print(f'\n{f}\nFile integrity failures. trying again')
+    else:
+        print(f'\n{f}\nIntegrity check passed, downloaded successfully!')
+        print(f'Downloaded in {time.time()-down_file_time} seconds')
 
 ### FUNCTION FOR SERIAL DOWNLOADS
 def downloadSerial(f, client):
     down_file_time = time.time()
-    ## send message for download containing file name
-    send(FILE_DOWNLOAD_MESSAGE+f,client)
-    ## receive md5 and file data 
-    md5_original = getMessage(client)
-    file_data = getMessage(client)
-    ## if the connection timesout due to packet loss, return file name to re-download
-    if (md5_original=="TIMEOUT" or file_data=="TIMEOUT"):
-        print(f'\n{f} failed to download due to time out, trying again!')
-        return f
-    ## generate md5 of the file data received
-    md5_mirror = hashlib.md5(file_data).hexdigest()
-    ## INTEGRITY CHECK - Save if success, else return file name for re-download
-    if md5_original == md5_mirror:
-        file_mirror = open(os.path.join(args.dir,f), 'wb')
-        file_mirror.write(file_data)
-        file_mirror.close()
-        print(f'\n{f}\nmd5: {md5_mirror}\nIntegrity check pass, downloaded successfully!')
-        print(f'Downloaded in {time.time()-down_file_time} seconds')
-    else:
-        print(f'\n{f}\nFile integrity failures. trying again')
-        return f
+    ## download (or resume) the file over the shared connection
+    fail = fetchFile(f, client)
+    report(f, fail, down_file_time)
+    return fail
 
-### FUNCTION FOR PARALLEL DOWNLOADS - Each file is assigned one connection thread
+### FUNCTION FOR PARALLEL DOWNLOADS - Each file is downloaded over a connection checked out of the pool
 def downloadParallel(c,f):
-    ## make a new connection to the server
-    c = createSocket()
-    ## send message for download containing file name
+    ## check out a keep-alive connection to the server
+    c = POOL.get()
     down_file_time = time.time()
-    send(FILE_DOWNLOAD_MESSAGE+f, c)
-    ## receive md5 and file data
-    md5_original = getMessage(c)
-    file_data = getMessage(c)
-    ## if the connection timesout due to packet loss,
-    ## close connection thread and try again
-    if (md5_original=="TIMEOUT" or file_data=="TIMEOUT"):
-        print(f'\n{f} failed to download due to time out, trying again!')
-        send(DISCONNECT_MESSAGE,c)
-        c.close()
-        return f
-    ## generate md5 of the file data received
-    md5_mirror = hashlib.md5(file_data).hexdigest()
-    ## INTEGRITY CHECK - Save if success and disconnect
-    if md5_original == md5_mirror:
-        file_mirror = open(os.path.join(args.dir,f), 'wb')
-        file_mirror.write(file_data)
-        file_mirror.close()
-        print(f'\n{f}\nmd5: {md5_mirror}\nIntegrity check passed, downloaded successfully!')
-        print(f'Downloaded in {time.time()-down_file_time} seconds')
-        send(DISCONNECT_MESSAGE,c)
-        c.close()
-    ## IF FAILED INTEGRITY CHECK - Close connection thread and try again
+    ## large files are split into segments fetched over several connections,
+    ## the zero length range only asks for size and md5
+    head = None
+    if args.segments > 1:
+        sendRange(f, 0, 0, c)
+        head = getRangeHeader(c)
+    if head == "TIMEOUT":
+        fail = "TIMEOUT"
+    elif head and head[1] >= args.segment_min:
+        # give the connection back first, the segments check out their own
+        POOL.put(c)
+        c = None
+        fail = fetchSegmented(f, head[1], head[2], args.segments)
+    ## download (or resume) the file, partial data is kept on failure
     else:
-        print(f'\n{f}\nFile integrity failures. trying again')
-        send(DISCONNECT_MESSAGE,c)
-        c.close()
+        fail = fetchFile(f, c)
+    report(f, fail, down_file_time)
+    ## return connection to the pool (closed if it timed out), return file name to try again on failure
+    if c is not None:
+        POOL.put(c, reuse=(fail != "TIMEOUT"))
+    if fail:
         return f
 
+### FUNCTION FOR PIPELINED DOWNLOADS - Up to --window files are requested at once over the one connection
+### Replies and data frames of the files in flight arrive interleaved and are told apart by the request id
+### in the frame header, each file goes to its own partial file and md5. Returns failed files and the client.
+def downloadPipelined(file_list, client):
+    pending = list(file_list)
+    fail_list = []
+    # request id -> {'file', 'part', 'offset', 'time', 'out', 'md5', 'md5_original', 'count', 'got', 'fail'}
+    flight = {}
+    rid = 0
+    buf = bytearray(BLOCK)
+
+    ## ON A TIMEOUT THE CONNECTION MAY STILL CARRY THE REST OF THE OLD REPLIES, FAIL THEM ALL AND START OVER
+    def abandon():
+        for t in flight.values():
+            if t['out']:
+                t['out'].close()
+            report(t['file'], "TIMEOUT", t['time'])
+            fail_list.append(t['file'])
+        client.close()
+        return fail_list + pending, createSocket()
+
+    while pending or flight:
+        ## KEEP THE WINDOW FULL - resume the newest partial file, a stale one is caught by the reply md5
+        while pending and len(flight) < args.window:
+            f = pending.pop(0)
+            dest = os.path.join(args.dir, f)
+            parts = glob.glob(glob.escape(dest) + '.*.part')
+            part = max(parts, key=os.path.getmtime) if parts else None
+            offset = os.path.getsize(part) if part else 0
+            rid += 1
+            send({'main':FILE_MUX_MESSAGE, 'file_name':f, 'offset':offset, 'length':-1}, client, rid)
+            flight[rid] = {'file':f, 'part':part, 'offset':offset, 'time':time.time(), 'out':None, 'md5':None,
+                           'md5_original':None, 'count':0, 'got':0, 'fail':None}
+
+        ## NEXT FRAME OF ANY FILE IN FLIGHT
+        head = getFrameHead(client)
+        if head == "TIMEOUT":
+            return abandon()
+        msg, frame_rid, payload_len = head
+        t = flight[frame_rid]
+
+        ## REPLY - open the partial file, drop partial files of other versions of the file
+        if msg['main'] == RES_MUX_MESSAGE:
+            dest = os.path.join(args.dir, t['file'])
+            part = f'{dest}.{msg["md5"]}.part'
+            for p in glob.glob(glob.escape(dest) + '.*.part'):
+                if p != part:
+                    os.remove(p)
+            # the range asked for does not continue this version of the file, take the data and retry
+            if t['part'] not in (None, part) or msg['offset'] != t['offset']:
+                t['fail'] = "CHANGED"
+                t['out'] = open(os.devnull, 'wb')
+            else:
+                t['out'] = open(part, 'ab')
+                t['md5'] = hashFile(part, hashlib.md5()) if t['offset'] else hashlib.md5()
+            t['part'], t['md5_original'], t['count'] = part, msg['md5'], msg['count']
+
+        ## DATA FRAME - append its payload to the partial file of its request
+        elif payload_len:
+            left = payload_len
+            while left:
+                view = memoryview(buf)[:min(BLOCK, left)]
+                if not recvInto(client, view):
+                    return abandon()
+                t['out'].write(view)
+                if t['md5']:
+                    t['md5'].update(view)
+                left -= len(view)
+            t['got'] += payload_len
+
+        ## EMPTY DATA FRAME - the download is complete, check integrity and move into place
+        else:
+            t['out'].close()
+            del flight[frame_rid]
+            fail = t['fail']
+            if not fail and (t['got'] != t['count'] or t['md5'].hexdigest() != t['md5_original']):
+                os.remove(t['part'])
+                fail = "INTEGRITY"
+            if not fail:
+                os.replace(t['part'], os.path.join(args.dir, t['file']))
+            report(t['file'], fail, t['time'])
+            if fail:
+                fail_list.append(t['file'])
+    return fail_list, client
+
 ### START MAIN CLIENT PROGRAM (ACTIVE)
 client = createSocket()
 print(f"[CONNECTED] Client connected to {args.ip}")
@@ -198,28 +596,34 @@ active = True
 try:
     while active: 
         ## SEND REQUEST TO GET FILE LIST ON DEMAND
-        send(FILE_LIST_MESSAGE, client)
-        file_list = getMessage(client)
+        file_list = getFileList(client)
         if file_list == "TIMEOUT":
             continue
         
-        ## LET USER SELECT FILES TO DOWNLOAD FROM THE LIST
-        file_list = selectFilesFromList(file_list)
+        ## LET USER SELECT FILES TO DOWNLOAD FROM THE LIST (OR TAKE THEM FROM --files)
+        if args.files:
+            names = set(f['name'] for f in file_list)
+            file_list = [f for f in args.files.split(',') if f in names]
+        else:
+            file_list = selectFilesFromList(file_list)
         
-        ## LET USER SELECT MODE
-        comm = int(input("Enter\n0 - Serially download\n1 - Parallely download\n"))
+        ## LET USER SELECT MODE (OR TAKE IT FROM --mode)
+        if args.mode is not None:
+            comm = args.mode
+        else:
+            comm = int(input("Enter\n0 - Serially download\n1 - Parallely download\n2 - Pipelined download over one connection\n"))
         download_time = time.time()
-        fail_list = download(file_list, comm, client)
+        fail_list, client = download(file_list, comm, client)
         
         ## LOOP TO TRY AND DOWNLOAD FAILED FILES AGAIN
         if fail_list:
             retry = 3
             while retry:
-                if (comm != 0 and comm != 1):
+                if comm not in (0, 1, 2):
                     break
                 print(f'\n{fail_list} failed to download, tries left {retry}')
                 retry = retry - 1
-                fail_list = download(fail_list, comm, client)
+                fail_list, client = download(fail_list, comm, client)
                 if not fail_list:
                     break
         
@@ -230,8 +634,9 @@ try:
         download_time = time.time()-download_time
         print(f'\nDownload Completed in: {download_time} seconds')
         
-        ## END CONNECTION
-        send(DISCONNECT_MESSAGE, client)
+        ## END CONNECTIONS
+        POOL.close()
+        send({'main':DISCONNECT_MESSAGE}, client)
         client.close()
         
         ## DEACTIVATE PROGRAM
@@ -239,5 +644,6 @@ try:
         active = False
 
 except KeyboardInterrupt:
-    send(DISCONNECT_MESSAGE, client)
+    POOL.close()
+    send({'main':DISCONNECT_MESSAGE}, client)
     print("\n[KEYBOARD INTERRUPT]")
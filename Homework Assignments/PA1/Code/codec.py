@@ -0,0 +1,401 @@
+### DEFAULT PYTHON 3.8.3 MODULES
+import struct
+import zlib
+import bz2
+import lzma
+
+### COMPACT BINARY FRAMING CODEC
+###
+### Frame on the wire:
+###   header   18 bytes, struct '!HIIQ' = type code, request id, body length, payload length
+###   body     the message dict (without 'main' and without the payload) in the compact encoding below
+###   payload  raw trailing bytes (file data, chunks), never encoded or copied into the body
+###
+### Type codes are derived from the message name (crc32 & 0xffff), so both ends agree without
+### sharing a table; every message a script sends or receives must be registered first.
+### Decoding only builds None/bool/int/float/str/bytes/list/tuple/dict, unlike pickle, and a header
+### announcing more than MAX_BODY/MAX_PAYLOAD bytes is refused before anything is allocated for it.
+###
+### This is the one copy of the codec, the codec.py of PA2, PA3 and PA4 is a link to it.
+
+HEADER = struct.Struct('!HIIQ')
+HEADER_SIZE = HEADER.size
+MAX_BODY = 16777216         # Largest body accepted from a peer
+MAX_PAYLOAD = 1073741824    # Largest payload accepted from a peer into memory, a streamed payload may pass its own limit
+MAX_DEPTH = 32              # Deepest nesting of lists/tuples/dicts accepted from a peer
+SMALL_FRAME = 65536         # Payloads up to this size are joined to the header and sent in one call
+
+### VALUE TAGS
+(NONE, FALSE, TRUE, UINT8, UINT16, INT32, INT64, BIGINT, FLOAT, STR8, STR32, REF8, REF16,
+ BYTES8, BYTES32, LIST8, LIST32, TUPLE8, TUPLE32, DICT8, DICT32) = range(21)
+
+_B = struct.Struct('!B')
+_H = struct.Struct('!H')
+_i = struct.Struct('!i')
+_q = struct.Struct('!q')
+_d = struct.Struct('!d')
+_I = struct.Struct('!I')
+_BB = struct.Struct('!BB')
+_BH = struct.Struct('!BH')
+_Bi = struct.Struct('!Bi')
+_Bq = struct.Struct('!Bq')
+_Bd = struct.Struct('!Bd')
+_BI = struct.Struct('!BI')
+
+_TAG = [_B.pack(t) for t in range(21)]
+_UINT8 = [_BB.pack(UINT8, n) for n in range(256)]
+
+### MESSAGE TYPE REGISTRY
+CODES = {}                  # message name -> type code
+NAMES = {}                  # type code -> message name
+PAYLOADS = {}               # message name -> key of the dict entry sent as raw payload
+
+## REGISTER A MESSAGE NAME, OPTIONALLY WITH THE KEY THAT CARRIES ITS BULK PAYLOAD
+def register(name, payload=None):
+    code = zlib.crc32(name.encode('utf-8')) & 0xffff
+    if NAMES.get(code, name) != name:
+        raise ValueError(f'type code collision between {name} and {NAMES[code]}')
+    CODES[name] = code
+    NAMES[code] = name
+    if payload:
+        PAYLOADS[name] = payload
+
+##
+### ENCODER
+##
+
+## Repeated strings (e.g. the host of every address in a source list) are sent once and then
+## referenced by their index in the memo.
+def _encode(v, out, memo):
+    t = type(v)
+    if t is str:
+        ref = memo.get(v)
+        if ref is not None:
+            out.append(_BB.pack(REF8, ref) if ref < 256 else _BH.pack(REF16, ref))
+            return
+        if len(memo) < 65536:
+            memo[v] = len(memo)
+        b = v.encode('utf-8')
+        out.append(_BB.pack(STR8, len(b)) + b if len(b) < 256 else _BI.pack(STR32, len(b)) + b)
+    elif t is int:
+        if 0 <= v < 256:
+            out.append(_UINT8[v])
+        elif 0 <= v < 65536:
+            out.append(_BH.pack(UINT16, v))
+        elif -2147483648 <= v < 2147483648:
+            out.append(_Bi.pack(INT32, v))
+        elif -9223372036854775808 <= v < 9223372036854775808:
+            out.append(_Bq.pack(INT64, v))
+        else:
+            b = str(v).encode('ascii')
+            out.append(_BB.pack(BIGINT, len(b)) + b)
+    elif t is tuple or t is list:
+        n = len(v)
+        if t is tuple:
+            out.append(_BB.pack(TUPLE8, n) if n < 256 else _BI.pack(TUPLE32, n))
+        else:
+            out.append(_BB.pack(LIST8, n) if n < 256 else _BI.pack(LIST32, n))
+        for i in v:
+            _encode(i, out, memo)
+    elif v is None:
+        out.append(_TAG[NONE])
+    elif t is bool:
+        out.append(_TAG[TRUE] if v else _TAG[FALSE])
+    elif t is dict:
+        n = len(v)
+        out.append(_BB.pack(DICT8, n) if n < 256 else _BI.pack(DICT32, n))
+        for k, i in v.items():
+            _encode(k, out, memo)
+            _encode(i, out, memo)
+    elif t is float:
+        out.append(_Bd.pack(FLOAT, v))
+    elif t is bytes or t is bytearray or t is memoryview:
+        b = bytes(v)
+        out.append(_BB.pack(BYTES8, len(b)) + b if len(b) < 256 else _BI.pack(BYTES32, len(b)) + b)
+    else:
+        raise TypeError(f'cannot encode {t.__name__}')
+
+## ENCODE THE FIELDS OF A MESSAGE (EVERYTHING BUT 'main' AND THE PAYLOAD) AS A DICT
+def _body(msg, skip):
+    out = [None]
+    memo = {}
+    n = 0
+    for k, v in msg.items():
+        if k != 'main' and k != skip:
+            _encode(k, out, memo)
+            _encode(v, out, memo)
+            n += 1
+    out[0] = _BB.pack(DICT8, n) if n < 256 else _BI.pack(DICT32, n)
+    return b''.join(out)
+
+## ENCODE A MESSAGE DICT - RETURNS (header + body, payload)
+## The payload is returned as is, so the caller can send it without joining it to the body.
+def pack(msg, rid=0):
+    name = msg['main']
+    payload_key = PAYLOADS.get(name)
+    body = _body(msg, payload_key)
+    payload = msg.get(payload_key) if payload_key else None
+    if payload is None:
+        payload = b''
+    plen = payload.nbytes if type(payload) is memoryview else len(payload)
+    return HEADER.pack(CODES[name], rid, len(body), plen) + body, payload
+
+## ENCODE A WHOLE FRAME INTO ONE BYTES OBJECT (SMALL MESSAGES)
+def packed(msg, rid=0):
+    head, payload = pack(msg, rid)
+    return head + payload if payload else head
+
+## SEND ONE MESSAGE ON A BLOCKING SOCKET - RETURNS NUMBER OF BYTES SENT
+## Small frames go out in one call, a large payload is sent from the caller's buffer without joining.
+def sendMsg(sock, msg, rid=0):
+    head, payload = pack(msg, rid)
+    plen = payload.nbytes if type(payload) is memoryview else len(payload)
+    if plen > SMALL_FRAME:
+        sock.sendall(head)
+        sock.sendall(payload)
+    else:
+        sock.sendall(head + bytes(payload) if plen else head)
+    return len(head) + plen
+
+## HEADER FOR A FRAME WHOSE PAYLOAD IS STREAMED SEPARATELY (e.g. WITH sendfile)
+def packHead(msg, payload_len, rid=0):
+    body = _body(msg, PAYLOADS.get(msg['main']))
+    return HEADER.pack(CODES[msg['main']], rid, len(body), payload_len) + body
+
+##
+### DECODER
+##
+
+def _decode(buf, i, depth, memo):
+    tag = buf[i]
+    i += 1
+    if tag == STR8:
+        n = buf[i]
+        v = str(buf[i+1:i+1+n], 'utf-8')
+        if len(memo) < 65536:
+            memo.append(v)
+        return v, i+1+n
+    if tag == UINT8:
+        return buf[i], i+1
+    if tag == REF8:
+        return memo[buf[i]], i+1
+    if tag == UINT16:
+        return _H.unpack_from(buf, i)[0], i+2
+    if LIST8 <= tag <= DICT32:
+        if depth >= MAX_DEPTH:
+            raise ValueError('message nested too deep')
+        if tag == LIST8 or tag == TUPLE8 or tag == DICT8:
+            n = buf[i]
+            i += 1
+        else:
+            n = _I.unpack_from(buf, i)[0]
+            i += 4
+        if n > len(buf) - i:
+            raise ValueError('container longer than body')
+        if tag == DICT8 or tag == DICT32:
+            d = {}
+            for _ in range(n):
+                k, i = _decode(buf, i, depth+1, memo)
+                d[k], i = _decode(buf, i, depth+1, memo)
+            return d, i
+        items = []
+        for _ in range(n):
+            v, i = _decode(buf, i, depth+1, memo)
+            items.append(v)
+        return (tuple(items) if tag == TUPLE8 or tag == TUPLE32 else items), i
+    if tag == NONE:
+        return None, i
+    if tag == TRUE:
+        return True, i
+    if tag == FALSE:
+        return False, i
+    if tag == INT32:
+        return _i.unpack_from(buf, i)[0], i+4
+    if tag == INT64:
+        return _q.unpack_from(buf, i)[0], i+8
+    if tag == FLOAT:
+        return _d.unpack_from(buf, i)[0], i+8
+    if tag == STR32:
+        n = _I.unpack_from(buf, i)[0]
+        v = str(buf[i+4:i+4+n], 'utf-8')
+        if len(memo) < 65536:
+            memo.append(v)
+        return v, i+4+n
+    if tag == REF16:
+        return memo[_H.unpack_from(buf, i)[0]], i+2
+    if tag == BYTES8:
+        n = buf[i]
+        return bytes(buf[i+1:i+1+n]), i+1+n
+    if tag == BYTES32:
+        n = _I.unpack_from(buf, i)[0]
+        return bytes(buf[i+4:i+4+n]), i+4+n
+    if tag == BIGINT:
+        n = buf[i]
+        return int(str(buf[i+1:i+1+n], 'ascii')), i+1+n
+    raise ValueError(f'unknown tag {tag}')
+
+## PARSE A FRAME HEADER - RETURNS (message name, request id, body length, payload length)
+## max_payload None is for a caller that streams the payload to disk instead of holding it in memory.
+def unpackHeader(buf, max_payload=MAX_PAYLOAD):
+    code, rid, body_len, payload_len = HEADER.unpack_from(buf)
+    if code not in NAMES:
+        raise ValueError(f'unknown message type {code}')
+    if body_len > MAX_BODY:
+        raise ValueError(f'body of {body_len} bytes is too large')
+    if max_payload is not None and payload_len > max_payload:
+        raise ValueError(f'payload of {payload_len} bytes is too large')
+    return NAMES[code], rid, body_len, payload_len
+
+## DECODE A BODY (bytes, bytearray or memoryview) INTO A MESSAGE DICT, PAYLOAD GOES UNDER ITS REGISTERED KEY
+def decodeBody(name, body, payload=None):
+    try:
+        msg, end = _decode(body, 0, 0, [])
+    except (IndexError, struct.error, UnicodeDecodeError, ValueError) as e:
+        raise ValueError(f'malformed body: {e}')
+    if end != len(body) or type(msg) is not dict:
+        raise ValueError('malformed body')
+    msg['main'] = name
+    if name in PAYLOADS:
+        msg[PAYLOADS[name]] = payload
+    return msg
+
+## DECODE ONE COMPLETE FRAME HELD IN MEMORY
+def unpack(frame):
+    name, rid, body_len, payload_len = unpackHeader(frame)
+    view = memoryview(frame)
+    body = view[HEADER_SIZE:HEADER_SIZE+body_len]
+    payload = view[HEADER_SIZE+body_len:HEADER_SIZE+body_len+payload_len]
+    return decodeBody(name, body, payload), rid
+
+
+##
+### RECEIVE ENGINE
+##
+
+## RECEIVE EXACTLY len(view) BYTES INTO A BUFFER, SHORT READS ARE CONTINUED - RETURNS False IF THE PEER CLOSED FIRST
+def recvInto(sock, view):
+    got = 0
+    size = len(view)
+    while got < size:
+        n = sock.recv_into(view[got:], size - got)
+        if not n:
+            return False
+        got += n
+    return True
+
+## RECEIVE ONE FRAME ON A BLOCKING SOCKET - RETURNS (message, request id, frame size) OR None ON END OF STREAM
+## Raises ValueError for a frame the header check or the decoder refuses, the caller closes the connection.
+## Body and payload are received into one bytearray preallocated from the header, so a frame of n bytes
+## costs one allocation and O(n) copying; the decoder and the payload get memoryviews of that buffer.
+def recvFrame(sock):
+    head = bytearray(HEADER_SIZE)
+    if not recvInto(sock, memoryview(head)):
+        return None
+    name, rid, body_len, payload_len = unpackHeader(head)
+    buf = bytearray(body_len + payload_len)
+    view = memoryview(buf)
+    if not recvInto(sock, view):
+        return None
+    return decodeBody(name, view[:body_len], view[body_len:]), rid, HEADER_SIZE + len(buf)
+
+
+##
+### STREAMING COMPRESSION
+##
+### Peers agree on one stdlib codec and level per connection (see negotiate). A sender compresses
+### a sample of the data first and sends it raw when compression would not pay off.
+
+COMPRESSORS = {
+    'zlib': lambda level: zlib.compressobj(level),
+    'bz2': lambda level: bz2.BZ2Compressor(max(level, 1)),
+    'lzma': lambda level: lzma.LZMACompressor(preset=level),
+}
+DECOMPRESSORS = {'zlib': zlib.decompressobj, 'bz2': bz2.BZ2Decompressor, 'lzma': lzma.LZMADecompressor}
+SAMPLE_SIZE = 65536         # Bytes compressed up front to decide if data is worth compressing
+MIN_SAVING = 0.1            # Smallest fraction of the sample compression must save
+
+## PICK THE FIRST OFFERED CODEC THE RECEIVER ALLOWS - RETURNS (codec, level) OR (None, 0)
+def negotiate(offered, allowed, level):
+    for name in offered:
+        if name in allowed and name in COMPRESSORS:
+            return name, min(max(int(level), 0), 9)
+    return None, 0
+
+## COMPRESS A SAMPLE OF THE DATA - RETURNS True IF IT SHRINKS BY AT LEAST MIN_SAVING
+def compressible(sample, name, level):
+    if not sample:
+        return False
+    c = COMPRESSORS[name](level)
+    return len(c.compress(sample)) + len(c.flush()) <= len(sample) * (1 - MIN_SAVING)
+
+## ONE-SHOT COMPRESS AND DECOMPRESS OF A SMALL BUFFER
+def compress(data, name, level):
+    c = COMPRESSORS[name](level)
+    return c.compress(data) + c.flush()
+
+## A PEER'S DATA NEVER INFLATES PAST limit BYTES, CORRUPT DATA, LONGER OUTPUT OR INPUT LEFT OVER RAISES ValueError
+def decompress(data, name, limit):
+    d = DECOMPRESSORS[name]()
+    try:
+        out = d.decompress(data, limit + 1)
+    except (zlib.error, lzma.LZMAError, OSError, EOFError) as e:
+        raise ValueError(f'{name} data is corrupt: {e}')
+    if len(out) > limit or getattr(d, 'unconsumed_tail', b'') or d.unused_data:
+        raise ValueError(f'{name} data has input left over or inflates past {limit} bytes')
+    return out
+
+## DECOMPRESS data WITH A STREAMING decompressor IN PIECES OF AT MOST block BYTES, SO A SMALL INPUT
+## NEVER INFLATES IN MEMORY ALL AT ONCE
+def inflate(decompressor, data, block):
+    while True:
+        out = decompressor.decompress(data, block)
+        if out:
+            yield out
+        # zlib hands back the input it did not get to, bz2 and lzma keep it inside
+        if hasattr(decompressor, 'unconsumed_tail'):
+            data = decompressor.unconsumed_tail
+            if not data and len(out) < block:
+                return
+        else:
+            data = b''
+            if decompressor.needs_input or decompressor.eof:
+                return
+
+## COMPRESSION PART OF A STAT LOG LINE - raw BYTES OF DATA CARRIED IN wire BYTES FOR cpu SECONDS
+def compressStat(name, raw, wire, cpu):
+    saved = 1 - wire/raw if raw else 0
+    return f' | codec:{name or "none"} raw:{raw} wire:{wire} saved:{saved:.1%} cpu:{cpu:.6f}s'
+
+
+### MICRO-BENCHMARKS AGAINST PICKLE + PADDED ASCII LENGTH HEADER (python3 codec.py)
+if __name__ == "__main__":
+    import pickle
+    import timeit
+
+    def picklePack(msg, header=16):
+        msg = pickle.dumps(msg)
+        return bytes(f'{len(msg):<{header}}', 'utf-8') + msg
+
+    def pickleUnpack(frame, header=16):
+        return pickle.loads(frame[header:header+int(frame[:header])])
+
+    register('!LEADER_CHECK')
+    register('!RES_FILE_SRC_MESSAGE')
+    register('!RES_DOWNLOAD', payload='chunk_data')
+    cases = [
+        ('control !LEADER_CHECK', {'main':'!LEADER_CHECK', 'addr':('127.0.0.1', 9001)}),
+        ('source list (20 peers)', {'main':'!RES_FILE_SRC_MESSAGE', 'status':True, 'src_list':[('127.0.0.1', 9000+i) for i in range(20)], 'src_list_sec':None}),
+        ('chunk 1536 B', {'main':'!RES_DOWNLOAD', 'file_name':'data.bin', 'md5':'0'*32, 'chunk_data':bytes(1536), 'cnumber':4711}),
+        ('chunk 4 MiB', {'main':'!RES_DOWNLOAD', 'file_name':'data.bin', 'md5':'0'*32, 'chunk_data':bytes(4194304), 'cnumber':4711}),
+    ]
+    print(f'{"Message":<26}{"pickle B":>10}{"codec B":>10}{"pickle enc us":>15}{"codec enc us":>14}{"pickle dec us":>15}{"codec dec us":>14}')
+    for label, msg in cases:
+        number = 2000 if len(msg.get('chunk_data', b'')) < 65536 else 50
+        pframe = picklePack(msg)
+        cframe = packed(msg)
+        penc = min(timeit.repeat(lambda: picklePack(msg), number=number, repeat=3)) / number * 1e6
+        # a sender passes head and payload to sendmsg/sendfile separately, so encoding stops at pack()
+        cenc = min(timeit.repeat(lambda: pack(msg), number=number, repeat=3)) / number * 1e6
+        pdec = min(timeit.repeat(lambda: pickleUnpack(pframe), number=number, repeat=3)) / number * 1e6
+        cdec = min(timeit.repeat(lambda: unpack(cframe), number=number, repeat=3)) / number * 1e6
+        print(f'{label:<26}{len(pframe):>10}{len(cframe):>10}{penc:>15.2f}{cenc:>14.2f}{pdec:>15.2f}{cdec:>14.2f}')
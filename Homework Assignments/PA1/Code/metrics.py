@@ -0,0 +1,170 @@
+### DEFAULT PYTHON 3.8.3 MODULES
+import threading
+import bisect
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+### IN-PROCESS METRICS REGISTRY WITH A PROMETHEUS TEXT ENDPOINT
+###
+### Counters, gauges and histograms are kept per label set and are safe to update from any thread.
+### A scrape of http://<host>:<port>/metrics renders every registered metric in the Prometheus
+### text exposition format (version 0.0.4).
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+DURATION_BUCKETS = (.001, .005, .01, .05, .1, .25, .5, 1, 2.5, 5, 10, 30, 60)
+
+## ESCAPE A LABEL VALUE FOR THE EXPOSITION FORMAT
+def _escape(v):
+    return str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+## RENDER A LABEL SET, extra IS APPENDED (e.g. THE le LABEL OF A HISTOGRAM BUCKET)
+def _labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{k}="{_escape(v)}"' for k, v in pairs) + '}'
+
+## RENDER A SAMPLE VALUE, WHOLE NUMBERS WITHOUT A FRACTION
+def _value(v):
+    if v == float('inf'):
+        return '+Inf'
+    return str(int(v)) if float(v).is_integer() else repr(float(v))
+
+
+### BASE OF ALL METRICS - ONE VALUE PER LABEL SET, LABEL VALUES ARE PASSED AS KEYWORDS
+class Metric:
+    kind = 'untyped'
+
+    def __init__(self, name, doc, labels=()):
+        self.name = name
+        self.doc = doc
+        self.labels = tuple(labels)
+        self.lock = threading.Lock()
+        self.values = {}
+
+    ## LABEL VALUES IN DECLARED ORDER
+    def key(self, labels):
+        return tuple(labels[l] for l in self.labels)
+
+    ## EXPOSITION LINES OF ONE LABEL SET
+    def samples(self, key, value):
+        return [f'{self.name}{_labels(self.labels, key)} {_value(value)}']
+
+    ## EXPOSITION TEXT OF THE WHOLE METRIC
+    def render(self):
+        with self.lock:
+            items = sorted(self.values.items())
+        lines = [f'# HELP {self.name} {self.doc}', f'# TYPE {self.name} {self.kind}']
+        for key, value in items:
+            lines += self.samples(key, value)
+        return lines
+
+
+### MONOTONIC COUNTER
+class Counter(Metric):
+    kind = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+
+### VALUE THAT GOES UP AND DOWN
+class Gauge(Metric):
+    kind = 'gauge'
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[self.key(labels)] = value
+
+    def get(self, **labels):
+        with self.lock:
+            return self.values.get(self.key(labels), 0)
+
+
+### HISTOGRAM OF OBSERVATIONS, BUCKETS ARE CUMULATIVE WHEN RENDERED
+class Histogram(Metric):
+    kind = 'histogram'
+
+    def __init__(self, name, doc, labels=(), buckets=DURATION_BUCKETS):
+        Metric.__init__(self, name, doc, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        i = bisect.bisect_left(self.buckets, value)
+        with self.lock:
+            counts, total = self.values.get(key, ([0] * (len(self.buckets) + 1), 0))
+            counts[i] += 1
+            self.values[key] = (counts, total + value)
+
+    def samples(self, key, value):
+        counts, total = value
+        lines = []
+        cumulative = 0
+        for le, n in zip(self.buckets + (float('inf'),), counts):
+            cumulative += n
+            lines.append(f'{self.name}_bucket{_labels(self.labels, key, [("le", _value(le))])} {cumulative}')
+        lines.append(f'{self.name}_sum{_labels(self.labels, key)} {_value(total)}')
+        lines.append(f'{self.name}_count{_labels(self.labels, key)} {cumulative}')
+        return lines
+
+
+### REGISTRY - CREATES METRICS AND RENDERS THEM ALL FOR A SCRAPE
+class Registry:
+
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, doc, labels=()):
+        return self.register(Counter(name, doc, labels))
+
+    def gauge(self, name, doc, labels=()):
+        return self.register(Gauge(name, doc, labels))
+
+    def histogram(self, name, doc, labels=(), buckets=DURATION_BUCKETS):
+        return self.register(Histogram(name, doc, labels, buckets))
+
+    def render(self):
+        lines = []
+        for m in self.metrics:
+            lines += m.render()
+        return '\n'.join(lines) + '\n'
+
+
+### SERVE A REGISTRY ON /metrics FROM A DAEMON THREAD - RETURNS THE HTTP SERVER
+def serve(registry, host, port):
+
+    class Handler(BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+            body = registry.render().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', CONTENT_TYPE)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        # scrapes are not worth a log line each
+        def log_message(self, *_):
+            pass
+
+    http = ThreadingHTTPServer((host, port), Handler)
+    http.daemon_threads = True
+    threading.Thread(target=http.serve_forever, daemon=True).start()
+    return http
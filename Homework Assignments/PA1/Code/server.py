@@ -1,19 +1,32 @@
 ### DEFAULT PYTHON 3.8.3 MODULES
 import socket
 import threading
-import pickle
 import os
 from os.path import isfile, join
 import argparse
 import hashlib
 import logging
 import time
+import json
+import select
+from collections import OrderedDict
+import asyncio
+import codec
+import metrics
 
 ### Code to Pass Arguments to Server Script through Linux Terminal
 parser = argparse.ArgumentParser(description = "This is the Multi Threaded Socket Server!")
 parser.add_argument('--ip', metavar = 'ip', type = str, nargs = '?', default = socket.gethostbyname(socket.gethostname()))
 parser.add_argument('--port', metavar = 'port', type = int, nargs = '?', default = 9000)
 parser.add_argument('--dir', metavar = 'dir', type = str, nargs = '?', default = './host_dir')
+parser.add_argument('--engine', metavar = 'engine', type = str, nargs = '?', default = 'thread', choices = ['thread', 'asyncio'])
+parser.add_argument('--compress', metavar = 'compress', type = str, nargs = '?', default = 'zlib,bz2,lzma')
+parser.add_argument('--metrics_port', metavar = 'metrics_port', type = int, nargs = '?', default = 9091)
+parser.add_argument('--rate', metavar = 'rate', type = int, nargs = '?', default = 0)
+parser.add_argument('--client_rate', metavar = 'client_rate', type = int, nargs = '?', default = 0)
+parser.add_argument('--quantum', metavar = 'quantum', type = int, nargs = '?', default = 65536)
+parser.add_argument('--cache', metavar = 'cache', type = int, nargs = '?', default = 268435456)
+parser.add_argument('--cache_file_max', metavar = 'cache_file_max', type = int, nargs = '?', default = 16777216)
 args = parser.parse_args()
 
 ### SETUP LOGGING
@@ -28,16 +41,53 @@ logger.addHandler(file_handler)
 logger.addHandler(stream_handler)
 
 ### CONNECTION PROTOCOL
-HEADER = 64                 # Size of header
+HEADER = codec.HEADER_SIZE  # Size of frame header (see codec.py)
 PACKET = 2048               # Size of a packet, multiple packets are sent if message is larger than packet size. 
 FORMAT = 'utf-8'            # Message format
+BLOCK = 1048576             # Size of a block read from disk while hashing files
+DIGEST_INDEX = '.md5_index.json'    # Sidecar file in --dir where file digests are persisted
+DIGEST_SAVE_DELAY = 5       # Seconds between saves of the digest index to disk
+INDEX_INTERVAL = 1          # Seconds between checks of the directory mtime by the directory index
+COMPRESS_MIN = 4096         # Bodies smaller than this are never compressed
+MAX_PAGE = 1000             # Most files a client gets in one page of the file listing, whatever limit it asks for
+BURST_SECONDS = 0.1         # A rate limit lets this many seconds of traffic out at once
+CODECS = [c for c in args.compress.split(',') if c in codec.COMPRESSORS]    # Codecs clients may pick
 ADDR = (args.ip, args.port)  # Address socket server will bind to  
 
 ### DEFAULT MESSAGES
 FILE_LIST_MESSAGE = "!GET_FILE_LIST"
-FILE_DOWNLOAD_MESSAGE = "!DOWNLOAD "
+RES_FILE_LIST_MESSAGE = "!RES_FILE_LIST"      # {'file_list'}
+FILE_PAGE_MESSAGE = "!GET_FILE_PAGE"          # {'offset', 'limit'}
+RES_FILE_PAGE_MESSAGE = "!RES_FILE_PAGE"      # {'total', 'files':[{'name','size','mtime','md5'}]}
+FILE_DOWNLOAD_MESSAGE = "!DOWNLOAD"           # {'file_name'}
+RES_DOWNLOAD_MESSAGE = "!RES_DOWNLOAD"        # {'md5'}, file bytes follow as raw payload
+FILE_RANGE_MESSAGE = "!DOWNLOAD_RANGE"        # {'file_name', 'offset', 'length'}
+RES_RANGE_MESSAGE = "!RES_DOWNLOAD_RANGE"     # {'offset', 'total', 'md5'}, range bytes follow as raw payload
+COMPRESS_MESSAGE = "!COMPRESS"                # {'codecs', 'level'}, codecs in order of preference
+RES_COMPRESS_MESSAGE = "!RES_COMPRESS"        # {'codec', 'level'}, codec is None if none agreed
+BLOCK_MESSAGE = "!BLOCK"                      # compressed bytes as raw payload, an empty block ends the body
+FILE_MUX_MESSAGE = "!DOWNLOAD_MUX"            # {'file_name', 'offset', 'length'}, answered under its request id
+RES_MUX_MESSAGE = "!RES_DOWNLOAD_MUX"         # {'offset', 'total', 'md5', 'count'}, data frames follow
+MUX_DATA_MESSAGE = "!MUX_DATA"                # range bytes as raw payload, an empty frame ends the download
 DISCONNECT_MESSAGE = "!DISCONNECT"
 
+### A COMPRESSED REPLY CARRIES {'encoding', 'count'} AND NO PAYLOAD, THE count BYTES OF THE BODY FOLLOW
+### AS BLOCK MESSAGES WITH THE encoding STREAM
+
+### MULTIPLEXED DOWNLOADS - A CLIENT MAY KEEP MANY !DOWNLOAD_MUX REQUESTS IN FLIGHT ON ONE CONNECTION.
+### Every reply and data frame carries the request id of its request in the frame header, data frames
+### of the downloads in progress are interleaved one quantum at a time.
+
+### REGISTER MESSAGES WITH THE BINARY FRAMING CODEC, FILE DATA TRAVELS AS RAW PAYLOAD
+for m in (FILE_LIST_MESSAGE, RES_FILE_LIST_MESSAGE, FILE_PAGE_MESSAGE, RES_FILE_PAGE_MESSAGE,
+          FILE_DOWNLOAD_MESSAGE, FILE_RANGE_MESSAGE, COMPRESS_MESSAGE, RES_COMPRESS_MESSAGE, FILE_MUX_MESSAGE,
+          RES_MUX_MESSAGE, DISCONNECT_MESSAGE):
+    codec.register(m)
+codec.register(RES_DOWNLOAD_MESSAGE, payload='file_data')
+codec.register(RES_RANGE_MESSAGE, payload='file_data')
+codec.register(BLOCK_MESSAGE, payload='data')
+codec.register(MUX_DATA_MESSAGE, payload='data')
+
 
 ### BIND SOCKET SERVER TO PORT
 try:
@@ -46,99 +96,863 @@ try:
 except Exception as e:
     raise SystemExit(f"Failed to bind to host: {args.ip} and port: {args.port}, because {e}")
 
+### METRICS REGISTRY, SCRAPED IN PROMETHEUS TEXT FORMAT FROM http://127.0.0.1:<metrics_port>/metrics
+METRICS = metrics.Registry()
+ACTIVE_CONNECTIONS = METRICS.gauge('pa1_active_connections', 'Client connections currently open.')
+CONNECTIONS = METRICS.counter('pa1_connections_total', 'Client connections accepted.')
+REQUESTS = METRICS.counter('pa1_requests_total', 'Requests served by message type.', ['type'])
+BYTES_SENT = METRICS.counter('pa1_bytes_sent_total', 'Bytes sent to clients by message type.', ['type'])
+DOWNLOAD_SECONDS = METRICS.histogram('pa1_download_duration_seconds', 'Time to serve a file or range by body size.', ['size'])
+CACHE_LOOKUPS = METRICS.counter('pa1_file_cache_lookups_total', 'File cache lookups by result.', ['result'])
+CACHE_EVICTIONS = METRICS.counter('pa1_file_cache_evictions_total', 'Files evicted from the file cache.')
+CACHE_BYTES_SAVED = METRICS.counter('pa1_file_cache_saved_bytes_total', 'Bytes served from the file cache instead of disk.')
+CACHE_BYTES = METRICS.gauge('pa1_file_cache_bytes', 'Bytes of file contents held by the file cache.')
+SIZE_BUCKETS = ((65536, '64KiB'), (1048576, '1MiB'), (16777216, '16MiB'), (268435456, '256MiB'))
+
+### NAME OF THE SIZE BUCKET A BODY OF size BYTES FALLS IN
+def sizeBucket(size):
+    for limit, name in SIZE_BUCKETS:
+        if size <= limit:
+            return f'<={name}'
+    return f'>{SIZE_BUCKETS[-1][1]}'
+
+### RECORD ONE SERVED REQUEST, DOWNLOADS ALSO GO INTO THE DURATION HISTOGRAM
+def recordRequest(kind, sent, seconds=None, size=0):
+    REQUESTS.inc(type=kind)
+    BYTES_SENT.inc(sent, type=kind)
+    if seconds is not None:
+        DOWNLOAD_SECONDS.observe(seconds, size=sizeBucket(size))
+
+if args.metrics_port:
+    try:
+        metrics.serve(METRICS, '127.0.0.1', args.metrics_port)
+        logger.info(f'{"[METRICS]":<26}Serving http://127.0.0.1:{args.metrics_port}/metrics')
+    except OSError as e:
+        logger.info(f'{"[METRICS]":<26}Failed to serve metrics on port {args.metrics_port}, because {e}')
+
 ### MAKE DIRECTORY TO SERVE FILES IF NOT MADE
 if not os.path.exists(args.dir):
     os.makedirs(args.dir)
     logger.info(f'{"[FILE DIRECTORY]":<26}{args.dir} directory created. Keep files which you want clients to download here.')
 
-### FETCH A LIST OF FILES FROM THE DIRECTORY ON DEMAND
+### FETCH A LIST OF FILES FROM THE DIRECTORY INDEX
 def getFileList():
-    return [f for f in os.listdir(args.dir) if isfile(join(args.dir, f))]
+    return list(INDEX.names)
+
+
+### MD5 HASH A FILE BLOCK BY BLOCK SO MEMORY DOES NOT GROW WITH FILE SIZE
+def fileDigest(file_name):
+    with open(file_name, 'rb') as file_open:
+        return fdDigest(file_open.fileno())
+
+### MD5 OF AN OPEN FILE, READ WITH pread SO THE FILE POSITION IS LEFT AS IT IS
+def fdDigest(fd):
+    md5 = hashlib.md5()
+    offset = 0
+    while True:
+        block = os.pread(fd, BLOCK, offset)
+        if not block:
+            return md5.hexdigest()
+        md5.update(block)
+        offset += len(block)
+
+
+### PERSISTENT INDEX OF FILE DIGESTS, AN ENTRY IS VALID ONLY WHILE (inode, size, mtime_ns) ARE UNCHANGED
+class DigestIndex:
+
+    ## LOAD THE SIDECAR FILE (IF ANY) SO RESTARTS ARE WARM
+    def __init__(self, directory):
+        self.directory = directory
+        self.path = join(directory, DIGEST_INDEX)
+        self.data = {}
+        self.lock = threading.Lock()
+        self.dirty = False
+        self.last_save = time.time()
+        try:
+            with open(self.path, 'r') as index_file:
+                self.data = json.load(index_file)
+            # drop entries for files removed while the server was down
+            self.data = {f: e for f, e in self.data.items() if isfile(join(directory, f))}
+            logger.info(f'{"[DIGEST INDEX]":<26}{len(self.data)} digest(s) loaded from {self.path}')
+        except (OSError, ValueError):
+            self.data = {}
+
+    ## RETURN MD5 OF A FILE, HASH ONLY IF FILE IS NEW OR CHANGED
+    ## st and fd are the fstat and descriptor of the file when it is open already, the digest is of that very file.
+    def digest(self, file_name, st=None, fd=None):
+        if st is None:
+            st = os.stat(join(self.directory, file_name))
+        key = [st.st_ino, st.st_size, st.st_mtime_ns]
+        with self.lock:
+            entry = self.data.get(file_name)
+        if entry and entry[:3] == key:
+            return entry[3]
+        # hash outside the lock so other handlers are not blocked
+        md5 = fdDigest(fd) if fd is not None else fileDigest(join(self.directory, file_name))
+        # a file written to while it was hashed is not cached under the key it had before
+        st = os.fstat(fd) if fd is not None else os.stat(join(self.directory, file_name))
+        if key != [st.st_ino, st.st_size, st.st_mtime_ns]:
+            return md5
+        with self.lock:
+            self.data[file_name] = key + [md5]
+            self.dirty = True
+        if time.time() - self.last_save > DIGEST_SAVE_DELAY:
+            self.save()
+        return md5
+
+    ## RETURN MD5 OF A FILE ONLY IF IT IS ALREADY KNOWN AND STILL VALID, NEVER HASHES
+    def cached(self, file_name, st):
+        with self.lock:
+            entry = self.data.get(file_name)
+        if entry and entry[:3] == [st.st_ino, st.st_size, st.st_mtime_ns]:
+            return entry[3]
+        return None
+
+    ## WRITE INDEX TO A TEMP FILE AND RENAME IT OVER THE SIDECAR
+    def save(self):
+        with self.lock:
+            if not self.dirty:
+                return
+            snapshot = dict(self.data)
+            self.dirty = False
+            self.last_save = time.time()
+        tmp = f'{self.path}.{threading.get_ident()}.tmp'
+        try:
+            with open(tmp, 'w') as index_file:
+                json.dump(snapshot, index_file)
+            os.replace(tmp, self.path)
+        except OSError as e:
+            logger.info(f'{"[DIGEST INDEX]":<26}Failed to save {self.path}, because {e}')
+
+DIGESTS = DigestIndex(args.dir)
+
+
+### DIRECTORY INDEX MAINTAINED IN THE BACKGROUND, SO LISTINGS NEVER SCAN THE DIRECTORY
+### The directory is rescanned with os.scandir only when its mtime changes (files added,
+### removed or renamed). Entries of a served page are re-stat'ed, which catches files
+### rewritten in place, so a page costs O(page) and not O(directory).
+class DirectoryIndex:
+
+    ## BUILD THE FIRST SNAPSHOT
+    def __init__(self, directory):
+        self.directory = directory
+        self.dir_mtime = None
+        self.names = ()         # sorted file names, replaced as a whole so readers need no lock
+        self.refresh()
+
+    ## RESCAN IF THE DIRECTORY CHANGED SINCE THE LAST SCAN
+    def refresh(self):
+        dir_mtime = os.stat(self.directory).st_mtime_ns
+        if dir_mtime == self.dir_mtime:
+            return
+        names = []
+        with os.scandir(self.directory) as it:
+            for entry in it:
+                if entry.name.startswith(DIGEST_INDEX):
+                    continue
+                try:
+                    if entry.is_file():
+                        names.append(entry.name)
+                except OSError:
+                    continue
+        self.names = tuple(sorted(names))
+        self.dir_mtime = dir_mtime
+        logger.info(f'{"[DIRECTORY INDEX]":<26}{len(self.names)} file(s) indexed')
+
+    ## BACKGROUND LOOP
+    def watch(self):
+        while True:
+            time.sleep(INDEX_INTERVAL)
+            try:
+                self.refresh()
+            except OSError as e:
+                logger.info(f'{"[DIRECTORY INDEX]":<26}Failed to scan {self.directory}, because {e}')
+
+    ## RETURN (total files, one page of file metadata)
+    def page(self, offset, limit):
+        names = self.names
+        files = []
+        for f in names[offset:offset+limit]:
+            try:
+                st = os.stat(join(self.directory, f))
+            except OSError:
+                continue
+            files.append({'name':f, 'size':st.st_size, 'mtime':st.st_mtime, 'md5':DIGESTS.cached(f, st)})
+        return len(names), files
+
+INDEX = DirectoryIndex(args.dir)
+threading.Thread(target=INDEX.watch, daemon=True).start()
+
+
+### IN-MEMORY LRU CACHE OF HOT FILE CONTENTS WITH A BYTE BUDGET, SHARED BY ALL HANDLERS
+### An entry is valid only while (inode, size, mtime_ns) are unchanged, like the digest index.
+### Files larger than max_file are never cached, they keep going out with sendfile.
+class FileCache:
+
+    def __init__(self, budget, max_file):
+        self.budget = budget
+        self.max_file = min(max_file, budget)
+        self.entries = OrderedDict()    # file name -> ([inode, size, mtime_ns], bytearray), oldest first
+        self.size = 0
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.saved = 0
+
+    ## RETURN THE CONTENTS OF AN OPEN FILE WHEN IT FITS THE CACHE, count IS THE NUMBER OF BYTES ABOUT TO BE SERVED
+    ## A miss reads the whole file once and keeps it, None means the file is not cacheable.
+    def get(self, file_name, file_open, st, count):
+        if st.st_size > self.max_file:
+            return None
+        key = [st.st_ino, st.st_size, st.st_mtime_ns]
+        with self.lock:
+            entry = self.entries.get(file_name)
+            if entry and entry[0] == key:
+                self.entries.move_to_end(file_name)
+                self.hits += 1
+                self.saved += count
+                CACHE_LOOKUPS.inc(result='hit')
+                CACHE_BYTES_SAVED.inc(count)
+                return entry[1]
+            self.misses += 1
+            CACHE_LOOKUPS.inc(result='miss')
+        # read outside the lock so other handlers are not blocked, two handlers may both read a cold file
+        data = bytearray(st.st_size)
+        view = memoryview(data)
+        got = 0
+        while got < st.st_size:
+            n = os.preadv(file_open.fileno(), [view[got:]], got)
+            if not n:
+                return None
+            got += n
+        # handlers only read the buffer, it is kept as read instead of copied into bytes
+        with self.lock:
+            old = self.entries.pop(file_name, None)
+            if old:
+                self.size -= old[0][1]
+            self.entries[file_name] = (key, data)
+            self.size += st.st_size
+            # evict least recently used files until the budget is met
+            while self.size > self.budget:
+                _, (old_key, _) = self.entries.popitem(last=False)
+                self.size -= old_key[1]
+                self.evictions += 1
+                CACHE_EVICTIONS.inc()
+            CACHE_BYTES.set(self.size)
+        return data
+
+    ## STAT TEXT FOR THE LOG
+    def stat(self):
+        lookups = self.hits + self.misses
+        ratio = self.hits / lookups if lookups else 0
+        return f' | cache hit ratio:{ratio:.2f} evictions:{self.evictions} saved:{self.saved} Bytes'
+
+CACHE = FileCache(args.cache, args.cache_file_max)
+
+### CONTENTS OF A FILE ABOUT TO SERVE count BYTES FROM THE CACHE, OR None TO SEND IT FROM DISK
+def cachedFile(file_name, file_open, st, count):
+    if not CACHE.budget or not count:
+        return None
+    return CACHE.get(file_name, file_open, st, count)
+
+
+### CLAMP A RANGE REQUEST {'offset', 'length'} TO THE FILE SIZE - RETURNS (offset, count)
+### length -1 means up to the end of the file, length 0 only asks for size and md5
+def parseRange(msg, size):
+    offset = min(max(int(msg['offset']), 0), size)
+    length = int(msg['length'])
+    count = size - offset if length < 0 else min(length, size - offset)
+    return offset, count
+
+
+### DECIDE HOW TO SEND count BYTES OF A FILE FROM offset - RETURNS (codec or None, CPU seconds spent)
+### Only the first block is compressed to find out, incompressible files (media, archives) go out raw.
+def chooseEncoding(file_open, offset, count, encoding, level):
+    if not encoding or count < COMPRESS_MIN:
+        return None, 0
+    cpu = time.thread_time()
+    sample = os.pread(file_open.fileno(), min(codec.SAMPLE_SIZE, count), offset)
+    if not codec.compressible(sample, encoding, level):
+        encoding = None
+    return encoding, time.thread_time() - cpu
+
+
+### TOKEN BUCKET KEPT AS A THEORETICAL ARRIVAL TIME (GCRA) - reserve NEVER BLOCKS, IT RETURNS HOW LONG
+### THE CALLER HAS TO WAIT BEFORE SENDING, SO THREADS AND COROUTINES CAN SHARE THE SAME BUCKET
+class TokenBucket:
+
+    def __init__(self, rate, burst):
+        self.rate = rate        # bytes per second, 0 is unlimited
+        self.burst = burst      # bytes that may go out at once
+        self.tat = 0
+
+    ## RESERVE n BYTES - RETURNS SECONDS TO WAIT
+    def reserve(self, n, now):
+        if not self.rate:
+            return 0
+        self.tat = max(self.tat, now) + n / self.rate
+        return max(0, self.tat - self.burst / self.rate - now)
+
+
+### BANDWIDTH SHAPER - GLOBAL AND PER CLIENT IP TOKEN BUCKETS WITH A FAIR SHARE OF THE GLOBAL RATE
+### Bodies are sent in quanta of --quantum bytes and every quantum is reserved first. The global rate
+### is split evenly between the client IPs with a transfer in progress, so a client with many
+### connections gets no more than one with a single connection. Quanta of the transfers of one IP
+### go out in reservation order, which interleaves them.
+class Shaper:
+
+    def __init__(self, rate, client_rate, quantum):
+        self.rate = rate
+        self.client_rate = client_rate
+        self.quantum = quantum
+        self.enabled = bool(rate or client_rate)
+        self.lock = threading.Lock()
+        self.total = TokenBucket(rate, max(quantum, rate * BURST_SECONDS))
+        self.clients = {}       # ip -> {'bucket', 'active', 'sent', 'since'}
+
+    ## A TRANSFER TO ip STARTS
+    def start(self, ip):
+        with self.lock:
+            c = self.clients.get(ip)
+            if c is None:
+                c = self.clients[ip] = {'bucket':TokenBucket(0, self.quantum), 'active':0, 'sent':0, 'since':time.time()}
+            c['active'] += 1
+
+    ## A TRANSFER TO ip ENDS - RETURNS (bytes, seconds) SENT TO ip SINCE IT BECAME ACTIVE IF IT IS NOW IDLE, ELSE None
+    def finish(self, ip, sent):
+        with self.lock:
+            c = self.clients[ip]
+            c['active'] -= 1
+            c['sent'] += sent
+            if c['active']:
+                return None
+            del self.clients[ip]
+        return c['sent'], time.time() - c['since']
+
+    ## RESERVE n BYTES FOR ip - RETURNS SECONDS TO WAIT BEFORE SENDING THEM
+    def reserve(self, ip, n):
+        if not self.enabled:
+            return 0
+        with self.lock:
+            now = time.monotonic()
+            share = self.rate / len(self.clients) if self.rate else 0
+            rates = [r for r in (self.client_rate, share) if r]
+            bucket = self.clients[ip]['bucket']
+            bucket.rate = min(rates)
+            bucket.burst = max(self.quantum, bucket.rate * BURST_SECONDS)
+            return max(bucket.reserve(n, now), self.total.reserve(n, now))
+
+SHAPER = Shaper(args.rate, args.client_rate, args.quantum)
+
+### ACHIEVED RATE PART OF A STAT LOG LINE
+def rateStat(sent, seconds):
+    return f' | rate:{sent/seconds/1e6 if seconds else 0:.2f}MB/s'
+
+### LOG THE RATE A CLIENT ACHIEVED WHILE IT HAD TRANSFERS IN PROGRESS, SKIPS BURSTS OF A QUANTUM OR LESS
+def logClientRate(ip, busy):
+    if busy and busy[0] > SHAPER.quantum:
+        sent, seconds = busy
+        logger.info(f'{"[CLIENT RATE]":<26}{ip} <- sent:{sent} Bytes in time:{seconds:.3f}{rateStat(sent, seconds)}')
+
+
+### ONE MULTIPLEXED DOWNLOAD - A FILE RANGE SENT AS DATA FRAMES TAGGED WITH THE REQUEST ID
+class MuxStream:
+
+    def __init__(self, file_name, file_open, offset, count, rid):
+        self.file_name = file_name
+        self.file_open = file_open
+        self.first = offset
+        self.offset = offset
+        self.count = count
+        self.left = count
+        self.rid = rid
+        self.sent = 0
+        self.start = time.time()
+        self.done = False
+
+    ## NEXT DATA FRAME OF AT MOST quantum BYTES - RETURNS (frame header, file offset, byte count)
+    ## A count of 0 is the empty frame that ends the download.
+    def next(self, quantum):
+        n = min(quantum, self.left)
+        offset = self.offset
+        self.offset += n
+        self.left -= n
+        self.done = not n
+        return codec.packHead({'main':MUX_DATA_MESSAGE}, n, self.rid), offset, n
+
+    ## LOG AND RECORD A FINISHED (OR ABANDONED) DOWNLOAD
+    def close(self, addr):
+        self.file_open.close()
+        logClientRate(addr[0], SHAPER.finish(addr[0], self.sent))
+        recordRequest(FILE_MUX_MESSAGE, self.sent, time.time()-self.start, self.count)
+        logger.info(f'{"[DOWNLOAD FILE]":<26}{addr} -> is downloading {self.file_name} bytes {self.first}-{self.first+self.count} (request {self.rid}), '
+                    f'sent:{self.count-self.left} left:{self.left} Bytes')
+        logger.info(f'{"[UPLOAD STAT]":<26}{addr} <- sent:{self.sent:^12}Bytes in time:{time.time()-self.start:<24}{rateStat(self.sent, time.time()-self.start)}')
+
+
+### STREAMING COMPRESSION OF A FILE RANGE BLOCK BY BLOCK, MEMORY STAYS O(BLOCK) WHATEVER THE FILE SIZE
+class CompressedRange:
+
+    def __init__(self, file_open, offset, count, encoding, level):
+        self.fd = file_open.fileno()
+        self.offset = offset
+        self.left = count
+        self.compressor = codec.COMPRESSORS[encoding](level)
+        self.cpu = 0        # CPU seconds spent reading and compressing
+
+    ## RETURN THE NEXT NON EMPTY PIECE OF COMPRESSED DATA, b'' ONCE THE STREAM IS FLUSHED
+    def next(self):
+        while self.compressor:
+            cpu = time.thread_time()
+            data = os.pread(self.fd, min(BLOCK, self.left), self.offset) if self.left else b''
+            if data:
+                self.offset += len(data)
+                self.left -= len(data)
+                out = self.compressor.compress(data)
+            # end of range (or of a file truncated meanwhile), the client sees a short body
+            else:
+                out = self.compressor.flush()
+                self.compressor = None
+            self.cpu += time.thread_time() - cpu
+            if out:
+                return out
+        return b''
 
 
 ### SOCKET CONNECTION HANDLER
 def handle_client(conn, addr):
     logger.info(f'{"[NEW CONNECTION]":<26}{addr} connected.')
 
-    ## FUNCTION TO SEND MESSAGES ENCODED IN FORMAT TO CLIENT
-    def send(msg):
-        # message pickled into bytes and HEADER added to message
-        msg = pickle.dumps(msg)
-        msg = bytes(f'{len(msg):<{HEADER}}', FORMAT) + msg
-        if len(msg) > PACKET:    
-            for i in range(0, len(msg), PACKET):
-                conn.send(msg[i:i+PACKET])
-            return len(msg)
-        conn.send(msg)
-        return len(msg)
+    ## FUNCTION TO SEND MESSAGES ENCODED WITH THE CODEC TO CLIENT
+    def send(msg, rid=0):
+        return codec.sendMsg(conn, msg, rid)
+
+    ## FUNCTION TO SEND ONE DATA FRAME OF EVERY MULTIPLEXED DOWNLOAD, ROUND ROBIN - RETURNS BYTES SENT
+    def sendQuanta():
+        sent = 0
+        try:
+            for rid, stream in list(streams.items()):
+                head, offset, n = stream.next(SHAPER.quantum)
+                if n:
+                    time.sleep(SHAPER.reserve(ip, n))
+                conn.sendall(head)
+                n = len(head) + (conn.sendfile(stream.file_open, offset, n) if n else 0)
+                stream.sent += n
+                sent += n
+                if stream.done:
+                    del streams[rid]
+                    stream.close(addr)
+        # a broken connection abandons every download in progress
+        except OSError:
+            closeStreams()
+            raise
+        return sent
+
+    ## FUNCTION TO CLOSE MULTIPLEXED DOWNLOADS LEFT IN PROGRESS
+    def closeStreams():
+        for stream in streams.values():
+            stream.close(addr)
+        streams.clear()
+
+    ## FUNCTION TO SEND count BYTES OF AN OPEN FILE FROM offset WITH ZERO COPY sendfile - RETURNS BYTES SENT
+    ## Cached file contents are sent from memory instead. When shaping, the file goes out one reserved quantum at a time.
+    def sendRaw(file_open, offset, count, data=None):
+        if data is not None:
+            data = memoryview(data)
+        if not SHAPER.enabled:
+            if data is not None:
+                conn.sendall(data[offset:offset+count])
+                return count
+            # socket.sendfile uses os.sendfile, file bytes never enter user space
+            return conn.sendfile(file_open, offset, count) if count else 0
+        sent = 0
+        while sent < count:
+            n = min(SHAPER.quantum, count - sent)
+            time.sleep(SHAPER.reserve(ip, n))
+            if data is not None:
+                conn.sendall(data[offset+sent:offset+sent+n])
+            else:
+                n = conn.sendfile(file_open, offset + sent, n)
+            if not n:
+                break
+            sent += n
+        return sent
+
+    ## FUNCTION TO SEND count BYTES OF AN OPEN FILE FROM offset AS THE BODY OF reply - RETURNS (bytes sent, stat text)
+    ## Raw bodies go out with zero copy sendfile (or from the cache), compressed ones as a stream of block messages.
+    ## Only the raw path looks up the cache, a compressed body is always read from disk by CompressedRange.
+    def sendBody(reply, file_name, file_open, st, offset, count):
+        start = time.time()
+        SHAPER.start(ip)
+        sent = 0
+        try:
+            used, cpu = chooseEncoding(file_open, offset, count, encoding, level)
+            if not used:
+                data = cachedFile(file_name, file_open, st, count)
+                head = codec.packHead(reply, count)
+                conn.sendall(head)
+                sent = len(head) + sendRaw(file_open, offset, count, data)
+                stat = codec.compressStat(None, count, count, cpu) if encoding else ''
+            else:
+                reply['encoding'] = used
+                reply['count'] = count
+                head = codec.packHead(reply, 0)
+                conn.sendall(head)
+                stream = CompressedRange(file_open, offset, count, used, level)
+                sent = len(head)
+                piece = stream.next()
+                while piece:
+                    time.sleep(SHAPER.reserve(ip, len(piece)))
+                    sent += send({'main':BLOCK_MESSAGE, 'data':piece})
+                    piece = stream.next()
+                sent += send({'main':BLOCK_MESSAGE})
+                stat = codec.compressStat(used, count, sent, cpu + stream.cpu)
+        finally:
+            logClientRate(ip, SHAPER.finish(ip, sent))
+        return sent, stat + rateStat(sent, time.time() - start)
 
     ## RECORD STATS
     conn_time = time.time()
     conn_download = 0
+    ip = addr[0]
+
+    ## COMPRESSION AGREED WITH THE CLIENT, NONE UNTIL IT ASKS
+    encoding, level = None, 0
+
+    ## MULTIPLEXED DOWNLOADS IN PROGRESS, request id -> MuxStream
+    streams = {}
 
     ## MESSAGE RECEIVER 
     connected = True
     while connected:
+        msg = {'main':''}
+
+        # WHILE MULTIPLEXED DOWNLOADS ARE IN PROGRESS, SEND A ROUND OF DATA FRAMES UNLESS A REQUEST IS WAITING
+        if streams and not select.select([conn], [], [], 0)[0]:
+            conn_download += sendQuanta()
+            continue
+
+        # RECEIVE FRAME HEADER > PREALLOCATE BODY AND PAYLOAD > recv_into AND DECODE FROM A VIEW
+        try:
+            frame = codec.recvFrame(conn)
+        # a frame over the codec limits or one that does not decode, the connection is dropped
+        except ValueError as e:
+            logger.info(f'{"[BAD FRAME]":<26}{addr} -> {e}')
+            frame = None
+        if not frame:
+            msg['main'] = DISCONNECT_MESSAGE
 
-        # RECEIVE MESSAGE HEADER > GET LENGTH OF MESSAGE > SAVE AND DECODE FULL MESSAGE
-        msg_length = conn.recv(HEADER)
-        if msg_length:
-            # Start the process only for a valid header 
-            full_msg = b''
-            new_msg = True
-            # loop to download full message body
-            while True:
-                # receive message packets
-                msg = conn.recv(PACKET)
-                
-                # get length from header
-                if new_msg:
-                    msg_len = int(msg_length)
-                    full_msg = msg_length
-                    new_msg = False
-                
-                full_msg += msg
-
-                # decode and break out of loop if full message is received
-                if len(full_msg)-HEADER == msg_len:
-                    msg = pickle.loads(full_msg[HEADER:])
-                    break
+        if frame:
+            msg, rid, _ = frame
         
-        # CASE FOR DOWNLOAD MESSAGE
-        if msg[:len(FILE_DOWNLOAD_MESSAGE)] == FILE_DOWNLOAD_MESSAGE:
-            # open requested file in binary and read data
-            file_name = join(args.dir, msg[len(FILE_DOWNLOAD_MESSAGE):])
+        # CASE FOR DOWNLOAD MESSAGE - ZERO COPY FROM PAGE CACHE TO SOCKET
+        if msg['main'] == FILE_DOWNLOAD_MESSAGE:
+            file_name = join(args.dir, msg['file_name'])
             up_start = time.time()
-            file_open = open(file_name,'rb')
-            file_data = file_open.read()
-            # md5 HASH the opened file
-            md5 = hashlib.md5(file_data).hexdigest()
-            # send md5 and then opened file data
-            file_size = send(md5)
-            file_size += send(file_data)
-            file_open.close()
+            with open(file_name, 'rb') as file_open:
+                st = os.fstat(file_open.fileno())
+                md5 = DIGESTS.digest(msg['file_name'], st, file_open.fileno())
+                # frame header and md5 go first, then the file is the payload of the same frame
+                file_size, stat = sendBody({'main':RES_DOWNLOAD_MESSAGE, 'md5':md5}, msg['file_name'], file_open, st, 0, st.st_size)
 
             # log stats
             conn_download += file_size
-            logger.info(f'{"[DOWNLOAD FILE]":<26}{addr} -> is downloading {msg[len(FILE_DOWNLOAD_MESSAGE):]}.')
-            logger.info(f'{"[UPLOAD STAT]":<26}{addr} <- sent:{file_size:^12}Bytes in time:{time.time()-up_start:<24}')
-            msg=''
+            recordRequest(msg['main'], file_size, time.time()-up_start, st.st_size)
+            logger.info(f'{"[DOWNLOAD FILE]":<26}{addr} -> is downloading {msg["file_name"]}.')
+            logger.info(f'{"[UPLOAD STAT]":<26}{addr} <- sent:{file_size:^12}Bytes in time:{time.time()-up_start:<24}{stat}')
             
+        # CASE FOR RANGE DOWNLOAD MESSAGE - RESUMABLE, ZERO COPY
+        if msg['main'] == FILE_RANGE_MESSAGE:
+            up_start = time.time()
+            file_name = msg['file_name']
+            with open(join(args.dir, file_name), 'rb') as file_open:
+                st = os.fstat(file_open.fileno())
+                offset, count = parseRange(msg, st.st_size)
+                md5 = DIGESTS.digest(file_name, st, file_open.fileno())
+                reply = {'main':RES_RANGE_MESSAGE, 'offset':offset, 'total':st.st_size, 'md5':md5}
+                file_size, stat = sendBody(reply, file_name, file_open, st, offset, count)
+
+            # log stats
+            conn_download += file_size
+            recordRequest(msg['main'], file_size, time.time()-up_start, count)
+            logger.info(f'{"[DOWNLOAD FILE]":<26}{addr} -> is downloading {file_name} bytes {offset}-{offset+count}.')
+            logger.info(f'{"[UPLOAD STAT]":<26}{addr} <- sent:{file_size:^12}Bytes in time:{time.time()-up_start:<24}{stat}')
+
+        # CASE FOR MULTIPLEXED DOWNLOAD MESSAGE - REPLY NOW, DATA FRAMES GO OUT WITH THE OTHER DOWNLOADS IN PROGRESS
+        if msg['main'] == FILE_MUX_MESSAGE:
+            file_open = open(join(args.dir, msg['file_name']), 'rb')
+            st = os.fstat(file_open.fileno())
+            offset, count = parseRange(msg, st.st_size)
+            md5 = DIGESTS.digest(msg['file_name'], st, file_open.fileno())
+            # a request id still in use ends the download it belonged to, its file and shaper slot are released
+            if rid in streams:
+                streams.pop(rid).close(addr)
+            SHAPER.start(ip)
+            streams[rid] = MuxStream(msg['file_name'], file_open, offset, count, rid)
+            streams[rid].sent = send({'main':RES_MUX_MESSAGE, 'offset':offset, 'total':st.st_size, 'md5':md5, 'count':count}, rid)
+            conn_download += streams[rid].sent
+
+        # CASE FOR COMPRESSION HANDSHAKE - AGREE ON A CODEC FOR THE REST OF THE CONNECTION
+        if msg['main'] == COMPRESS_MESSAGE:
+            encoding, level = codec.negotiate(msg['codecs'], CODECS, msg['level'])
+            recordRequest(msg['main'], send({'main':RES_COMPRESS_MESSAGE, 'codec':encoding, 'level':level}))
+            logger.info(f'{"[COMPRESSION]":<26}{addr} -> codec:{encoding} level:{level}')
+
+        # CASE FOR FILE PAGE MESSAGE - RETURNS ONE PAGE OF FILES WITH METADATA
+        if msg['main'] == FILE_PAGE_MESSAGE:
+            offset, limit = max(0, msg['offset']), max(1, min(msg['limit'], MAX_PAGE))
+            total, files = INDEX.page(offset, limit)
+            file_size = send({'main':RES_FILE_PAGE_MESSAGE, 'total':total, 'files':files})
+            conn_download += file_size
+            recordRequest(msg['main'], file_size)
+            logger.info(f'{"[FETCH FILE PAGE]":<26}{addr} -> files {offset}-{offset+len(files)} of {total}')
+
         # CASE FOR FILE LIST MESSAGE - RETURNS LIST OF FILES
-        if msg == FILE_LIST_MESSAGE:
-            file_size = send(getFileList())
+        if msg['main'] == FILE_LIST_MESSAGE:
+            file_size = send({'main':RES_FILE_LIST_MESSAGE, 'file_list':getFileList()})
             conn_download += file_size
+            recordRequest(msg['main'], file_size)
             logger.info(f'{"[FETCH FILE LIST]":<26}{addr}')
-            msg=''
         
         # CASE FOR DISCONNECT MESSAGE
-        if msg == DISCONNECT_MESSAGE:
+        if msg['main'] == DISCONNECT_MESSAGE:
             connected = False
-            logger.info(f'{"[DISCONNECTED]":<26}{addr} -> Total Download:{conn_download} Bytes | Time Connected:{time.time()-conn_time}')
+            recordRequest(msg['main'], 0)
+            logger.info(f'{"[DISCONNECTED]":<26}{addr} -> Total Download:{conn_download} Bytes | Time Connected:{time.time()-conn_time}{rateStat(conn_download, time.time()-conn_time)}{CACHE.stat() if CACHE.budget else ""}')
+            DIGESTS.save()
     
     ## CLOSE CONNECTION
+    closeStreams()
     conn.close()
 
+### THREAD TARGET - THE ACTIVE CONNECTION GAUGE IS RELEASED EVEN IF handle_client FAILS
+def serveClient(conn, addr):
+    try:
+        handle_client(conn, addr)
+    finally:
+        ACTIVE_CONNECTIONS.dec()
+
+
+### SOCKET CONNECTION HANDLER FOR THE ASYNCIO ENGINE - SAME PROTOCOL AS handle_client, ONE COROUTINE PER CONNECTION
+ACTIVE_ASYNC = 0
+
+async def handle_client_async(reader, writer):
+    global ACTIVE_ASYNC
+    ACTIVE_ASYNC += 1
+    addr = writer.get_extra_info('peername')
+    loop = asyncio.get_running_loop()
+    logger.info(f'{"[NEW CONNECTION]":<26}{addr} connected.')
+    logger.info(f'{"[ACTIVE CONNECTIONS]":<26}{ACTIVE_ASYNC}')
+    CONNECTIONS.inc()
+    ACTIVE_CONNECTIONS.inc()
+
+    ## FUNCTION TO SEND MESSAGES ENCODED WITH THE CODEC TO CLIENT
+    async def send(msg, rid=0):
+        frame = codec.packed(msg, rid)
+        writer.write(frame)
+        await writer.drain()
+        return len(frame)
+
+    ## FUNCTION TO STREAM ONE MULTIPLEXED DOWNLOAD AS DATA FRAMES, ONE TASK PER DOWNLOAD
+    ## The write lock keeps the frames of concurrent downloads whole, it wakes waiters in FIFO order
+    ## so the downloads take turns one quantum at a time.
+    async def sendMux(stream):
+        nonlocal conn_download
+        try:
+            while not stream.done:
+                head, offset, n = stream.next(SHAPER.quantum)
+                if n:
+                    await asyncio.sleep(SHAPER.reserve(ip, n))
+                async with write_lock:
+                    writer.write(head)
+                    await writer.drain()
+                    n = len(head) + (await loop.sendfile(writer.transport, stream.file_open, offset, n) if n else 0)
+                stream.sent += n
+                conn_download += n
+        finally:
+            stream.close(addr)
+            if mux_streams.get(stream.rid) is stream:
+                del mux_streams[stream.rid]
+
+    ## FUNCTION TO SEND count BYTES OF AN OPEN FILE FROM offset WITH ZERO COPY sendfile - RETURNS BYTES SENT
+    ## Cached file contents are sent from memory instead. When shaping, the file goes out one reserved quantum at a time.
+    async def sendRaw(file_open, offset, count, data=None):
+        if data is not None:
+            data = memoryview(data)
+        if not SHAPER.enabled:
+            if data is not None:
+                writer.write(data[offset:offset+count])
+                await writer.drain()
+                return count
+            # loop.sendfile uses os.sendfile on the transport socket when available
+            return await loop.sendfile(writer.transport, file_open, offset, count) if count else 0
+        sent = 0
+        while sent < count:
+            n = min(SHAPER.quantum, count - sent)
+            await asyncio.sleep(SHAPER.reserve(ip, n))
+            if data is not None:
+                writer.write(data[offset+sent:offset+sent+n])
+                await writer.drain()
+            else:
+                n = await loop.sendfile(writer.transport, file_open, offset + sent, n)
+            if not n:
+                break
+            sent += n
+        return sent
+
+    ## FUNCTION TO SEND count BYTES OF AN OPEN FILE FROM offset AS THE BODY OF reply - RETURNS (bytes sent, stat text)
+    ## Sampling, cache reads and compression run in the default executor so the loop keeps serving.
+    async def sendBody(reply, file_name, file_open, st, offset, count):
+        start = time.time()
+        SHAPER.start(ip)
+        sent = 0
+        try:
+            used, cpu = await loop.run_in_executor(None, chooseEncoding, file_open, offset, count, encoding, level)
+            if not used:
+                data = await loop.run_in_executor(None, cachedFile, file_name, file_open, st, count)
+                head = codec.packHead(reply, count)
+                writer.write(head)
+                await writer.drain()
+                sent = len(head) + await sendRaw(file_open, offset, count, data)
+                stat = codec.compressStat(None, count, count, cpu) if encoding else ''
+            else:
+                reply['encoding'] = used
+                reply['count'] = count
+                sent = await send(reply)
+                stream = CompressedRange(file_open, offset, count, used, level)
+                piece = await loop.run_in_executor(None, stream.next)
+                while piece:
+                    await asyncio.sleep(SHAPER.reserve(ip, len(piece)))
+                    sent += await send({'main':BLOCK_MESSAGE, 'data':piece})
+                    piece = await loop.run_in_executor(None, stream.next)
+                sent += await send({'main':BLOCK_MESSAGE})
+                stat = codec.compressStat(used, count, sent, cpu + stream.cpu)
+        finally:
+            logClientRate(ip, SHAPER.finish(ip, sent))
+        return sent, stat + rateStat(sent, time.time() - start)
+
+    ## RECORD STATS
+    conn_time = time.time()
+    conn_download = 0
+    ip = addr[0]
+
+    ## COMPRESSION AGREED WITH THE CLIENT, NONE UNTIL IT ASKS
+    encoding, level = None, 0
+
+    ## MULTIPLEXED DOWNLOADS IN PROGRESS, request id -> MuxStream OF ITS TASK
+    mux_tasks = set()
+    mux_streams = {}
+    write_lock = asyncio.Lock()
+
+    ## MESSAGE RECEIVER
+    try:
+        while True:
+            # RECEIVE MESSAGE HEADER > GET LENGTH OF MESSAGE > SAVE AND DECODE FULL MESSAGE
+            # unpackHeader refuses lengths over MAX_BODY/MAX_PAYLOAD before readexactly buffers them,
+            # the ValueError closes the connection below
+            try:
+                name, rid, body_len, payload_len = codec.unpackHeader(await reader.readexactly(HEADER))
+                body = await reader.readexactly(body_len)
+                msg = codec.decodeBody(name, body, await reader.readexactly(payload_len))
+            except asyncio.IncompleteReadError:
+                break
+
+            # CASE FOR MULTIPLEXED DOWNLOAD MESSAGE - REPLY NOW, A TASK STREAMS THE DATA FRAMES
+            if msg['main'] == FILE_MUX_MESSAGE:
+                f = msg['file_name']
+                file_open = open(join(args.dir, f), 'rb')
+                st = os.fstat(file_open.fileno())
+                offset, count = parseRange(msg, st.st_size)
+                md5 = await loop.run_in_executor(None, DIGESTS.digest, f, st, file_open.fileno())
+                # a request id still in use ends the download it belonged to after its current frame,
+                # its task closes the file and releases the shaper slot
+                if rid in mux_streams:
+                    mux_streams[rid].done = True
+                SHAPER.start(ip)
+                stream = MuxStream(f, file_open, offset, count, rid)
+                mux_streams[rid] = stream
+                async with write_lock:
+                    stream.sent = await send({'main':RES_MUX_MESSAGE, 'offset':offset, 'total':st.st_size, 'md5':md5, 'count':count}, rid)
+                conn_download += stream.sent
+                task = asyncio.ensure_future(sendMux(stream))
+                mux_tasks.add(task)
+                task.add_done_callback(mux_tasks.discard)
+                continue
+
+            # OTHER REPLIES ARE NOT MULTIPLEXED, THEY WAIT FOR THE DOWNLOADS IN PROGRESS
+            if mux_tasks:
+                await asyncio.gather(*mux_tasks)
+
+            # CASE FOR DOWNLOAD MESSAGE - ZERO COPY FROM PAGE CACHE TO SOCKET
+            if msg['main'] == FILE_DOWNLOAD_MESSAGE:
+                f = msg['file_name']
+                up_start = time.time()
+                with open(join(args.dir, f), 'rb') as file_open:
+                    st = os.fstat(file_open.fileno())
+                    # hashing runs in the default executor so the loop keeps serving
+                    md5 = await loop.run_in_executor(None, DIGESTS.digest, f, st, file_open.fileno())
+                    file_size, stat = await sendBody({'main':RES_DOWNLOAD_MESSAGE, 'md5':md5}, f, file_open, st, 0, st.st_size)
+                conn_download += file_size
+                recordRequest(msg['main'], file_size, time.time()-up_start, st.st_size)
+                logger.info(f'{"[DOWNLOAD FILE]":<26}{addr} -> is downloading {f}.')
+                logger.info(f'{"[UPLOAD STAT]":<26}{addr} <- sent:{file_size:^12}Bytes in time:{time.time()-up_start:<24}{stat}')
+
+            # CASE FOR RANGE DOWNLOAD MESSAGE - RESUMABLE, ZERO COPY
+            elif msg['main'] == FILE_RANGE_MESSAGE:
+                up_start = time.time()
+                f = msg['file_name']
+                with open(join(args.dir, f), 'rb') as file_open:
+                    st = os.fstat(file_open.fileno())
+                    offset, count = parseRange(msg, st.st_size)
+                    md5 = await loop.run_in_executor(None, DIGESTS.digest, f, st, file_open.fileno())
+                    reply = {'main':RES_RANGE_MESSAGE, 'offset':offset, 'total':st.st_size, 'md5':md5}
+                    file_size, stat = await sendBody(reply, f, file_open, st, offset, count)
+                conn_download += file_size
+                recordRequest(msg['main'], file_size, time.time()-up_start, count)
+                logger.info(f'{"[DOWNLOAD FILE]":<26}{addr} -> is downloading {f} bytes {offset}-{offset+count}.')
+                logger.info(f'{"[UPLOAD STAT]":<26}{addr} <- sent:{file_size:^12}Bytes in time:{time.time()-up_start:<24}{stat}')
+
+            # CASE FOR COMPRESSION HANDSHAKE - AGREE ON A CODEC FOR THE REST OF THE CONNECTION
+            elif msg['main'] == COMPRESS_MESSAGE:
+                encoding, level = codec.negotiate(msg['codecs'], CODECS, msg['level'])
+                recordRequest(msg['main'], await send({'main':RES_COMPRESS_MESSAGE, 'codec':encoding, 'level':level}))
+                logger.info(f'{"[COMPRESSION]":<26}{addr} -> codec:{encoding} level:{level}')
+
+            # CASE FOR FILE PAGE MESSAGE - RETURNS ONE PAGE OF FILES WITH METADATA
+            elif msg['main'] == FILE_PAGE_MESSAGE:
+                offset, limit = max(0, msg['offset']), max(1, min(msg['limit'], MAX_PAGE))
+                total, files = INDEX.page(offset, limit)
+                file_size = await send({'main':RES_FILE_PAGE_MESSAGE, 'total':total, 'files':files})
+                conn_download += file_size
+                recordRequest(msg['main'], file_size)
+                logger.info(f'{"[FETCH FILE PAGE]":<26}{addr} -> files {offset}-{offset+len(files)} of {total}')
+
+            # CASE FOR FILE LIST MESSAGE - RETURNS LIST OF FILES
+            elif msg['main'] == FILE_LIST_MESSAGE:
+                file_size = await send({'main':RES_FILE_LIST_MESSAGE, 'file_list':getFileList()})
+                conn_download += file_size
+                recordRequest(msg['main'], file_size)
+                logger.info(f'{"[FETCH FILE LIST]":<26}{addr}')
+
+            # CASE FOR DISCONNECT MESSAGE
+            elif msg['main'] == DISCONNECT_MESSAGE:
+                recordRequest(msg['main'], 0)
+                logger.info(f'{"[DISCONNECTED]":<26}{addr} -> Total Download:{conn_download} Bytes | Time Connected:{time.time()-conn_time}{rateStat(conn_download, time.time()-conn_time)}{CACHE.stat() if CACHE.budget else ""}')
+                await loop.run_in_executor(None, DIGESTS.save)
+                break
+
+    except (ConnectionError, OSError, ValueError) as e:
+        logger.info(f'Connection error: {e}')
+
+    ## CLOSE CONNECTION
+    finally:
+        for task in mux_tasks:
+            task.cancel()
+        ACTIVE_ASYNC -= 1
+        ACTIVE_CONNECTIONS.dec()
+        writer.close()
+
 
 ### MAIN SERVER THAT IS LISTENING FOR CONNECTIONS ON BINDED PORT,
 ### ACCEPTS CONNECTIONS AND ASSIGNS A THREAD TO HANDLE CONNECTION.
@@ -150,14 +964,16 @@ def start():
         ## MULTI THREADING CONNECTIONS
         try:
             conn, addr = server.accept()
-            thread = threading.Thread(target=handle_client, args=(conn,addr))
+            CONNECTIONS.inc()
+            ACTIVE_CONNECTIONS.inc()
+            thread = threading.Thread(target=serveClient, args=(conn,addr))
             thread.start()
-            logger.info(f'{"[ACTIVE CONNECTIONS]":<26}{threading.activeCount() - 1}')
+            logger.info(f'{"[ACTIVE CONNECTIONS]":<26}{ACTIVE_CONNECTIONS.get()}')
         
         ## HANDLE KEYBOARD INTERRUPTS
         except KeyboardInterrupt:
             logger.info(f'{"[KEYBOARD INTERRUPT]":<26}Server stopped accepting new connections')
-            logger.info(f'{"[CHECK]":<26}{threading.activeCount() - 1} client thread(s) still active')
+            logger.info(f'{"[CHECK]":<26}{ACTIVE_CONNECTIONS.get()} client thread(s) still active')
             break
 
         ## HANDLE ANY OTHER ERRORS
@@ -165,7 +981,34 @@ def start():
             logger.info(f'Connection error: {e}')
 
 
+### ASYNCIO ENGINE - ONE EVENT LOOP SERVES EVERY CONNECTION, COUNT IS BOUNDED ONLY BY FILE DESCRIPTORS
+async def serveAsync():
+    # raise the open file soft limit to the hard limit, each connection holds one descriptor
+    try:
+        import resource
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+        logger.info(f'{"[FILE DESCRIPTORS]":<26}Limit raised from {soft} to {hard}')
+    except (ImportError, ValueError, OSError):
+        pass
+    async_server = await asyncio.start_server(handle_client_async, sock=server, backlog=socket.SOMAXCONN)
+    logger.info(f'{"[LISTENING]":<26}Server is listening on host:{args.ip} and Port:{args.port} (asyncio)')
+    async with async_server:
+        await async_server.serve_forever()
+
+def startAsync():
+    try:
+        asyncio.run(serveAsync())
+    ## HANDLE KEYBOARD INTERRUPTS
+    except KeyboardInterrupt:
+        logger.info(f'{"[KEYBOARD INTERRUPT]":<26}Server stopped accepting new connections')
+
+
 ### START SERVER ON BINDED PORT
 logger.info(f'{"[STARTING]":<26}Server is starting...')
-start()
+if args.engine == 'asyncio':
+    startAsync()
+else:
+    start()
+DIGESTS.save()
 logger.info('[SERVER SHUTDOWN]')
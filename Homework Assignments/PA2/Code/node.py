@@ -1,12 +1,14 @@
 ### DEFAULT PYTHON 3.8.3 MODULES
 import socket
 import threading
-import pickle
+import codec
 import argparse
 import logging
 import time
 import os
 import hashlib
+import itertools
+import concurrent.futures
 
 ### Code to Pass Arguments to Server Script through Linux Terminal
 parser = argparse.ArgumentParser(description = "This is the Node in the DHT Architecture!")
@@ -37,11 +39,12 @@ file_handler.setFormatter(formatter)
 logger.addHandler(file_handler)
 
 ### CONNECTION PROTOCOL & ADDRESSES
-HEADER = 16                 # Size of header
+HEADER = codec.HEADER_SIZE  # Size of frame header (see codec.py)
 PACKET = 2048               # Size of a packet, multiple packets are sent if message is larger than packet size. 
 FORMAT = 'utf-8'            # Message format
 ADDR = (args.ip, args.port)  # Address socket server will bind to  
 DHT_ADDR = (args.dht_ip, args.dht_port)
+REQUEST_TIMEOUT = 30         # Seconds a request waits for its response
 
 ### DEFAULT MESSAGES
 REQ_FILE_LIST_MESSAGE = "!FILE_LIST"
@@ -54,6 +57,12 @@ UPDATE_MESSAGE = "!UPDATE"
 DEACTIVATE_MESSAGE = "!DEACTIVATE"
 DISCONNECT_MESSAGE = "!DISCONNECT"
 
+### REGISTER MESSAGES WITH THE BINARY FRAMING CODEC, FILE DATA TRAVELS AS RAW PAYLOAD
+for m in (REQ_FILE_LIST_MESSAGE, RES_FILE_LIST_MESSAGE, DOWNLOAD_MESSAGE, DHT_RECORD_MESSAGE,
+          ACTIVATE_MESSAGE, UPDATE_MESSAGE, DEACTIVATE_MESSAGE, DISCONNECT_MESSAGE):
+    codec.register(m)
+codec.register(RES_DOWNLOAD_MESSAGE, payload='file_data')
+
 ### BIND NODE TO PORT
 try:
     server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -77,28 +86,67 @@ class NodeThread(threading.Thread):
         else:
             self.conn = conn
         
-        # HANDLER PARAMETERS
+        # HANDLER PARAMETERS, REQUESTS WAITING FOR A RESPONSE BY REQUEST ID (COMPLETED BY THE RECEIVER)
         self.listen = True
-        self.buffer_file_list = None
-        self.buffer_file_data = None
-        self.buffer_down_size = None
+        self.pending = {}
+        self.rids = itertools.count(1)
+        self.lock = threading.Lock()
+        self.send_lock = threading.Lock()
         logger.info(f'{"[NEW CONNECTION]":<26}{self.addr}')
 
     ##
     ### BASIC FUNCTIONS
     ##
 
-    ## SEND MESSAGE FUNCTION
-    def send(self,msg):
-        # message pickled into bytes and HEADER added to message
-        msg = pickle.dumps(msg)
-        msg = bytes(f'{len(msg):<{HEADER}}', FORMAT) + msg
-        if len(msg) > PACKET:
-            for i in range(0, len(msg), PACKET):
-                self.conn.send(msg[i:i+PACKET])
-            return len(msg)
-        self.conn.send(msg)
-        return len(msg)
+    ## SEND MESSAGE FUNCTION, A RESPONSE CARRIES THE REQUEST ID OF ITS REQUEST
+    def send(self, msg, rid=0):
+        # message encoded into a binary frame, bulk data sent as raw payload after it
+        # requests from several threads share the connection, frames must not interleave
+        with self.send_lock:
+            return codec.sendMsg(self.conn, msg, rid)
+
+    ## SEND A REQUEST UNDER A NEW REQUEST ID - RETURNS (request id, Future) TO wait ON
+    def submit(self, msg):
+        future = concurrent.futures.Future()
+        with self.lock:
+            rid = next(self.rids)
+            self.pending[rid] = future
+        try:
+            self.send(msg, rid)
+        except OSError:
+            with self.lock:
+                self.pending.pop(rid, None)
+            raise
+        return rid, future
+
+    ## WAIT FOR THE RESPONSE TO A REQUEST - RETURNS WHAT THE RECEIVER RESOLVED IT WITH, None ON TIMEOUT OR DISCONNECT
+    def wait(self, rid, future, timeout=REQUEST_TIMEOUT):
+        try:
+            return future.result(timeout)
+        except concurrent.futures.TimeoutError:
+            logger.info(f'{"[REQUEST TIMEOUT]":<26}#{rid} to {self.addr}')
+            return None
+        finally:
+            with self.lock:
+                self.pending.pop(rid, None)
+
+    ## SEND A REQUEST AND WAIT FOR ITS RESPONSE
+    def request(self, msg, timeout=REQUEST_TIMEOUT):
+        return self.wait(*self.submit(msg), timeout)
+
+    ## COMPLETE THE REQUEST WAITING FOR rid (RECEIVER)
+    def resolve(self, rid, value):
+        with self.lock:
+            future = self.pending.pop(rid, None)
+        if future:
+            future.set_result(value)
+
+    ## WAKE EVERY WAITING REQUEST WITH None, THE CONNECTION IS GONE (RECEIVER)
+    def failPending(self):
+        with self.lock:
+            pending, self.pending = self.pending, {}
+        for future in pending.values():
+            future.set_result(None)
 
     ## FUNCTION TO GET FILE LIST FROM LOCAL HOSTED DIRECTORY
     def localFileList(self):
@@ -141,49 +189,43 @@ class NodeThread(threading.Thread):
     
     ## FUNCTION TO GET FILE LIST FROM REMOTE NODE
     def getFileList(self):
-        self.send({'main':REQ_FILE_LIST_MESSAGE})
-        # USE RECEIVER & BUFFER TO RECEIVE
-        while not self.buffer_file_list:
-            time.sleep(.1)
-        return self.buffer_file_list
+        # THE RECEIVER COMPLETES THE REQUEST WITH THE LIST, [] IF THE NODE DID NOT ANSWER
+        return self.request({'main':REQ_FILE_LIST_MESSAGE}) or []
 
     ## FUNCTION TO DOWNLOAD FILES FROM REMOTE NODE
     def download(self, download_list):
         fail_list = []
+        # REQUEST EVERY DOWNLOAD UP FRONT, THE REMOTE NODE STREAMS THE FILES BACK TO BACK
+        try:
+            requests = [(d, self.submit({'main':DOWNLOAD_MESSAGE,'file_name':d})) for d in download_list]
+        except OSError:
+            return list(download_list)
         # ITERATE DOWNLOAD LIST
-        for d in download_list:
-            # REQUEST DOWNLOAD
+        for d, (rid, future) in requests:
+            # RESPONSE RECEIVE, None IF IT TIMED OUT OR THE CONNECTION WAS LOST
             down_file_time = time.time()
-            self.send({'main':DOWNLOAD_MESSAGE,'file_name':d})
-            # RESPONSE RECEIVE
-            while not self.buffer_file_data:
-                time.sleep(.1)
+            res = self.wait(rid, future)
             # PROCEED IF RIGHT RESPONSE
-            if self.buffer_file_data['file_name'] == d:
+            if res and res[0]['file_name'] == d:
+                file_data, down_size = res
                 # GENERATE LOCAL MD5
-                md5_mirror = hashlib.md5(self.buffer_file_data['file_data']).hexdigest()
+                md5_mirror = hashlib.md5(file_data['file_data']).hexdigest()
                 # SAVE IF INTEGRITY CHECK SUCCESSFUL AND REPORT STATS
-                if self.buffer_file_data['md5'] == md5_mirror:
+                if file_data['md5'] == md5_mirror:
                     file_mirror = open(os.path.join(args.dir,d), 'wb')
-                    file_mirror.write(self.buffer_file_data['file_data'])
+                    file_mirror.write(file_data['file_data'])
                     file_mirror.close()
                     down_file_time = time.time()-down_file_time
-                    logger.info(f'{"[DOWNLOAD INFO]":<26}{self.buffer_file_data["file_name"]} downloaded from {self.addr}')
-                    logger.info(f'{"[DOWNLOAD STAT]":<26}{self.buffer_down_size} Bytes <- {self.addr} in {down_file_time} Seconds')
+                    logger.info(f'{"[DOWNLOAD INFO]":<26}{file_data["file_name"]} downloaded from {self.addr}')
+                    logger.info(f'{"[DOWNLOAD STAT]":<26}{down_size} Bytes <- {self.addr} in {down_file_time} Seconds')
                     print(f'\n{d}\nmd5: {md5_mirror}\nIntegrity check pass, downloaded successfully!')
                     print(f'Downloaded in {down_file_time} seconds')
-                    self.buffer_file_data = None
-                    self.buffer_down_size = None
                 # DON'T SAVE IF INTEGRITY CHECK FAILS, TRY AGAIN LATER
                 else:
                     print(f'\n{d}\nFile integrity failures.')
-                    self.buffer_file_data = None
-                    self.buffer_down_size = None
                     fail_list.append(d)
-            # IF WRONG FILE, TERMINATE
+            # IF WRONG FILE OR NO RESPONSE, TERMINATE
             else:
-                self.buffer_file_data = None
-                self.buffer_down_size = None
                 fail_list.append(d)
         # RETURN LIST OF FAILED FILE DOWNLOADS
         return fail_list
@@ -193,29 +235,21 @@ class NodeThread(threading.Thread):
         while self.listen:
             msg = {'main':''}
             
-            # RECEIVE MESSAGE HEADER > GET LENGTH OF MESSAGE > SAVE AND DECODE FULL MESSAGE
-            msg_length = self.conn.recv(HEADER)
-            if msg_length:
-                # Start the process only for a valid header 
-                full_msg = b''
-                new_msg = True
-                # loop to download full message body
-                while True:
-                    # receive message packets
-                    msg = self.conn.recv(PACKET)
-                    
-                    # get length from header
-                    if new_msg:
-                        msg_len = int(msg_length)
-                        full_msg = msg_length
-                        new_msg = False
-                    
-                    full_msg += msg
-
-                    # decode and break out of loop if full message is received
-                    if len(full_msg)-HEADER == msg_len:
-                        msg = pickle.loads(full_msg[HEADER:])
-                        break
+            # RECEIVE FRAME HEADER > PREALLOCATE BODY AND PAYLOAD > recv_into AND DECODE FROM A VIEW
+            try:
+                frame = codec.recvFrame(self.conn)
+            # the socket was closed by disconnect() while this thread was dispatching,
+            # or the frame is over the codec limits or does not decode and the connection is dropped
+            except (OSError, ValueError):
+                frame = None
+            # CONNECTION LOST, WAKE THE WAITING REQUESTS
+            if frame is None:
+                self.listen = False
+                self.conn.close()
+                self.failPending()
+            else:
+                # the payload (if any) is a memoryview attached under its registered key
+                msg, rid, frame_size = frame
                 
                 # RECEIVE & UPDATE LOCAL DHT RECORD
                 if msg['main'] == DHT_RECORD_MESSAGE:
@@ -225,11 +259,11 @@ class NodeThread(threading.Thread):
                 # CASE: REQ FOR FILE LIST, SEND LOCAL FILE LIST 
                 if msg['main'] == REQ_FILE_LIST_MESSAGE:
                     res = {'main':RES_FILE_LIST_MESSAGE, 'file_list':self.localFileList()}
-                    self.send(res)
+                    self.send(res, rid)
                 
-                # CASE: RES FOR A FILE LIST REQUEST, SAVE IN BUFFER
+                # CASE: RES FOR A FILE LIST REQUEST, COMPLETE THE REQUEST
                 if msg['main'] == RES_FILE_LIST_MESSAGE:
-                    self.buffer_file_list = msg['file_list']
+                    self.resolve(rid, msg['file_list'])
                 
                 # CASE: DOWNLOAD REQUEST
                 if msg['main'] == DOWNLOAD_MESSAGE:
@@ -242,22 +276,22 @@ class NodeThread(threading.Thread):
                     md5 = hashlib.md5(file_data).hexdigest()
                     # SEND MD5 AND FILE BINARY DATA
                     res = {'main':RES_DOWNLOAD_MESSAGE, 'file_name':msg['file_name'], 'md5':md5, 'file_data':file_data}
-                    up_size = self.send(res)
+                    up_size = self.send(res, rid)
                     # REPORT THE UPLOAD STATS
                     up_time = time.time()-up_time
                     logger.info(f'{"[UPLOAD INFO]":<26}{msg["file_name"]} sent to {self.addr}')
                     logger.info(f'{"[UPLOAD STAT]":<26}{up_size} Bytes -> {self.addr} in {up_time} Seconds')
 
-                # CASE: RES FOR DOWNLOAD REQUEST, SAVE TO BUFFER
+                # CASE: RES FOR DOWNLOAD REQUEST, COMPLETE THE REQUEST
                 if msg['main'] == RES_DOWNLOAD_MESSAGE:
-                    self.buffer_down_size = len(full_msg)
-                    self.buffer_file_data = msg
+                    self.resolve(rid, (msg, frame_size))
 
                 # CASE: DISCONNECTING REMOTE NODE, RELEASE CONNECTION
                 if msg['main'] == DISCONNECT_MESSAGE:
                     logger.info(f'{"[DISCONNECTED]":<26}{self.addr}')
                     self.listen = False
                     self.conn.close()
+                    self.failPending()
 
 ### KEEP LISTING FOR CONNECTIONS ON BINDED PORT
 def portListener():
@@ -1,7 +1,7 @@
 ### DEFAULT PYTHON 3.8.3 MODULES
 import socket
 import threading
-import pickle
+import codec
 import argparse
 import logging
 import time
@@ -24,7 +24,7 @@ logger.addHandler(file_handler)
 logger.addHandler(stream_handler)
 
 ### CONNECTION PROTOCOL
-HEADER = 16                 # Size of header
+HEADER = codec.HEADER_SIZE  # Size of frame header (see codec.py)
 PACKET = 2048               # Size of a packet, multiple packets are sent if message is larger than packet size. 
 FORMAT = 'utf-8'            # Message format
 ADDR = (args.ip, args.port)  # Address socket server will bind to  
@@ -36,6 +36,11 @@ UPDATE_MESSAGE = "!UPDATE"
 DEACTIVATE_MESSAGE = "!DEACTIVATE"
 DISCONNECT_MESSAGE = "!DISCONNECT"
 
+### REGISTER MESSAGES WITH THE BINARY FRAMING CODEC
+for m in (DHT_RECORD_MESSAGE, ACTIVATE_MESSAGE, UPDATE_MESSAGE, DEACTIVATE_MESSAGE,
+          DISCONNECT_MESSAGE):
+    codec.register(m)
+
 ### BIND SOCKET SERVER TO PORT
 try:
     server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
@@ -70,42 +75,26 @@ def handle_client(conn, addr):
 
     ## FUNCTION TO SEND MESSAGES ENCODED IN FORMAT TO CLIENT
     def send(msg):
-        # message pickled into bytes and HEADER added to message
-        msg = pickle.dumps(msg)
-        msg = bytes(f'{len(msg):<{HEADER}}', FORMAT) + msg
-        if len(msg) > PACKET:    
-            for i in range(0, len(msg), PACKET):
-                conn.send(msg[i:i+PACKET])
-        conn.send(msg)
+        # message encoded into a binary frame
+        codec.sendMsg(conn, msg)
     
     ## MESSAGE RECEIVER 
     connected = True
     while connected:
         msg = {'main':''}
         
-        # RECEIVE MESSAGE HEADER > GET LENGTH OF MESSAGE > SAVE AND DECODE FULL MESSAGE
-        msg_length = conn.recv(HEADER)
-        if msg_length:
-            # Start the process only for a valid header 
-            full_msg = b''
-            new_msg = True
-            # loop to download full message body
-            while True:
-                # receive message packets
-                msg = conn.recv(PACKET)
-                
-                # get length from header
-                if new_msg:
-                    msg_len = int(msg_length)
-                    full_msg = msg_length
-                    new_msg = False
-                
-                full_msg += msg
-
-                # decode and break out of loop if full message is received
-                if len(full_msg)-HEADER == msg_len:
-                    msg = pickle.loads(full_msg[HEADER:])
-                    break
+        # RECEIVE FRAME HEADER > PREALLOCATE BODY AND PAYLOAD > recv_into AND DECODE FROM A VIEW
+        try:
+            frame = codec.recvFrame(conn)
+        # a frame over the codec limits or one that does not decode, or a reset connection, the connection is dropped
+        except (OSError, ValueError) as e:
+            logger.info(f'{"[BAD FRAME]":<26}{addr} -> {e}')
+            frame = None
+        if not frame:
+            msg['main'] = DISCONNECT_MESSAGE
+
+        if frame:
+            msg, _, _ = frame
 
         # CASE FOR ACTIVATE OR UPDATE DHT DATA
         if msg['main'] == ACTIVATE_MESSAGE or msg['main'] == UPDATE_MESSAGE:
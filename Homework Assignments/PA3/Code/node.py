@@ -1,13 +1,15 @@
 ### DEFAULT PYTHON 3.8.3 MODULES
 import socket
 import threading
-import pickle
+import codec
 import argparse
 import logging
 import time
 import os
 import hashlib
 import random
+import itertools
+import concurrent.futures
 
 ### Code to Pass Arguments to Server Script through Linux Terminal
 parser = argparse.ArgumentParser(description = "This is a distributed node in the P2P Architecture!")
@@ -41,7 +43,7 @@ logger.addHandler(file_handler)
 
 
 ### CONNECTION PROTOCOL & ADDRESSES
-HEADER = 16                  # Size of header
+HEADER = codec.HEADER_SIZE   # Size of frame header (see codec.py)
 PACKET = 2048                # Size of a packet, multiple packets are sent if message is larger than packet size. 
 FORMAT = 'utf-8'             # Message format
 ADDR = (args.ip, args.port)  # Address socket server will bind to
@@ -53,6 +55,7 @@ DHT_ADDR = None              # Address of DHT Node
 NODE_LIST = []               # List of Nodes in Network
 dht = {}                     # To save DHT Record (if leader)
 TEST_START = False           # For testing purpose
+REQUEST_TIMEOUT = 30         # Seconds a request waits for its response
 
 ### DEFAULT MESSAGES
 REQ_FILE_LIST_MESSAGE = "!FILE_LIST"
@@ -70,6 +73,13 @@ RES_UPDATE_DHT = "!RES_UPDATE_DHT"
 DEACTIVE_NODE = "!DEACTIVE_NODE"
 TEST_MESSAGE = "!TEST_MESSAGE"
 
+### REGISTER MESSAGES WITH THE BINARY FRAMING CODEC, FILE DATA TRAVELS AS RAW PAYLOAD
+for m in (REQ_FILE_LIST_MESSAGE, RES_FILE_LIST_MESSAGE, REQ_FILE_SRC_MESSAGE, RES_FILE_SRC_MESSAGE,
+          DOWNLOAD_MESSAGE, DISCONNECT_MESSAGE, LEADER_CHECK, RES_LEADER_CHECK, UPDATE_LEADER,
+          UPDATE_DHT, RES_UPDATE_DHT, DEACTIVE_NODE, TEST_MESSAGE):
+    codec.register(m)
+codec.register(RES_DOWNLOAD_MESSAGE, payload='file_data')
+
 ### DISTRIBUTED HASH TABLE (ONLY USED WHEN LEADER)
 class DHT:
     
@@ -136,31 +146,67 @@ class ConnThread(threading.Thread):
             self.conn = conn
             logger.info(f'{"[NEW CONNECTION IN]":<26}{self.addr}')
         
-        # HANDLER PARAMETERS
+        # HANDLER PARAMETERS, REQUESTS WAITING FOR A RESPONSE BY REQUEST ID (COMPLETED BY THE RECEIVER)
         self.listen = True
-        self.buffer_file_list = None
-        self.buffer_file_srcs = None
-        self.buffer_file_data = None
-        self.buffer_down_size = None
-        self.buffer_leader_check = None
-        self.buffer_update_dht_status = None
+        self.pending = {}
+        self.rids = itertools.count(1)
+        self.lock = threading.Lock()
+        self.send_lock = threading.Lock()
         
 
     ##
     ### BASIC FUNCTIONS
     ##
 
-    ## SEND MESSAGE FUNCTION
-    def send(self,msg):
-        # message pickled into bytes and HEADER added to message
-        msg = pickle.dumps(msg)
-        msg = bytes(f'{len(msg):<{HEADER}}', FORMAT) + msg
-        if len(msg) > PACKET:
-            for i in range(0, len(msg), PACKET):
-                self.conn.send(msg[i:i+PACKET])
-            return len(msg)
-        self.conn.send(msg)
-        return len(msg)
+    ## SEND MESSAGE FUNCTION, A RESPONSE CARRIES THE REQUEST ID OF ITS REQUEST
+    def send(self, msg, rid=0):
+        # message encoded into a binary frame, bulk data sent as raw payload after it
+        # requests from several threads share the connection, frames must not interleave
+        with self.send_lock:
+            return codec.sendMsg(self.conn, msg, rid)
+
+    ## SEND A REQUEST UNDER A NEW REQUEST ID - RETURNS (request id, Future) TO wait ON
+    def submit(self, msg):
+        future = concurrent.futures.Future()
+        with self.lock:
+            rid = next(self.rids)
+            self.pending[rid] = future
+        try:
+            self.send(msg, rid)
+        except OSError:
+            with self.lock:
+                self.pending.pop(rid, None)
+            raise
+        return rid, future
+
+    ## WAIT FOR THE RESPONSE TO A REQUEST - RETURNS WHAT THE RECEIVER RESOLVED IT WITH, None ON TIMEOUT OR DISCONNECT
+    def wait(self, rid, future, timeout=REQUEST_TIMEOUT):
+        try:
+            return future.result(timeout)
+        except concurrent.futures.TimeoutError:
+            logger.info(f'{"[REQUEST TIMEOUT]":<26}#{rid} to {self.addr}')
+            return None
+        finally:
+            with self.lock:
+                self.pending.pop(rid, None)
+
+    ## SEND A REQUEST AND WAIT FOR ITS RESPONSE
+    def request(self, msg, timeout=REQUEST_TIMEOUT):
+        return self.wait(*self.submit(msg), timeout)
+
+    ## COMPLETE THE REQUEST WAITING FOR rid (RECEIVER)
+    def resolve(self, rid, value):
+        with self.lock:
+            future = self.pending.pop(rid, None)
+        if future:
+            future.set_result(value)
+
+    ## WAKE EVERY WAITING REQUEST WITH None, THE CONNECTION IS GONE (RECEIVER)
+    def failPending(self):
+        with self.lock:
+            pending, self.pending = self.pending, {}
+        for future in pending.values():
+            future.set_result(None)
 
     ## FUNCTION TO GET FILE LIST FROM LOCAL HOSTED DIRECTORY
     def localFileList(self):
@@ -183,10 +229,7 @@ class ConnThread(threading.Thread):
     def leaderPing(self):
         global ADDR
         msg = {'main':LEADER_CHECK,'addr':ADDR}
-        self.send(msg)
-        while self.buffer_leader_check is None:
-            time.sleep(.1)
-        if self.buffer_leader_check:
+        if self.request(msg):
             global DHT_ADDR
             DHT_ADDR = self.addr
             return True
@@ -202,13 +245,8 @@ class ConnThread(threading.Thread):
     ## FUNCTION TO ADD NODE ON TO DHT 
     def updateDHT(self):
         msg = {'main':UPDATE_DHT, 'addr':ADDR, 'file_list':self.localFileList()}
-        self.send(msg)
         logger.info(f'{"[ADDING NODE TO DHT]":<26}')
-        while not self.buffer_update_dht_status:
-            time.sleep(.1)
-        temp = self.buffer_update_dht_status
-        self.buffer_update_dht_status = None
-        return temp
+        return self.request(msg)
 
     ## FUNCTION TO REMOVE NODE FROM DHT
     def removeFromDHT(self):
@@ -218,23 +256,13 @@ class ConnThread(threading.Thread):
 
     ## FUNCTION TO GET FILE LIST FROM DHT
     def getFileList(self):
-        self.send({'main':REQ_FILE_LIST_MESSAGE})
-        # USE RECEIVER & BUFFER TO RECEIVE
-        while self.buffer_file_list is None:
-            time.sleep(.1)
-        f_list = self.buffer_file_list
-        self.buffer_file_list = None
-        return f_list
+        # THE RECEIVER COMPLETES THE REQUEST WITH THE LIST
+        return self.request({'main':REQ_FILE_LIST_MESSAGE})
 
     ## FUNCTION TO GET NODES THAT CAN PROVIDE THE FILE
     def getFileSources(self, fname):
-        self.send({'main':REQ_FILE_SRC_MESSAGE, 'file_name':fname})
-        # USE RECEIVER & BUFFER TO RECEIVE
-        while self.buffer_file_srcs is None:
-            time.sleep(.1)
-        s_list = self.buffer_file_srcs
-        self.buffer_file_srcs = None
-        return s_list
+        # THE RECEIVER COMPLETES THE REQUEST WITH THE SOURCES
+        return self.request({'main':REQ_FILE_SRC_MESSAGE, 'file_name':fname})
 
     ##
     ### INTER NODE FUNCTIONS
@@ -243,40 +271,31 @@ class ConnThread(threading.Thread):
     ## FUNCTION TO DOWNLOAD FILES FROM REMOTE NODE
     def download(self, d):
         down_file_time = time.time()
-        self.send({'main':DOWNLOAD_MESSAGE,'file_name':d})
-        # RESPONSE RECEIVE
-        while not self.buffer_file_data:
-            time.sleep(.1)
+        # RESPONSE RECEIVE, None IF IT TIMED OUT OR THE CONNECTION WAS LOST
+        res = self.request({'main':DOWNLOAD_MESSAGE,'file_name':d})
         # PROCEED IF RIGHT RESPONSE
-        if self.buffer_file_data['file_name'] == d:
+        if res and res[0]['file_name'] == d:
+            file_data, down_size = res
             # GENERATE LOCAL MD5
-            md5_mirror = hashlib.md5(self.buffer_file_data['file_data']).hexdigest()
+            md5_mirror = hashlib.md5(file_data['file_data']).hexdigest()
             # SAVE IF INTEGRITY CHECK SUCCESSFUL AND REPORT STATS
-            if self.buffer_file_data['md5'] == md5_mirror:
+            if file_data['md5'] == md5_mirror:
                 dir_loc = f'{args.dir}/{args.port}/'
                 file_mirror = open(os.path.join(dir_loc,d), 'wb')
-                file_mirror.write(self.buffer_file_data['file_data'])
+                file_mirror.write(file_data['file_data'])
                 file_mirror.close()
                 down_file_time = time.time()-down_file_time
-                logger.info(f'{"[DOWNLOAD INFO]":<26}{self.buffer_file_data["file_name"]} downloaded from {self.addr}')
-                logger.info(f'{"[DOWNLOAD STAT]":<26}{self.buffer_down_size} Bytes <- {self.addr} in {down_file_time} Seconds')
+                logger.info(f'{"[DOWNLOAD INFO]":<26}{file_data["file_name"]} downloaded from {self.addr}')
+                logger.info(f'{"[DOWNLOAD STAT]":<26}{down_size} Bytes <- {self.addr} in {down_file_time} Seconds')
                 print(f'\n{d}\nmd5: {md5_mirror}\nIntegrity check pass, downloaded successfully!')
                 print(f'Downloaded in {down_file_time} seconds')
-                self.buffer_file_data = None
-                self.buffer_down_size = None
                 return True
             # DON'T SAVE IF INTEGRITY CHECK FAILS, TRY AGAIN LATER
             else:
                 print(f'\n{d}\nFile integrity failures.')
-                self.buffer_file_data = None
-                self.buffer_down_size = None
-                fail_list.append(d)
                 return False
-        # IF WRONG FILE, TERMINATE
+        # IF WRONG FILE OR NO RESPONSE, THE CALLER TRIES ANOTHER SOURCE
         else:
-            self.buffer_file_data = None
-            self.buffer_down_size = None
-            fail_list.append(d)
             return False
 
 
@@ -288,32 +307,19 @@ class ConnThread(threading.Thread):
         while self.listen:
             msg = {'main':''}
             
-            # RECEIVE MESSAGE HEADER > GET LENGTH OF MESSAGE > SAVE AND DECODE FULL MESSAGE
-            msg_length = self.conn.recv(HEADER)
-            if not msg_length:
+            # RECEIVE FRAME HEADER > PREALLOCATE BODY AND PAYLOAD > recv_into AND DECODE FROM A VIEW
+            try:
+                frame = codec.recvFrame(self.conn)
+            # the socket was closed by disconnect() while this thread was dispatching,
+            # or the frame is over the codec limits or does not decode and the connection is dropped
+            except (OSError, ValueError):
+                frame = None
+            if not frame:
                 msg['main'] = DISCONNECT_MESSAGE
             
-            if msg_length:
-                # Start the process only for a valid header 
-                full_msg = b''
-                new_msg = True
-                # loop to download full message body
-                while True:
-                    # receive message packets
-                    msg = self.conn.recv(PACKET)
-                    
-                    # get length from header
-                    if new_msg:
-                        msg_len = int(msg_length)
-                        full_msg = msg_length
-                        new_msg = False
-                    
-                    full_msg += msg
-
-                    # decode and break out of loop if full message is received
-                    if len(full_msg)-HEADER == msg_len:
-                        msg = pickle.loads(full_msg[HEADER:])
-                        break
+            if frame:
+                # the payload (if any) is a memoryview attached under its registered key
+                msg, rid, frame_size = frame
             
             ## UPDATE DHT RECORD
             if msg['main'] == UPDATE_DHT:
@@ -322,13 +328,13 @@ class ConnThread(threading.Thread):
                 # INFORM IF NOT LEADER
                 if not LEADER:
                     res = {'main':RES_UPDATE_DHT, 'status':LEADER}
-                    self.send(res)
+                    self.send(res, rid)
                 # UPDATE DHT AND ACK(IF LEADER)
                 else:
                     global dht
                     dht.update(msg['addr'],msg['file_list'])
                     res = {'main':RES_UPDATE_DHT, 'status':LEADER}
-                    self.send(res)
+                    self.send(res, rid)
                     logger.info(f'{"[DHT UPDATED BY]":<26}{msg["addr"]}')
 
             ## RESPOND TO UPDATE DHT RECORD REQUEST
@@ -336,12 +342,12 @@ class ConnThread(threading.Thread):
                 # SUCCESSFUL UPDATE
                 if msg['status']:
                     logger.info(f'{"[DHT UPDATE DONE]":<26}')
-                    self.buffer_update_dht_status = True
+                    self.resolve(rid, True)
                 
                 # WRONG UPDATE ATTEMPT
                 else:
                     logger.info(f'{"[DHT UPDATE FAILED]":<26}')
-                    self.buffer_update_dht_status = False
+                    self.resolve(rid, False)
 
             ## UPDATE LEADER AT OTHER NODE
             if msg['main'] == UPDATE_LEADER:
@@ -351,6 +357,7 @@ class ConnThread(threading.Thread):
                 while True:
                     try:
                         dht_conn = ConnThread(addr=DHT_ADDR, track=False)
+                        dht_conn.start()
                         f_list = False
                         while not f_list:
                             f_list = dht_conn.updateDHT()
@@ -362,14 +369,14 @@ class ConnThread(threading.Thread):
             # RESPOND TO LEADER CHECK
             if msg['main'] == LEADER_CHECK:
                 res = {'main':RES_LEADER_CHECK, 'leader':LEADER}
-                self.send(res)
+                self.send(res, rid)
                 logger.info(f'{"[LEADER PING]":<26}{msg["addr"]}')
                 if msg['addr'] not in NODE_LIST:
                     updateNodeList()
 
             # HAND RESPONSE FOR LEADER CHECK
             if msg['main'] == RES_LEADER_CHECK:
-                self.buffer_leader_check = msg['leader']
+                self.resolve(rid, msg['leader'])
                 logger.info(f'{"[LEADER PING]":<26}{self.addr}')
 
             # CASE: REQ FOR FILE LIST, SEND DHT FILE LIST
@@ -377,19 +384,19 @@ class ConnThread(threading.Thread):
                 if LEADER:
                     res = {'main':RES_FILE_LIST_MESSAGE, 'status':LEADER, 'file_list':dht.fileList()}
                     logger.info(f'{"[FILE LIST REQ]":<26}')
-                    self.send(res)
+                    self.send(res, rid)
                 else:
                     res = {'main':RES_FILE_LIST_MESSAGE, 'status':LEADER}
                     logger.info(f'{"[WRONG FILE LIST REQ]":<26}')
-                    self.send(res)
+                    self.send(res, rid)
             
-            # CASE: RES FOR A FILE LIST REQUEST, SAVE IN BUFFER & HANDLE FAILURE
+            # CASE: RES FOR A FILE LIST REQUEST, COMPLETE THE REQUEST & HANDLE FAILURE
             if msg['main'] == RES_FILE_LIST_MESSAGE:
                 if msg['status']:
-                    self.buffer_file_list = msg['file_list']
+                    self.resolve(rid, msg['file_list'])
                     logger.info(f'{"[FILE LIST RECEIVED]":<26}')
                 else:
-                    self.buffer_file_list = False
+                    self.resolve(rid, False)
                     logger.info(f'{"[WRONG DHT NODE]":<26}')
 
             # CASE: REQ FOR FILE SOURCES, SEND DHT FILE SOURCES
@@ -397,19 +404,19 @@ class ConnThread(threading.Thread):
                 if LEADER:
                     res = {'main':RES_FILE_SRC_MESSAGE, 'status':LEADER, 'src_list':dht.sourceList(msg['file_name'])}
                     logger.info(f'{"[FILE SOURCES REQ]":<26}')
-                    self.send(res)
+                    self.send(res, rid)
                 else:
                     res = {'main':RES_FILE_SRC_MESSAGE, 'status':LEADER}
                     logger.info(f'{"[WRONG FILE SOURCES REQ]":<26}')
-                    self.send(res)
+                    self.send(res, rid)
             
-            # CASE: RES FOR A FILE LIST REQUEST, SAVE IN BUFFER & HANDLE FAILURE
+            # CASE: RES FOR A FILE LIST REQUEST, COMPLETE THE REQUEST & HANDLE FAILURE
             if msg['main'] == RES_FILE_SRC_MESSAGE:
                 if msg['status']:
-                    self.buffer_file_srcs = msg['src_list']
+                    self.resolve(rid, msg['src_list'])
                     logger.info(f'{"[FILE SOURCES RECEIVED]":<26}')
                 else:
-                    self.buffer_file_srcs = False
+                    self.resolve(rid, False)
                     logger.info(f'{"[WRONG DHT NODE]":<26}')
             
             # REMOVE NODE FROM DHT
@@ -429,16 +436,15 @@ class ConnThread(threading.Thread):
                 md5 = hashlib.md5(file_data).hexdigest()
                 # SEND MD5 AND FILE BINARY DATA
                 res = {'main':RES_DOWNLOAD_MESSAGE, 'file_name':msg['file_name'], 'md5':md5, 'file_data':file_data}
-                up_size = self.send(res)
+                up_size = self.send(res, rid)
                 # REPORT THE UPLOAD STATS
                 up_time = time.time()-up_time
                 logger.info(f'{"[UPLOAD INFO]":<26}{msg["file_name"]} sent to {self.addr}')
                 logger.info(f'{"[UPLOAD STAT]":<26}{up_size} Bytes -> {self.addr} in {up_time} Seconds')
 
-            # CASE: RES FOR DOWNLOAD REQUEST, SAVE TO BUFFER
+            # CASE: RES FOR DOWNLOAD REQUEST, COMPLETE THE REQUEST
             if msg['main'] == RES_DOWNLOAD_MESSAGE:
-                self.buffer_down_size = len(full_msg)
-                self.buffer_file_data = msg
+                self.resolve(rid, (msg, frame_size))
 
             ## MESSAGE TO START THE TEST
             if msg['main'] == TEST_MESSAGE:
@@ -455,6 +461,7 @@ class ConnThread(threading.Thread):
                         findDHT()
                 self.listen = False
                 self.conn.close()
+                self.failPending()
 
 ### SELECT SPECIFIC FILES FROM A LIST OF FILES TO DOWNLOAD
 def selectFileFromList(file_list):
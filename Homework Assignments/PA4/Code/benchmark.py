@@ -0,0 +1,102 @@
+### DEFAULT PYTHON 3.8.3 MODULES
+import socket
+import argparse
+import os
+import sys
+import io
+import contextlib
+import tempfile
+import threading
+import time
+import json
+
+### Code to Pass Arguments to Benchmark Script through Linux Terminal
+parser = argparse.ArgumentParser(description = "Benchmark of the chunk schedules and chunk sizes of the P2P node on loopback peers of different speeds!")
+parser.add_argument('--peers', metavar = 'peers', type = str, nargs = '?', default = '0,0.0005,0.002')
+parser.add_argument('--size', metavar = 'size', type = int, nargs = '?', default = 4194304)
+parser.add_argument('--schedules', metavar = 'schedules', type = str, nargs = '?', default = 'static,dynamic')
+parser.add_argument('--chunk_sizes', metavar = 'chunk_sizes', type = str, nargs = '?', default = '1536,16384,65536,262144,1048576,0')
+parser.add_argument('--repeat', metavar = 'repeat', type = int, nargs = '?', default = 3)
+parser.add_argument('--out', metavar = 'out', type = str, nargs = '?', default = None)
+args = parser.parse_args()
+
+### THE NODE MODULE IS IMPORTED IN PROCESS, EVERY PEER IS A LISTENER SERVING THE SAME HOSTED DIRECTORY
+NODE_DIR = os.path.dirname(os.path.abspath(__file__))
+NODE_PORT = 9000            # Port the imported node believes it runs on, names its hosted directory
+FILE_NAME = 'bench.bin'
+
+### START A LOOPBACK PEER THAT SLEEPS delay SECONDS BEFORE SENDING EACH CHUNK - RETURNS ITS ADDRESS
+def startPeer(node, delay):
+
+    class SlowPeer(node.ConnThread):
+        def send(self, msg, rid=0):
+            if msg['main'] == node.RES_DOWNLOAD_MESSAGE:
+                time.sleep(delay)
+            return node.ConnThread.send(self, msg, rid)
+
+    soc = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    soc.bind(('127.0.0.1', 0))
+    soc.listen()
+
+    def accept():
+        while True:
+            conn, addr = soc.accept()
+            SlowPeer(conn, addr).start()
+
+    threading.Thread(target=accept, daemon=True).start()
+    return soc.getsockname()
+
+### DOWNLOAD THE BENCH FILE FROM ALL PEERS WITH A SCHEDULE AND CHUNK SIZE (0 LETS THE SOURCE PICK) - RETURNS THE BEST TIME OF args.repeat RUNS
+def run(node, peers, schedule, chunk_size):
+    node.args.schedule = schedule
+    node.args.chunk_size = chunk_size
+    best = None
+    for _ in range(args.repeat):
+        start = time.time()
+        # every chunk prints a line, keep the table readable
+        with contextlib.redirect_stdout(io.StringIO()):
+            node.downloadHandler(FILE_NAME, peers)
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+### MAIN
+if __name__ == "__main__":
+    delays = [float(d) for d in args.peers.split(',')]
+    args.out = args.out and os.path.abspath(args.out)
+    with tempfile.TemporaryDirectory() as work_dir:
+        # the node logs to ./logs and hosts from --dir/--port, keep both in the temporary directory
+        os.chdir(work_dir)
+        sys.argv = [os.path.join(NODE_DIR, 'node.py'), '--ip', '127.0.0.1', '--port', str(NODE_PORT), '--dir', work_dir, '--compress', 'none']
+        sys.path.insert(0, NODE_DIR)
+        import node
+        # skip the pause meant for a user reading the static split
+        node.TEST_START = True
+        with open(os.path.join(work_dir, str(NODE_PORT), FILE_NAME), 'wb') as f:
+            f.write(os.urandom(args.size))
+        peers = [startPeer(node, d) for d in delays]
+
+        print(f'Peers with per chunk delay (s): {delays}, file of {args.size} Bytes\n')
+        print(f'{"Schedule":<10}{"Chunk(B)":<16}{"Chunks":<8}{"Best(s)":<12}{"MB/s":<10}{"Speedup":<10}')
+        results = []
+        base = None
+        for chunk_size in [int(c) for c in args.chunk_sizes.split(',')]:
+            # the size a source picks on loopback, where the round trip is too short to matter
+            picked = node.chunkSize(args.size, len(peers), 0, chunk_size)
+            label = str(picked) if chunk_size else f'auto {picked}'
+            for schedule in args.schedules.split(','):
+                best = run(node, peers, schedule, chunk_size)
+                base = base or best
+                chunks = -(-args.size // picked)
+                results.append({'schedule':schedule, 'chunk_size':picked, 'adaptive':not chunk_size, 'chunks':chunks, 'size':args.size,
+                                'peers':delays, 'seconds':round(best, 4), 'throughput_mbps':round(args.size / best / 1e6, 2),
+                                'speedup':round(base / best, 2)})
+                print(f'{schedule:<10}{label:<16}{chunks:<8}{best:<12.3f}{args.size/best/1e6:<10.2f}{base/best:<10.2f}')
+        if args.out:
+            with open(args.out, 'w') as f:
+                json.dump(results, f, indent=2)
+            print(f'\nResults saved to {args.out}')
+        os.chdir(NODE_DIR)
+    # peer listeners and node background threads never end
+    sys.stdout.flush()
+    os._exit(0)
@@ -0,0 +1 @@
+../../PA1/Code/codec.py
\ No newline at end of file
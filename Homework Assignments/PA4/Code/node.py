@@ -1,13 +1,18 @@
 ### DEFAULT PYTHON 3.8.3 MODULES
 import socket
 import threading
-import pickle
+import codec
 import argparse
 import logging
 import time
 import os
 import hashlib
 import math
+import random
+import json
+import collections
+import itertools
+import select
 import concurrent.futures
 
 ### Code to Pass Arguments to Server Script through Linux Terminal
@@ -16,6 +21,11 @@ parser.add_argument('--ip', metavar = 'ip', type = str, nargs = '?', default = s
 parser.add_argument('--port', metavar = 'port', type = int, nargs = '?', default = 9000)
 parser.add_argument('--dir', metavar = 'dir', type = str, nargs = '?', default = './hosted_files')
 parser.add_argument('-t', metavar = 't', type = bool, nargs = '?', default = False)
+parser.add_argument('--compress', metavar = 'compress', type = str, nargs = '?', default = 'zlib')
+parser.add_argument('--level', metavar = 'level', type = int, nargs = '?', default = 1)
+parser.add_argument('--schedule', metavar = 'schedule', type = str, nargs = '?', default = 'dynamic', choices = ['dynamic', 'static'])
+parser.add_argument('--chunk_size', metavar = 'chunk_size', type = int, nargs = '?', default = 0)
+parser.add_argument('--select', metavar = 'select', type = str, nargs = '?', default = 'rarest', choices = ['rarest', 'sequential'])
 args = parser.parse_args()
 
 ### MAKE DIRECTORY TO LOG OUTPUTS TO(IF NOT MADE)
@@ -42,12 +52,29 @@ logger.addHandler(file_handler)
 
 
 ### CONNECTION PROTOCOL & ADDRESSES
-HEADER = 16                  # Size of header
+HEADER = codec.HEADER_SIZE   # Size of frame header (see codec.py)
 PACKET = 2048                # Size of a packet, multiple packets are sent if message is larger than packet size. 
 FORMAT = 'utf-8'             # Message format
 ADDR = (args.ip, args.port)  # Address socket server will bind to
 TOTAL_CONN = 0               # Current connections 
-CHUNK_SIZE = 1536             # Size of file chunks
+CHUNK_MIN = 65536            # Smallest chunk size picked for a file
+CHUNK_MAX = 4194304          # Largest chunk size of a file
+CHUNK_FLOOR = 1024           # Smallest chunk size a downloader may ask for with --chunk_size
+CHUNKS_PER_PEER = 16         # Chunks each source should get, so a faster source can take more of them
+LINK_RATE = 104857600        # Bytes per second assumed of a link, sending a chunk should outlast a round trip
+HANDLE_CACHE = 64            # Open file descriptors kept for serving chunks
+HANDLE_IDLE = 30             # Seconds a descriptor is kept open without serving a chunk
+MANIFEST_SUFFIX = '.manifest'    # Sidecar next to a hosted file with its chunk digests and Merkle root
+MANIFEST_BLOCK = 8388608     # Bytes read from disk at once while building a manifest, in whole chunks
+DOWNLOAD_SUFFIX = '.download.tmp'    # A file being downloaded, renamed to its name once every chunk is in
+SOURCE_FAILURES = 3          # Consecutive failed chunks after which a source is dropped from a download
+PACE_WEIGHT = 0.2            # Weight of the latest chunk time in the smoothed pace of a source
+BITMAP_REFRESH = 0.5         # Seconds between chunk bitmap queries to a source that is still downloading the file
+ENDGAME_CHUNKS = 8           # Chunks left of a download at which idle sources also request the ones in flight elsewhere
+DHT_REFRESH_CHUNKS = 64      # Chunks written between publishing a download in progress to the DHT again
+REQUEST_TIMEOUT = 30         # Seconds a request waits for its response
+READ_AHEAD = 32              # Frames read past a chunk request to see if it was cancelled
+CODECS = [c for c in args.compress.split(',') if c in codec.COMPRESSORS]    # Codecs offered and accepted
 LEADER = False               # Leader Status
 LEADER_TIME = None           # Record leader time
 DHT_ADDR = None              # Address of DHT Node
@@ -58,6 +85,7 @@ TEST_START = False           # For testing purpose
 LAST_CHECK = 0               # For DHT TIMELY CHECKS
 TOTAL_UP = 0                 # For Bandwidth Test
 TOTAL_DOWN = 0               # For Bandwidth test
+UP_CHUNKS = 0                # Chunks served, for the swarm test
 
 ### DEFAULT MESSAGES
 REQ_FILE_LIST_MESSAGE = "!FILE_LIST"
@@ -74,10 +102,22 @@ UPDATE_DHT = "!UPDATE_DHT"
 RES_UPDATE_DHT = "!RES_UPDATE_DHT"
 DEACTIVE_NODE = "!DEACTIVE_NODE"
 TEST_MESSAGE = "!TEST_MESSAGE"
-REQ_META_DATA = "!REQ_META_DATA"
-RES_META_DATA = "!RES_META_DATA"
+REQ_META_DATA = "!REQ_META_DATA"             # {'file_name', 'peers', 'rtt', 'chunk_size'}, chunk_size 0 lets the source pick
+RES_META_DATA = "!RES_META_DATA"             # {'fname', 'fsize', 'chunk_size', 'chunks', 'root'}, chunk md5 digests follow as raw payload
 REQ_CHK_FILE = "!REQ_CHK_FILE"
-RES_CHK_FILE = "!RES_CHK_FILE"
+RES_CHK_FILE = "!RES_CHK_FILE"               # {'status', 'file_name'}, with 'chunk_size' and 'bitmap' if the file is still downloading
+COMPRESS_MESSAGE = "!COMPRESS"              # {'codecs', 'level'}, codecs in order of preference
+RES_COMPRESS_MESSAGE = "!RES_COMPRESS"      # {'codec', 'level'}, codec is None if none agreed
+CANCEL_MESSAGE = "!CANCEL"                  # {'rids'}, requests the sender does not wait for any more
+
+### REGISTER MESSAGES WITH THE BINARY FRAMING CODEC, FILE DATA TRAVELS AS RAW PAYLOAD
+for m in (REQ_FILE_LIST_MESSAGE, RES_FILE_LIST_MESSAGE, REQ_FILE_SRC_MESSAGE, RES_FILE_SRC_MESSAGE,
+          DOWNLOAD_MESSAGE, DISCONNECT_MESSAGE, LEADER_CHECK, RES_LEADER_CHECK, UPDATE_LEADER,
+          UPDATE_DHT, RES_UPDATE_DHT, DEACTIVE_NODE, TEST_MESSAGE, REQ_META_DATA,
+          REQ_CHK_FILE, RES_CHK_FILE, COMPRESS_MESSAGE, RES_COMPRESS_MESSAGE, CANCEL_MESSAGE):
+    codec.register(m)
+codec.register(RES_DOWNLOAD_MESSAGE, payload='chunk_data')
+codec.register(RES_META_DATA, payload='digests')
 
 ### DISTRIBUTED HASH TABLE (ONLY USED WHEN LEADER)
 class DHT:
@@ -88,11 +128,12 @@ class DHT:
         self.data_second = {}
     
     ## RETURN SOURCES FOR A FILE AND UPDATE MAYBE LIST OF POSSIBLE FILE SOURCES
+    ## Maybe sources are nodes that asked for the file or are downloading it, they share the chunks they have so far.
     def sourceList(self, addr, file_name):
         self.sec = None
         if addr not in self.data[file_name]:
             if file_name in self.data_second.keys():
-                self.sec = self.data_second[file_name]
+                self.sec = [a for a in self.data_second[file_name] if a != addr]
                 if addr not in self.data_second[file_name]:
                     self.data_second[file_name].append(addr)
             else:
@@ -107,8 +148,15 @@ class DHT:
             file_list.append(key)
         return file_list
 
-    ## UPDATE A NODE IN DHT RECORD
-    def update(self, addr, file_list):
+    ## UPDATE A NODE IN DHT RECORD, FILES IT IS STILL DOWNLOADING MAKE IT A MAYBE SOURCE
+    ## A node is no maybe source any more of a file it stopped downloading, e.g. after a failed download.
+    def update(self, addr, file_list, partial_list=()):
+        for f in self.data_second:
+            if f not in partial_list and addr in self.data_second[f]:
+                self.data_second[f].remove(addr)
+        for f in partial_list:
+            if addr not in self.data_second.setdefault(f, []):
+                self.data_second[f].append(addr)
         for f in file_list:
             if f in self.data.keys(): 
                 if addr not in self.data[f]:
@@ -131,6 +179,454 @@ class DHT:
         for f in chk:
             if not self.data[f]:
                 self.data.pop(f)
+        for f in self.data_second:
+            if addr in self.data_second[f]:
+                self.data_second[f].remove(addr)
+
+### BOUNDED CACHE OF OPEN FILE DESCRIPTORS FOR SERVING CHUNKS, SHARED BY ALL CONNECTIONS
+### A chunk is read with os.pread at its offset, so serving chunk N costs O(chunk size) and not a
+### read of the whole file. A descriptor is reopened when the file changes (inode, size or mtime),
+### closed after HANDLE_IDLE seconds without use, and the least recently used one is closed when
+### more than HANDLE_CACHE files are open. A descriptor is never closed while a read is using it.
+class FileHandles:
+
+    def __init__(self, size, idle):
+        self.size = size
+        self.idle = idle
+        self.handles = {}       # path -> {'fd', 'key', 'used', 'users'}
+        self.lock = threading.Lock()
+
+    ## CHECK OUT A VALID HANDLE FOR path, OPENING (OR REOPENING) IT IF NEEDED
+    def acquire(self, path):
+        st = os.stat(path)
+        key = (st.st_ino, st.st_size, st.st_mtime_ns)
+        with self.lock:
+            h = self.handles.get(path)
+            if h and h['key'] != key:
+                self.drop(path)
+                h = None
+            if h is None:
+                # checked out before trim, so the new handle is never the one closed
+                h = {'fd':os.open(path, os.O_RDONLY), 'key':key, 'used':time.time(), 'users':1}
+                self.handles[path] = h
+                self.trim()
+            else:
+                h['users'] += 1
+                h['used'] = time.time()
+        return h
+
+    ## GIVE A HANDLE BACK, CLOSE IT IF IT WAS DROPPED WHILE IN USE, OR TRIM IF THE CACHE GREW PAST ITS LIMIT MEANWHILE
+    def release(self, path, h):
+        with self.lock:
+            h['users'] -= 1
+            if h['users']:
+                return
+            if self.handles.get(path) is not h:
+                os.close(h['fd'])
+            else:
+                self.trim()
+
+    ## REMOVE A HANDLE FROM THE CACHE (LOCK HELD), ITS LAST USER CLOSES IT
+    def drop(self, path):
+        h = self.handles.pop(path)
+        if not h['users']:
+            os.close(h['fd'])
+
+    ## CLOSE LEAST RECENTLY USED HANDLES OVER THE LIMIT (LOCK HELD), HANDLES IN USE STAY UNTIL THEY ARE RELEASED
+    def trim(self):
+        while len(self.handles) > self.size:
+            idle = [p for p, h in self.handles.items() if not h['users']]
+            if not idle:
+                return
+            self.drop(min(idle, key=lambda p: self.handles[p]['used']))
+
+    ## READ n BYTES OF path FROM offset
+    def read(self, path, offset, n):
+        h = self.acquire(path)
+        try:
+            return os.pread(h['fd'], n, offset)
+        finally:
+            self.release(path, h)
+
+    ## BACKGROUND LOOP CLOSING IDLE HANDLES
+    def watch(self):
+        while True:
+            time.sleep(self.idle)
+            with self.lock:
+                for path in [p for p, h in self.handles.items() if time.time() - h['used'] > self.idle]:
+                    self.drop(path)
+
+HANDLES = FileHandles(HANDLE_CACHE, HANDLE_IDLE)
+threading.Thread(target=HANDLES.watch, daemon=True).start()
+
+### MERKLE ROOT OF CONCATENATED 16 BYTE CHUNK DIGESTS - PAIRS ARE HASHED LEVEL BY LEVEL, AN ODD ONE IS CARRIED UP
+def merkleRoot(digests):
+    level = [digests[i:i+16] for i in range(0, len(digests), 16)] or [hashlib.md5(b'').digest()]
+    while len(level) > 1:
+        level = [hashlib.md5(b''.join(level[i:i+2])).digest() if i+1 < len(level) else level[i] for i in range(0, len(level), 2)]
+    return level[0].hex()
+
+### MD5 DIGESTS OF EVERY CHUNK OF A BUFFER, CONCATENATED
+def chunkDigests(data, chunk_size):
+    return b''.join(hashlib.md5(data[i:i+chunk_size]).digest() for i in range(0, len(data), chunk_size))
+
+### CHUNK SIZE OF A FILE DOWNLOADED FROM peers SOURCES WITH A ROUND TRIP OF rtt SECONDS - A POWER OF TWO
+### Small enough that every source gets CHUNKS_PER_PEER chunks, big enough that sending one takes longer than
+### a round trip, between CHUNK_MIN and CHUNK_MAX. A size the downloader asked for is taken if it is in bounds.
+def chunkSize(fsize, peers, rtt, asked=0):
+    if CHUNK_FLOOR <= asked <= CHUNK_MAX:
+        return asked
+    size = max(fsize // (max(peers, 1) * CHUNKS_PER_PEER), int(rtt * LINK_RATE), CHUNK_MIN)
+    return min(1 << (size - 1).bit_length(), CHUNK_MAX)
+
+
+### CHUNK MANIFESTS OF HOSTED FILES - CHUNK DIGESTS AND MERKLE ROOT, BUILT ONCE PER FILE VERSION AND CHUNK SIZE
+### A manifest is valid only while (inode, size, mtime_ns) of its file are unchanged. It is kept in
+### memory and persisted to a sidecar next to the file, so chunks are never hashed when served.
+class ManifestIndex:
+
+    def __init__(self):
+        self.data = {}          # (path, chunk size) -> {'key', 'digests', 'root'}
+        self.lock = threading.Lock()
+
+    ## RETURN THE MANIFEST OF A FILE FOR A CHUNK SIZE, LOAD OR BUILD IT IF NEW OR CHANGED
+    def manifest(self, path, chunk_size):
+        st = os.stat(path)
+        key = [st.st_ino, st.st_size, st.st_mtime_ns]
+        with self.lock:
+            m = self.data.get((path, chunk_size))
+        if m and m['key'] == key:
+            return m
+        m = self.load(path, key, chunk_size)
+        if m is None:
+            m = self.build(path, key, chunk_size)
+        with self.lock:
+            self.data[(path, chunk_size)] = m
+        return m
+
+    ## MANIFESTS OF A SIDECAR BY CHUNK SIZE, EMPTY IF MISSING OR STALE
+    def sidecar(self, path, key):
+        try:
+            with open(path + MANIFEST_SUFFIX, 'r') as sidecar:
+                saved = json.load(sidecar)
+        except (OSError, ValueError):
+            return {}
+        if saved.get('key') != key:
+            return {}
+        return saved.get('manifests', {})
+
+    ## READ A MANIFEST FROM THE SIDECAR, None IF IT HAS NONE FOR THIS VERSION AND CHUNK SIZE
+    def load(self, path, key, chunk_size):
+        saved = self.sidecar(path, key).get(str(chunk_size))
+        if saved is None:
+            return None
+        return {'key':key, 'digests':bytes.fromhex(saved['digests']), 'root':saved['root']}
+
+    ## HASH A FILE CHUNK BY CHUNK, ABOUT MANIFEST_BLOCK BYTES READ AT ONCE
+    def build(self, path, key, chunk_size):
+        digests = []
+        block_size = max(MANIFEST_BLOCK // chunk_size, 1) * chunk_size
+        with open(path, 'rb') as file_open:
+            for block in iter(lambda: file_open.read(block_size), b''):
+                digests.append(chunkDigests(block, chunk_size))
+        logger.info(f'{"[MANIFEST BUILT]":<26}{path} chunk size:{chunk_size}')
+        return self.save(path, key, chunk_size, b''.join(digests))
+
+    ## STORE THE MANIFEST OF A FILE WHOSE CHUNK DIGESTS ARE ALREADY KNOWN (e.g. A VERIFIED DOWNLOAD)
+    def store(self, path, chunk_size, digests):
+        st = os.stat(path)
+        m = self.save(path, [st.st_ino, st.st_size, st.st_mtime_ns], chunk_size, digests)
+        with self.lock:
+            self.data[(path, chunk_size)] = m
+        return m
+
+    ## ADD A MANIFEST TO THE SIDECAR, WRITTEN TO A TEMP FILE AND RENAMED INTO PLACE
+    def save(self, path, key, chunk_size, digests):
+        m = {'key':key, 'digests':digests, 'root':merkleRoot(digests)}
+        tmp = f'{path}{MANIFEST_SUFFIX}.{threading.get_ident()}.tmp'
+        try:
+            manifests = self.sidecar(path, key)
+            manifests[str(chunk_size)] = {'digests':digests.hex(), 'root':m['root']}
+            with open(tmp, 'w') as sidecar:
+                json.dump({'key':key, 'manifests':manifests}, sidecar)
+            os.replace(tmp, path + MANIFEST_SUFFIX)
+        except OSError as e:
+            logger.info(f'{"[MANIFEST]":<26}Failed to save {path}{MANIFEST_SUFFIX}, because {e}')
+        return m
+
+MANIFESTS = ManifestIndex()
+
+### TRUE IF CHUNK cnumber IS SET IN A CHUNK BITMAP
+def bitmapHas(bitmap, cnumber):
+    return bool(bitmap[cnumber >> 3] & (1 << (cnumber & 7)))
+
+### CHUNKS OF chunk_size BYTES OF A FILE OF size BYTES COVERED BY THE CHUNKS OF held_size BYTES SET IN bitmap
+### A holder may have picked another chunk size, a chunk is held only if every chunk of the holder under it is.
+def heldChunks(bitmap, held_size, size, chunk_size):
+    held = set()
+    for cnumber in range(-(-size // chunk_size)):
+        first = cnumber * chunk_size // held_size
+        last = (min((cnumber + 1) * chunk_size, size) - 1) // held_size
+        if all(bitmapHas(bitmap, h) for h in range(first, last + 1)):
+            held.add(cnumber)
+    return held
+
+### PREALLOCATED TARGET FILE OF ONE DOWNLOAD - A VERIFIED CHUNK IS WRITTEN AT ITS OFFSET AS SOON AS IT ARRIVES
+### The file is sized up front and filled with os.pwrite, so memory use does not grow with the file. A bitmap
+### records the chunks written. The file is renamed to its name only when every chunk is in. Until then the
+### chunks written are served to other downloaders of the file, with the manifest this download verifies against.
+class ChunkFile:
+
+    def __init__(self, path, size, chunk_size, digests, root):
+        self.path = path
+        self.tmp = path + DOWNLOAD_SUFFIX
+        self.size = size
+        self.chunk_size = chunk_size
+        self.chunks = -(-size // chunk_size)
+        self.digests = digests
+        self.root = root
+        self.bitmap = bytearray((self.chunks + 7) // 8)
+        self.count = 0
+        self.committed = False
+        self.lock = threading.Lock()
+        self.fd = os.open(self.tmp, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+        # reserve the blocks now if the platform can, a sparse file of the right size otherwise
+        try:
+            if size:
+                os.posix_fallocate(self.fd, 0, size)
+        except (AttributeError, OSError):
+            os.ftruncate(self.fd, size)
+
+    ## WRITE A VERIFIED CHUNK AT ITS OFFSET AND MARK IT IN THE BITMAP
+    def write(self, cnumber, data):
+        view = memoryview(data)
+        offset = cnumber * self.chunk_size
+        while view:
+            n = os.pwrite(self.fd, view, offset)
+            view = view[n:]
+            offset += n
+        with self.lock:
+            if not self.has(cnumber):
+                self.bitmap[cnumber >> 3] |= 1 << (cnumber & 7)
+                self.count += 1
+
+    def has(self, cnumber):
+        return bitmapHas(self.bitmap, cnumber)
+
+    def complete(self):
+        return self.count == self.chunks
+
+    ## COPY OF THE BITMAP FOR A CHUNK AVAILABILITY QUERY
+    def snapshot(self):
+        with self.lock:
+            return bytes(self.bitmap)
+
+    ## READ n BYTES AT offset FOR ANOTHER DOWNLOADER, None UNLESS EVERY CHUNK UNDER THEM IS WRITTEN
+    def read(self, offset, n):
+        n = min(n, self.size - offset)
+        with self.lock:
+            if not self.committed:
+                if self.fd is None or n <= 0:
+                    return None
+                if not all(self.has(c) for c in range(offset // self.chunk_size, (offset + n - 1) // self.chunk_size + 1)):
+                    return None
+                return os.pread(self.fd, n, offset)
+        # renamed into place meanwhile, it is a hosted file now
+        return HANDLES.read(self.path, offset, n)
+
+    ## RENAME THE COMPLETE FILE TO ITS NAME
+    def commit(self):
+        with self.lock:
+            os.close(self.fd)
+            os.replace(self.tmp, self.path)
+            self.fd = None
+            self.committed = True
+
+    ## THROW AWAY AN INCOMPLETE DOWNLOAD
+    def discard(self):
+        with self.lock:
+            os.close(self.fd)
+            self.fd = None
+        try:
+            os.remove(self.tmp)
+        except OSError:
+            pass
+
+PARTIALS = {}               # file name -> ChunkFile of a download in progress, its chunks are served to other downloaders
+
+### SHARED CHUNK WORK QUEUE OF ONE DOWNLOAD - A WORKER PER SOURCE PULLS THE NEXT CHUNK AS SOON AS IT FINISHES ONE
+### Faster sources take more chunks and a failed chunk goes back to the queue. Near the end a slow source
+### leaves the remaining chunks to the fastest one when that one would finish them all sooner. With --select
+### rarest a source gets the queued chunk fewest sources still downloading the file have, ties broken at
+### random, so a swarm of downloaders holds different chunks to trade instead of all the same early ones.
+### Without such sources rarity tells the chunks apart in no way and they are taken in file order.
+### The static schedule gives every source a fixed window instead, a source that stops leaves the rest of
+### its window to the queue. With ENDGAME_CHUNKS or fewer chunks left, an idle source takes chunks still
+### waiting in another window and then requests the ones in flight at other sources as well. The first
+### verified copy wins and the duplicate requests are cancelled. A source with nothing to do waits on the
+### ready condition, every chunk done, failed or given back wakes the waiting sources.
+class ChunkScheduler:
+
+    def __init__(self, target, windows=None):
+        self.target = target
+        self.chunks = target.chunks
+        self.windows = {s: collections.deque(w) for s, w in windows.items()} if windows else {}
+        self.queue = collections.deque() if windows else collections.deque(range(self.chunks))
+        self.inflight = {}      # chunk number -> {source: (connection, request id)} of the requests for it
+        self.pace = {}          # source -> smoothed seconds per chunk
+        self.have = {}          # source still downloading the file -> chunk numbers it can serve
+        self.rarity = collections.Counter()     # chunk number -> sources still downloading the file that have it
+        self.counts = collections.Counter()
+        self.lock = threading.Lock()
+        self.ready = threading.Condition(self.lock)
+
+    ## NEXT CHUNK NUMBER FOR src, None IF THERE IS NOTHING FOR IT TO DO AFTER WAITING UP TO wait SECONDS FOR A CHANGE
+    def next(self, src, wait=0):
+        with self.lock:
+            cnumber = self.take(src)
+            if cnumber is None and wait and not self.target.complete():
+                self.ready.wait(wait)
+                cnumber = self.take(src)
+            if cnumber is not None:
+                self.inflight.setdefault(cnumber, {})[src] = None
+            return cnumber
+
+    ## NEXT CHUNK FOR src FROM ITS WINDOW, THE SHARED QUEUE OR THE END GAME (LOCK HELD)
+    def take(self, src):
+        window = self.windows.get(src)
+        cnumber = window.popleft() if window else self.fromQueue(src)
+        return self.endgame(src) if cnumber is None else cnumber
+
+    ## NEXT CHUNK FOR src FROM THE SHARED QUEUE (LOCK HELD)
+    def fromQueue(self, src):
+        if not self.queue:
+            return None
+        mine = self.pace.get(src)
+        # only a source that has one of the queued chunks can take them over
+        fastest = min((p for s, p in self.pace.items() if s not in self.have or not self.have[s].isdisjoint(self.queue)), default=None)
+        if mine and fastest and fastest * (len(self.queue) + 1) < mine:
+            return None
+        # every chunk is as rare as the others while no source is still downloading the file, keep file order
+        if args.select == 'sequential' or not self.have:
+            return self.pick(src, lambda held: held[0])
+        return self.pick(src, self.rarest)
+
+    ## TAKE THE CHUNK choose PICKS FROM THE QUEUED CHUNKS src HAS (IN QUEUE ORDER), None IF IT HAS NONE
+    def pick(self, src, choose):
+        have = self.have.get(src)
+        held = self.queue if have is None else [c for c in self.queue if c in have]
+        if not held:
+            return None
+        cnumber = choose(held)
+        self.queue.remove(cnumber)
+        return cnumber
+
+    ## ONE OF THE CHUNKS HELD BY THE FEWEST SOURCES, AT RANDOM
+    def rarest(self, held):
+        fewest = min(self.rarity[c] for c in held)
+        return random.choice([c for c in held if self.rarity[c] == fewest])
+
+    ## END GAME CHUNK FOR src, None IF MORE THAN ENDGAME_CHUNKS ARE LEFT OR NONE IT HAS IS LEFT (LOCK HELD)
+    def endgame(self, src):
+        if len(self.queue) + len(self.inflight) + sum(len(w) for w in self.windows.values()) > ENDGAME_CHUNKS:
+            return None
+        have = self.have.get(src)
+        # a chunk nobody requested yet first, it is only waiting for a slower source
+        for window in self.windows.values():
+            for cnumber in window:
+                if have is None or cnumber in have:
+                    window.remove(cnumber)
+                    return cnumber
+        # then the chunk in flight at the fewest other sources
+        held = [c for c, requests in self.inflight.items() if src not in requests and (have is None or c in have)]
+        if not held:
+            return None
+        fewest = min(len(self.inflight[c]) for c in held)
+        cnumber = random.choice([c for c in held if len(self.inflight[c]) == fewest])
+        logger.info(f'{"[END GAME]":<26}{self.target.path}#{cnumber} also requested from {src}')
+        return cnumber
+
+    ## src SENT ITS REQUEST FOR cnumber ON conn AS rid, SO IT CAN BE CANCELLED WHEN ANOTHER COPY WINS
+    def track(self, src, cnumber, conn, rid):
+        with self.lock:
+            requests = self.inflight.get(cnumber)
+            if requests is not None and src in requests:
+                requests[src] = (conn, rid)
+                return
+        # the chunk came in meanwhile
+        conn.cancel(rid)
+
+    ## WHAT src CAN SERVE, AS checkChunks ANSWERED - True FOR THE WHOLE FILE, (chunk size, bitmap) OF ITS DOWNLOAD
+    ## OR False FOR A MAYBE SOURCE THAT HAS NOTHING YET
+    def offer(self, src, have):
+        with self.lock:
+            self.rarity.subtract(self.have.pop(src, ()))
+            if have is True:
+                return
+            held = heldChunks(have[1], have[0], self.target.size, self.target.chunk_size) if have else set()
+            self.have[src] = held
+            self.rarity.update(held)
+            self.ready.notify_all()
+
+    ## TRUE IF src IS STILL DOWNLOADING THE FILE ITSELF
+    def partial(self, src):
+        with self.lock:
+            return src in self.have
+
+    ## A VERIFIED CHUNK ARRIVED FROM src IN seconds, THE FIRST COPY GOES STRAIGHT TO THE TARGET FILE - RETURNS True IF IT WAS THE FIRST
+    def done(self, src, cnumber, data, seconds):
+        with self.lock:
+            # the request of the first copy in takes the others with it
+            requests = self.inflight.pop(cnumber, None)
+            won = requests is not None
+            requests = requests or {}
+            requests.pop(src, None)
+            pace = self.pace.get(src)
+            self.pace[src] = seconds if pace is None else (1 - PACE_WEIGHT) * pace + PACE_WEIGHT * seconds
+            if won:
+                self.counts[src] += 1
+        if won:
+            self.target.write(cnumber, data)
+        with self.lock:
+            self.ready.notify_all()
+        # the duplicate requests of the end game are not needed any more
+        for request in requests.values():
+            if request:
+                request[0].cancel(request[1])
+        return won
+
+    ## A CHUNK FAILED AT src, SOMEONE TRIES IT AGAIN FIRST - RETURNS False IF IT WAS A DUPLICATE NOT NEEDED ANY MORE
+    def failed(self, src, cnumber):
+        with self.lock:
+            # a source still downloading may have lost it, do not give it back to that source
+            if cnumber in self.have.get(src, ()):
+                self.have[src].discard(cnumber)
+                self.rarity[cnumber] -= 1
+            # another copy came in and cancelled this request
+            requests = self.inflight.get(cnumber)
+            if requests is None:
+                return False
+            requests.pop(src, None)
+            # still in flight at another source in the end game
+            if requests:
+                return True
+            self.inflight.pop(cnumber, None)
+            # the static schedule retries at the same source, its window goes to the others if it stops
+            window = self.windows.get(src)
+            (window if window is not None else self.queue).appendleft(cnumber)
+            self.ready.notify_all()
+            return True
+
+    ## src STOPPED WORKING, ITS PACE NO LONGER HOLDS BACK SLOWER SOURCES AND ITS CHUNKS NO LONGER COUNT
+    def retire(self, src):
+        with self.lock:
+            self.pace.pop(src, None)
+            self.rarity.subtract(self.have.pop(src, ()))
+            self.queue.extend(self.windows.pop(src, ()))
+            self.ready.notify_all()
+
+    def finished(self):
+        return self.target.complete()
 
 ### CONNECTION HANDLER THREAD
 class ConnThread(threading.Thread):
@@ -158,46 +654,130 @@ class ConnThread(threading.Thread):
             self.conn = conn
             logger.info(f'{"[NEW CONNECTION IN]":<26}{self.addr}')
         
-        # HANDLER BUFFER PARAMETERS
+        # HANDLER PARAMETERS, REQUESTS WAITING FOR A RESPONSE BY REQUEST ID (COMPLETED BY THE RECEIVER)
         self.listen = True
-        self.buffer_file_list = None
-        self.buffer_file_srcs = None
-        self.buffer_file_data = None
-        self.buffer_down_size = None
-        self.buffer_meta_data = None
-        self.buffer_check_file = None
-        self.buffer_leader_check = None
-        self.buffer_update_dht_status = None
+        self.pending = {}
+        self.rids = itertools.count(1)
+        self.lock = threading.Lock()
+        self.send_lock = threading.Lock()
+        # FRAMES READ AHEAD OF THE ONE BEING SERVED AND THE REQUESTS THE REMOTE NODE CANCELLED AMONG THEM
+        self.backlog = collections.deque()
+        self.cancelled = set()
+
+        # COMPRESSION AGREED FOR THIS CONNECTION AND, WHEN SERVING, WHICH FILES ARE WORTH COMPRESSING
+        self.encoding = None
+        self.level = 0
+        self.compressible = {}
         
 
     ##
     ### BASIC FUNCTIONS
     ##
 
-    ## SEND MESSAGE FUNCTION
-    def send(self,msg):
-        # message pickled into bytes and HEADER added to message
-        msg = pickle.dumps(msg)
-        msg = bytes(f'{len(msg):<{HEADER}}', FORMAT) + msg
+    ## SEND MESSAGE FUNCTION, A RESPONSE CARRIES THE REQUEST ID OF ITS REQUEST
+    def send(self, msg, rid=0):
+        # message encoded into a binary frame, bulk data sent as raw payload after it
+        # requests from several threads share the connection, frames must not interleave
+        with self.send_lock:
+            size = codec.sendMsg(self.conn, msg, rid)
         global TOTAL_UP
-        TOTAL_UP += len(msg)
-        if len(msg) > PACKET:
-            for i in range(0, len(msg), PACKET):
-                self.conn.send(msg[i:i+PACKET])
-            return len(msg)
-        self.conn.send(msg)
-        return len(msg)
+        TOTAL_UP += size
+        return size
+
+    ## SEND A REQUEST UNDER A NEW REQUEST ID - RETURNS (request id, Future) TO wait ON
+    def submit(self, msg):
+        future = concurrent.futures.Future()
+        with self.lock:
+            rid = next(self.rids)
+            self.pending[rid] = future
+        try:
+            self.send(msg, rid)
+        except OSError:
+            with self.lock:
+                self.pending.pop(rid, None)
+            raise
+        return rid, future
+
+    ## WAIT FOR THE RESPONSE TO A REQUEST - RETURNS WHAT THE RECEIVER RESOLVED IT WITH, None ON TIMEOUT OR DISCONNECT
+    def wait(self, rid, future, timeout=REQUEST_TIMEOUT):
+        try:
+            return future.result(timeout)
+        except concurrent.futures.TimeoutError:
+            logger.info(f'{"[REQUEST TIMEOUT]":<26}#{rid} to {self.addr}')
+            return None
+        finally:
+            with self.lock:
+                self.pending.pop(rid, None)
+
+    ## SEND A REQUEST AND WAIT FOR ITS RESPONSE
+    def request(self, msg, timeout=REQUEST_TIMEOUT):
+        return self.wait(*self.submit(msg), timeout)
+
+    ## COMPLETE THE REQUEST WAITING FOR rid (RECEIVER)
+    def resolve(self, rid, value):
+        with self.lock:
+            future = self.pending.pop(rid, None)
+        if future:
+            future.set_result(value)
+
+    ## STOP WAITING FOR A REQUEST AND WITHDRAW IT AT THE REMOTE NODE
+    def cancel(self, rid):
+        self.resolve(rid, None)
+        self.withdraw([rid])
+
+    ## ASK THE REMOTE NODE TO SKIP REQUESTS IT HAS NOT SERVED YET, THE RESPONSES TO THE OTHERS ARE DROPPED WHEN THEY COME IN
+    def withdraw(self, rids):
+        try:
+            self.send({'main':CANCEL_MESSAGE, 'rids':rids})
+        except OSError:
+            pass
+
+    ## READ THE FRAMES ALREADY WAITING ON THE CONNECTION - RETURNS True IF ONE OF THEM CANCELS REQUEST rid (RECEIVER)
+    ## The frames are served in order afterwards. Request ids of a connection only grow, so older cancels are forgotten.
+    def withdrawn(self, rid):
+        while (len(self.backlog) < READ_AHEAD and (not self.backlog or self.backlog[-1])
+               and select.select([self.conn], [], [], 0)[0]):
+            try:
+                frame = codec.recvFrame(self.conn)
+            except (OSError, ValueError):
+                frame = None
+            if frame and frame[0]['main'] == CANCEL_MESSAGE:
+                self.cancelled.update(frame[0]['rids'])
+            else:
+                self.backlog.append(frame)
+        skip = rid in self.cancelled
+        self.cancelled = {r for r in self.cancelled if r > rid}
+        return skip
+
+    ## WAKE EVERY WAITING REQUEST WITH None, THE CONNECTION IS GONE (RECEIVER)
+    def failPending(self):
+        with self.lock:
+            pending, self.pending = self.pending, {}
+        for future in pending.values():
+            future.set_result(None)
 
     ## FUNCTION TO GET FILE LIST FROM LOCAL HOSTED DIRECTORY
     def localFileList(self):
         dir_loc = f'{args.dir}/{args.port}/'
-        return [f for f in os.listdir(dir_loc) if os.path.isfile(os.path.join(dir_loc, f))]
+        files = {f for f in os.listdir(dir_loc) if os.path.isfile(os.path.join(dir_loc, f))}
+        # downloads in progress and the manifests of hosted files are not files of their own
+        return [f for f in files if not f.endswith(DOWNLOAD_SUFFIX)
+                and not (f.endswith(MANIFEST_SUFFIX) and f[:-len(MANIFEST_SUFFIX)] in files)]
 
     ## FUNCTION TO SAFELY DISCONNECT AND CLOSE CONNECTION
     def disconnect(self):
         self.listen = False
+        # requests still waiting are withdrawn first, the remote node would answer them on a closed connection
+        with self.lock:
+            rids = list(self.pending)
+        if rids:
+            self.withdraw(rids)
         msg = {'main':DISCONNECT_MESSAGE}
-        self.send(msg)
+        # the remote node may have closed the connection already
+        try:
+            self.send(msg)
+        except OSError:
+            pass
         self.conn.close()
         logger.info(f'{"[DISCONNECTED]":<26}{self.addr}')
 
@@ -209,10 +789,7 @@ class ConnThread(threading.Thread):
     def leaderPing(self):
         global ADDR
         msg = {'main':LEADER_CHECK,'addr':ADDR}
-        self.send(msg)
-        while self.buffer_leader_check is None:
-            time.sleep(.1)
-        if self.buffer_leader_check:
+        if self.request(msg):
             global DHT_ADDR
             DHT_ADDR = self.addr
             return True
@@ -227,14 +804,9 @@ class ConnThread(threading.Thread):
 
     ## FUNCTION TO ADD NODE ON TO DHT 
     def updateDHT(self):
-        msg = {'main':UPDATE_DHT, 'addr':ADDR, 'file_list':self.localFileList()}
-        self.send(msg)
+        msg = {'main':UPDATE_DHT, 'addr':ADDR, 'file_list':self.localFileList(), 'partial_list':list(PARTIALS)}
         logger.info(f'{"[ADDING SELF TO DHT]":<26}')
-        while not self.buffer_update_dht_status:
-            time.sleep(.1)
-        temp = self.buffer_update_dht_status
-        self.buffer_update_dht_status = None
-        return temp
+        return self.request(msg)
 
     ## FUNCTION TO REMOVE NODE FROM DHT
     def removeFromDHT(self):
@@ -244,82 +816,81 @@ class ConnThread(threading.Thread):
 
     ## FUNCTION TO GET FILE LIST FROM DHT
     def getFileList(self):
-        self.send({'main':REQ_FILE_LIST_MESSAGE})
-        # USE RECEIVER & BUFFER TO RECEIVE
-        while self.buffer_file_list is None:
-            time.sleep(.1)
-        f_list = self.buffer_file_list
-        self.buffer_file_list = None
-        return f_list
+        # THE RECEIVER COMPLETES THE REQUEST WITH THE LIST
+        return self.request({'main':REQ_FILE_LIST_MESSAGE})
 
     ## FUNCTION TO GET NODES THAT CAN PROVIDE THE FILE
     def getFileSources(self, fname):
-        self.send({'main':REQ_FILE_SRC_MESSAGE, 'addr':ADDR, 'file_name':fname})
-        # USE RECEIVER & BUFFER TO RECEIVE
-        while self.buffer_file_srcs is None:
-            time.sleep(.1)
-        s_list = self.buffer_file_srcs
-        self.buffer_file_srcs = None
-        return s_list
+        # THE RECEIVER COMPLETES THE REQUEST WITH THE SOURCES
+        return self.request({'main':REQ_FILE_SRC_MESSAGE, 'addr':ADDR, 'file_name':fname})
     
 
     ##
     ### INTER NODE FUNCTIONS
     ##
 
-    ## FUNCTION TO GET META DATA OF A FILE
-    def fileMeta(self, fname):
-        self.send({'main':REQ_META_DATA, 'addr':ADDR, 'file_name':fname})
+    ## FUNCTION TO GET META DATA OF A FILE, THE SOURCE PICKS THE CHUNK SIZE FOR peers SOURCES AND A ROUND TRIP OF rtt
+    def fileMeta(self, fname, peers=1, rtt=0):
         logger.info(f'{"[FETCH META DATA]":<26}For {fname}')
-        # USE RECEIVER & BUFFER TO RECEIVE
-        while self.buffer_meta_data is None:
-            time.sleep(.1)
-        meta = self.buffer_meta_data
-        self.buffer_meta_data = None
-        return meta
-
-    ## FUNCTION TO CHECK CHUNKS AT A NODE
+        # THE RECEIVER COMPLETES THE REQUEST WITH THE META DATA
+        return self.request({'main':REQ_META_DATA, 'addr':ADDR, 'file_name':fname, 'peers':peers, 'rtt':rtt, 'chunk_size':args.chunk_size})
+
+    ## FUNCTION TO CHECK CHUNKS AT A NODE - True IF IT HAS THE FILE, (chunk size, bitmap) WHILE IT DOWNLOADS IT, False OTHERWISE
     def checkChunks(self, fname):
-        self.send({'main':REQ_CHK_FILE, 'addr':ADDR, 'file_name':fname})
         logger.info(f'{"[CHECK SOURCE]":<26}For {fname} chunks')
-        # USE RECEIVER & BUFFER TO RECEIVE
-        while self.buffer_check_file is None:
-            time.sleep(.1)
-        chk = self.buffer_check_file
-        self.buffer_check_file = None
-        return chk
-
-    ## FUNCTION TO DOWNLOAD FILE CHUNK FROM REMOTE NODE
-    def downloadChunk(self, d, cnumber):
+        # THE RECEIVER COMPLETES THE REQUEST WITH THE STATUS
+        return self.request({'main':REQ_CHK_FILE, 'addr':ADDR, 'file_name':fname})
+
+    ## FUNCTION TO AGREE ON A COMPRESSION CODEC FOR THE CHUNKS SENT OVER THIS CONNECTION
+    def negotiate(self):
+        if not CODECS:
+            return None
+        # THE RECEIVER SETS THE AGREED CODEC BEFORE IT COMPLETES THE REQUEST
+        self.request({'main':COMPRESS_MESSAGE, 'codecs':CODECS, 'level':args.level})
+        return self.encoding
+
+    ## FUNCTION TO DOWNLOAD FILE CHUNK FROM REMOTE NODE, digest IS ITS MD5 FROM THE FILE MANIFEST
+    ## Several threads may download chunks over the same connection at once. started gets the request id once it is sent.
+    def downloadChunk(self, d, cnumber, digest, chunk_size, started=None):
         down_file_time = time.time()
-        self.send({'main':DOWNLOAD_MESSAGE,'file_name':d,'cnumber':cnumber})
-        # RESPONSE RECEIVE
-        while self.buffer_file_data is None:
-            time.sleep(.0005)
+        rid, future = self.submit({'main':DOWNLOAD_MESSAGE,'file_name':d,'cnumber':cnumber,'chunk_size':chunk_size})
+        if started:
+            started(rid)
+        # RESPONSE RECEIVE, None IF IT TIMED OUT, WAS CANCELLED OR THE CONNECTION WAS LOST
+        res = self.wait(rid, future)
+        if res is None:
+            return (False, None)
         # PROCEED IF RIGHT RESPONSE
-        if self.buffer_file_data['file_name'] == d and self.buffer_file_data['cnumber'] == cnumber:
-            # GENERATE LOCAL MD5 FOR CHUNK
-            md5_mirror = hashlib.md5(self.buffer_file_data['chunk_data']).hexdigest()
-            # RETURN IF INTEGRITY CHECK SUCCESSFUL AND REPORT STATS
-            if self.buffer_file_data['md5'] == md5_mirror:
-                down_file_time = time.time()-down_file_time
-                logger.info(f'{"[DOWNLOAD INFO]":<26}{d}#{cnumber} downloaded from {self.addr}')
-                logger.info(f'{"[DOWNLOAD STAT]":<26}{self.buffer_down_size} Bytes <- {self.addr} in {down_file_time} Seconds')
-                print(f'\n{d}#{cnumber}\nmd5: {md5_mirror}\nIntegrity check pass, downloaded successfully!\nDownloaded in {down_file_time} seconds')
-                payload = self.buffer_file_data['chunk_data']
-                self.buffer_file_data = None
-                self.buffer_down_size = None
-                return (True, payload)
-            # DON'T SAVE IF INTEGRITY CHECK FAILS, TRY AGAIN LATER
-            else:
-                print(f'\n{d}#{cnumber}\nIntegrity failures.')
-                self.buffer_file_data = None
-                self.buffer_down_size = None
-                return (False, None)
-        else:
-            self.buffer_file_data = None
-            self.buffer_down_size = None
+        file_data, down_size = res
+        if file_data['file_name'] != d or file_data['cnumber'] != cnumber:
+            return (False, None)
+        # A SOURCE STILL DOWNLOADING THE FILE DOES NOT HAVE THE CHUNK
+        if file_data.get('missing'):
+            logger.info(f'{"[CHUNK MISSING]":<26}{d}#{cnumber} at {self.addr}')
             return (False, None)
+        # DECOMPRESS IF THE SENDER COMPRESSED THE CHUNK, NEVER PAST THE SIZE OF A CHUNK
+        wire = file_data['chunk_data']
+        encoding = file_data.get('encoding')
+        cpu = time.thread_time()
+        try:
+            chunk = codec.decompress(wire, encoding, chunk_size) if encoding else wire
+        except ValueError as e:
+            logger.info(f'{"[CHUNK INVALID]":<26}{d}#{cnumber} from {self.addr}: {e}')
+            return (False, None)
+        cpu = time.thread_time() - cpu
+        stat = codec.compressStat(encoding, len(chunk), len(wire), cpu) if self.encoding else ''
+        # GENERATE LOCAL MD5 FOR CHUNK
+        md5_mirror = hashlib.md5(chunk).hexdigest()
+        # RETURN IF INTEGRITY CHECK AGAINST THE MANIFEST SUCCESSFUL AND REPORT STATS
+        if digest.hex() == md5_mirror:
+            down_file_time = time.time()-down_file_time
+            logger.info(f'{"[DOWNLOAD INFO]":<26}{d}#{cnumber} downloaded from {self.addr}')
+            logger.info(f'{"[DOWNLOAD STAT]":<26}{down_size} Bytes <- {self.addr} in {down_file_time} Seconds{stat}')
+            print(f'\n{d}#{cnumber}\nmd5: {md5_mirror}\nIntegrity check pass, downloaded successfully!\nDownloaded in {down_file_time} seconds')
+            return (True, chunk)
+        # DON'T SAVE IF INTEGRITY CHECK FAILS, TRY AGAIN LATER
+        print(f'\n{d}#{cnumber}\nIntegrity failures.')
+        return (False, None)
 
     ##
     ### RECEIVER
@@ -329,34 +900,21 @@ class ConnThread(threading.Thread):
         while self.listen:
             msg = {'main':''}
             
-            # RECEIVE MESSAGE HEADER > GET LENGTH OF MESSAGE > SAVE AND DECODE FULL MESSAGE
-            msg_length = self.conn.recv(HEADER)
-            if not msg_length:
+            # RECEIVE FRAME HEADER > PREALLOCATE BODY AND PAYLOAD > recv_into AND DECODE FROM A VIEW
+            try:
+                frame = self.backlog.popleft() if self.backlog else codec.recvFrame(self.conn)
+            # the socket was closed by disconnect() while this thread was dispatching,
+            # or the frame is over the codec limits or does not decode and the connection is dropped
+            except (OSError, ValueError):
+                frame = None
+            if not frame:
                 msg['main'] = DISCONNECT_MESSAGE
             
-            if msg_length:
-                # Start the process only for a valid header 
-                full_msg = b''
-                new_msg = True
-                # loop to download full message body
-                while True:
-                    # receive message packets
-                    msg = self.conn.recv(PACKET)
-                    
-                    # get length from header
-                    if new_msg:
-                        msg_len = int(msg_length)
-                        full_msg = msg_length
-                        new_msg = False
-                    
-                    full_msg += msg
-
-                    # decode and break out of loop if full message is received
-                    if len(full_msg)-HEADER == msg_len:
-                        global TOTAL_DOWN
-                        TOTAL_DOWN += len(full_msg) 
-                        msg = pickle.loads(full_msg[HEADER:])
-                        break
+            if frame:
+                # the payload (if any) is a memoryview attached under its registered key
+                msg, rid, frame_size = frame
+                global TOTAL_DOWN
+                TOTAL_DOWN += frame_size
             
             ## UPDATE DHT RECORD
             if msg['main'] == UPDATE_DHT:
@@ -365,13 +923,13 @@ class ConnThread(threading.Thread):
                 # INFORM IF NOT LEADER
                 if not LEADER:
                     res = {'main':RES_UPDATE_DHT, 'status':LEADER}
-                    self.send(res)
+                    self.send(res, rid)
                 # UPDATE DHT AND ACK(IF LEADER)
                 else:
                     global dht
-                    dht.update(msg['addr'],msg['file_list'])
+                    dht.update(msg['addr'],msg['file_list'],msg.get('partial_list', []))
                     res = {'main':RES_UPDATE_DHT, 'status':LEADER}
-                    self.send(res)
+                    self.send(res, rid)
                     logger.info(f'{"[DHT UPDATED BY]":<26}{msg["addr"]}')
 
             ## RESPOND TO UPDATE DHT RECORD REQUEST
@@ -379,12 +937,12 @@ class ConnThread(threading.Thread):
                 # SUCCESSFUL UPDATE
                 if msg['status']:
                     logger.info(f'{"[DHT UPDATE DONE]":<26}')
-                    self.buffer_update_dht_status = True
+                    self.resolve(rid, True)
                 
                 # WRONG UPDATE ATTEMPT
                 else:
                     logger.info(f'{"[DHT UPDATE FAILED]":<26}')
-                    self.buffer_update_dht_status = False
+                    self.resolve(rid, False)
 
             ## UPDATE LEADER AT OTHER NODE
             if msg['main'] == UPDATE_LEADER:
@@ -394,6 +952,7 @@ class ConnThread(threading.Thread):
                 while True:
                     try:
                         dht_conn = ConnThread(addr=DHT_ADDR, track=False)
+                        dht_conn.start()
                         f_list = False
                         while not f_list:
                             f_list = dht_conn.updateDHT()
@@ -405,7 +964,7 @@ class ConnThread(threading.Thread):
             # RESPOND TO LEADER CHECK
             if msg['main'] == LEADER_CHECK:
                 res = {'main':RES_LEADER_CHECK, 'leader':LEADER}
-                self.send(res)
+                self.send(res, rid)
                 logger.info(f'{"[LEADER PING]":<26}{msg["addr"]}')
                 if msg['addr'] not in NODE_LIST:
                     NODE_LIST.append(msg['addr'])
@@ -414,7 +973,7 @@ class ConnThread(threading.Thread):
 
             # HAND RESPONSE FOR LEADER CHECK
             if msg['main'] == RES_LEADER_CHECK:
-                self.buffer_leader_check = msg['leader']
+                self.resolve(rid, msg['leader'])
                 logger.info(f'{"[LEADER PING]":<26}{self.addr}')
 
             # CASE: REQ FOR FILE LIST, SEND DHT FILE LIST
@@ -422,19 +981,19 @@ class ConnThread(threading.Thread):
                 if LEADER:
                     res = {'main':RES_FILE_LIST_MESSAGE, 'status':LEADER, 'file_list':dht.fileList()}
                     logger.info(f'{"[FILE LIST REQ]":<26}')
-                    self.send(res)
+                    self.send(res, rid)
                 else:
                     res = {'main':RES_FILE_LIST_MESSAGE, 'status':LEADER}
                     logger.info(f'{"[WRONG FILE LIST REQ]":<26}')
-                    self.send(res)
+                    self.send(res, rid)
             
-            # CASE: RES FOR A FILE LIST REQUEST, SAVE IN BUFFER & HANDLE FAILURE
+            # CASE: RES FOR A FILE LIST REQUEST, COMPLETE THE REQUEST & HANDLE FAILURE
             if msg['main'] == RES_FILE_LIST_MESSAGE:
                 if msg['status']:
-                    self.buffer_file_list = msg['file_list']
+                    self.resolve(rid, msg['file_list'])
                     logger.info(f'{"[FILE LIST RECEIVED]":<26}')
                 else:
-                    self.buffer_file_list = False
+                    self.resolve(rid, False)
                     logger.info(f'{"[WRONG DHT NODE]":<26}')
 
             # CASE: REQ FOR FILE SOURCES, SEND DHT FILE SOURCES
@@ -443,19 +1002,19 @@ class ConnThread(threading.Thread):
                     primary, secondary = dht.sourceList(msg['addr'], msg['file_name'])
                     res = {'main':RES_FILE_SRC_MESSAGE, 'status':LEADER, 'src_list':primary, 'src_list_sec':secondary}
                     logger.info(f'{"[FILE SOURCES REQ]":<26}')
-                    self.send(res)
+                    self.send(res, rid)
                 else:
                     res = {'main':RES_FILE_SRC_MESSAGE, 'status':LEADER}
                     logger.info(f'{"[WRONG FILE SOURCES REQ]":<26}')
-                    self.send(res)
+                    self.send(res, rid)
             
-            # CASE: RES FOR A FILE LIST REQUEST, SAVE IN BUFFER & HANDLE FAILURE
+            # CASE: RES FOR A FILE LIST REQUEST, COMPLETE THE REQUEST & HANDLE FAILURE
             if msg['main'] == RES_FILE_SRC_MESSAGE:
                 if msg['status']:
-                    self.buffer_file_srcs = (msg['src_list'],msg['src_list_sec'])
+                    self.resolve(rid, (msg['src_list'],msg['src_list_sec']))
                     logger.info(f'{"[FILE SOURCES RECEIVED]":<26}')
                 else:
-                    self.buffer_file_srcs = False
+                    self.resolve(rid, False)
                     logger.info(f'{"[WRONG DHT NODE]":<26}')
             
             # REMOVE NODE FROM DHT
@@ -467,58 +1026,121 @@ class ConnThread(threading.Thread):
             if msg['main'] == REQ_META_DATA:
                 dir_loc = f'{args.dir}/{args.port}/'
                 file_name = os.path.join(dir_loc, msg['file_name'])
-                file_data = open(file_name,'rb').read()
-                res = {'main':RES_META_DATA, 'fname':msg['file_name'], 'fsize':len(file_data), 'chunks':math.ceil(len(file_data)/CHUNK_SIZE)}
-                logger.info(f'{"[FILE META DATA REQ]":<26}From {msg["addr"]}')
-                self.send(res)
+                partial = PARTIALS.get(msg['file_name'])
+                # A FILE STILL DOWNLOADING HAS THE MANIFEST AND CHUNK SIZE OF ITS DOWNLOAD
+                if partial and not os.path.isfile(file_name):
+                    chunk_size = partial.chunk_size
+                    res = {'main':RES_META_DATA, 'fname':msg['file_name'], 'fsize':partial.size, 'chunk_size':chunk_size,
+                           'chunks':partial.chunks, 'root':partial.root, 'digests':partial.digests}
+                else:
+                    # PICK THE CHUNK SIZE OF THIS DOWNLOAD, EVERY SOURCE SERVES CHUNKS OF THE SIZE ASKED FOR
+                    chunk_size = chunkSize(os.stat(file_name).st_size, msg['peers'], msg['rtt'], msg['chunk_size'])
+                    manifest = MANIFESTS.manifest(file_name, chunk_size)
+                    fsize = manifest['key'][1]
+                    res = {'main':RES_META_DATA, 'fname':msg['file_name'], 'fsize':fsize, 'chunk_size':chunk_size,
+                           'chunks':math.ceil(fsize/chunk_size), 'root':manifest['root'], 'digests':manifest['digests']}
+                logger.info(f'{"[FILE META DATA REQ]":<26}From {msg["addr"]} chunk size:{chunk_size}')
+                self.send(res, rid)
 
             # RESPONSE TO META DATA REQUEST
             if msg['main'] == RES_META_DATA:
                 logger.info(f'{"[META DATA RECEIVED]":<26}From {self.addr}')
-                self.buffer_meta_data = {'fname':msg['fname'], 'fsize':msg['fsize'], 'chunks':msg['chunks']}
+                self.resolve(rid, {'fname':msg['fname'], 'fsize':msg['fsize'], 'chunk_size':msg['chunk_size'],
+                                   'chunks':msg['chunks'], 'root':msg['root'], 'digests':bytes(msg.get('digests', b''))})
 
             # MESSAGE TO CHECK THE CHUNKS AT A NODE
             if msg['main'] == REQ_CHK_FILE:
                 flist = self.localFileList()
                 logger.info(f'{"[FILE CHUNKS CHECK]":<26}From {msg["addr"]}')
                 # commits only if file available
+                partial = PARTIALS.get(msg['file_name'])
                 if msg['file_name'] in flist:
                     res = {'main':RES_CHK_FILE, 'status': True, 'file_name':msg['file_name']}
-                    self.send(res)
+                    self.send(res, rid)
+                # still downloading, tell which chunks are in
+                elif partial:
+                    res = {'main':RES_CHK_FILE, 'status': True, 'file_name':msg['file_name'],
+                           'chunk_size':partial.chunk_size, 'bitmap':partial.snapshot()}
+                    self.send(res, rid)
                 else:
                     res = {'main':RES_CHK_FILE, 'status': False, 'file_name':msg['file_name']}
-                    self.send(res)
+                    self.send(res, rid)
 
             # RESPONSE FOR CHECKING THE CHUNKS REQUEST
             if msg['main'] == RES_CHK_FILE:
-                self.buffer_check_file = msg['status']
+                if msg['status'] and 'bitmap' in msg:
+                    self.resolve(rid, (msg['chunk_size'], bytes(msg['bitmap'])))
+                else:
+                    self.resolve(rid, msg['status'])
+
+            # COMPRESSION HANDSHAKE, PICK THE FIRST OFFERED CODEC THIS NODE ACCEPTS
+            if msg['main'] == COMPRESS_MESSAGE:
+                self.encoding, self.level = codec.negotiate(msg['codecs'], CODECS, msg['level'])
+                self.send({'main':RES_COMPRESS_MESSAGE, 'codec':self.encoding, 'level':self.level}, rid)
+                logger.info(f'{"[COMPRESSION]":<26}{self.addr} codec:{self.encoding} level:{self.level}')
+
+            # RESPONSE TO COMPRESSION HANDSHAKE
+            if msg['main'] == RES_COMPRESS_MESSAGE:
+                self.encoding, self.level = msg['codec'], msg['level']
+                self.resolve(rid, True)
 
             # CASE: DOWNLOAD REQUEST
             if msg['main'] == DOWNLOAD_MESSAGE:
+                # SKIP IT IF THE DOWNLOADER CANCELLED IT MEANWHILE, ANOTHER SOURCE SENT THE CHUNK FIRST
+                if self.withdrawn(rid):
+                    logger.info(f'{"[UPLOAD CANCELLED]":<26}{msg["file_name"]}#{msg["cnumber"]} for {self.addr}')
+                    continue
                 up_time = time.time()
                 # FIND FILE
                 dir_loc = f'{args.dir}/{args.port}/'
                 file_name = os.path.join(dir_loc, msg['file_name'])
-                file_open = open(file_name,'rb')
-                file_data = file_open.read()
-                # FIND SPECIFIC CHUNK IN THE FILE
-                cstart = msg['cnumber'] * CHUNK_SIZE
-                cend = (msg['cnumber']+1) * CHUNK_SIZE
-                chunk = file_data[cstart:cend]
-                # GENERATE MD5
-                md5 = hashlib.md5(chunk).hexdigest()
-                # SEND MD5 AND CHUNK BINARY DATA
-                res = {'main':RES_DOWNLOAD_MESSAGE, 'file_name':msg['file_name'], 'md5':md5, 'chunk_data':chunk, 'cnumber': msg['cnumber']}
-                up_size = self.send(res)
-                # REPORT THE UPLOAD STATS
-                up_time = time.time()-up_time
-                logger.info(f'{"[UPLOAD INFO]":<26}{msg["file_name"]}#{msg["cnumber"]} sent to {self.addr}')
-                logger.info(f'{"[UPLOAD STAT]":<26}{up_size} Bytes -> {self.addr} in {up_time} Seconds')
-
-            # CASE: RES FOR DOWNLOAD REQUEST, SAVE TO BUFFER
+                # READ ONLY THE SPECIFIC CHUNK OF THE FILE THROUGH A CACHED DESCRIPTOR
+                # chunks are of the size agreed in the meta data, bounded so a request cannot ask for any amount
+                chunk_size = min(max(msg['chunk_size'], CHUNK_FLOOR), CHUNK_MAX)
+                # a file still downloading serves the chunks written so far, None for the others
+                partial = PARTIALS.get(msg['file_name'])
+                hosted = not partial or os.path.isfile(file_name)
+                if hosted:
+                    chunk = HANDLES.read(file_name, msg['cnumber'] * chunk_size, chunk_size)
+                else:
+                    chunk = partial.read(msg['cnumber'] * chunk_size, chunk_size)
+                # NO HASHING, THE DOWNLOADER CHECKS THE CHUNK AGAINST THE MANIFEST
+                res = {'main':RES_DOWNLOAD_MESSAGE, 'file_name':msg['file_name'], 'chunk_data':chunk or b'', 'cnumber': msg['cnumber']}
+                if chunk is None:
+                    res['missing'] = True
+                # COMPRESS THE CHUNK IF A CODEC IS AGREED AND A SAMPLE FROM THE START OF THE FILE SHRINKS
+                stat = ''
+                if self.encoding and chunk:
+                    cpu = time.thread_time()
+                    if msg['file_name'] not in self.compressible:
+                        sample = HANDLES.read(file_name, 0, codec.SAMPLE_SIZE) if hosted else chunk[:codec.SAMPLE_SIZE]
+                        self.compressible[msg['file_name']] = codec.compressible(sample, self.encoding, self.level)
+                    wire = chunk
+                    if self.compressible[msg['file_name']]:
+                        packed = codec.compress(chunk, self.encoding, self.level)
+                        # a chunk that does not shrink goes out raw
+                        if len(packed) < len(chunk):
+                            res['chunk_data'] = wire = packed
+                            res['encoding'] = self.encoding
+                    stat = codec.compressStat(res.get('encoding'), len(chunk), len(wire), time.thread_time() - cpu)
+                # SEND CHUNK BINARY DATA, A DOWNLOADER THAT WENT AWAY IS RELEASED BELOW LIKE A DISCONNECT
+                try:
+                    up_size = self.send(res, rid)
+                except OSError as e:
+                    logger.info(f'{"[UPLOAD FAILED]":<26}{msg["file_name"]}#{msg["cnumber"]} to {self.addr}: {e}')
+                    msg = {'main':DISCONNECT_MESSAGE}
+                else:
+                    if chunk is not None:
+                        global UP_CHUNKS
+                        UP_CHUNKS += 1
+                    # REPORT THE UPLOAD STATS
+                    up_time = time.time()-up_time
+                    logger.info(f'{"[UPLOAD INFO]":<26}{msg["file_name"]}#{msg["cnumber"]} sent to {self.addr}')
+                    logger.info(f'{"[UPLOAD STAT]":<26}{up_size} Bytes -> {self.addr} in {up_time} Seconds{stat}')
+
+            # CASE: RES FOR DOWNLOAD REQUEST, COMPLETE THE REQUEST
             if msg['main'] == RES_DOWNLOAD_MESSAGE:
-                self.buffer_down_size = len(full_msg)
-                self.buffer_file_data = msg
+                self.resolve(rid, (msg, frame_size))
 
             ## MESSAGE TO START THE TEST
             if msg['main'] == TEST_MESSAGE:
@@ -537,6 +1159,7 @@ class ConnThread(threading.Thread):
                         findDHT()
                 self.listen = False
                 self.conn.close()
+                self.failPending()
 
 ### SELECT SPECIFIC FILES FROM A LIST OF FILES TO DOWNLOAD
 def selectFileFromList(file_list):
@@ -555,26 +1178,98 @@ def selectFileFromList(file_list):
 def downloadHandler(fl, slist):
     logger.info(f'{"[DOWNLOAD HANDLER START]":<26}')
     
-    ## CHECK SOURCES FOR FILE CHUNKS
+    ## CHECK SOURCES FOR FILE CHUNKS, THE SLOWEST ROUND TRIP IS TAKEN INTO THE CHUNK SIZE
     primary = []
+    partial = {}        # source still downloading the file -> (chunk size, bitmap) of its download
+    waiting = []        # source without the file yet, it may start downloading it
+    rtt = 0
     for s in slist:
-        ## GET META DATA FOR FILE
-        src_conn = ConnThread(addr=s)
+        ## GET META DATA FOR FILE, SKIP A SOURCE THAT CANNOT BE REACHED
+        try:
+            src_conn = ConnThread(addr=s)
+        except OSError as e:
+            logger.info(f'{"[ERROR]":<26}Checking {s}: {e}')
+            continue
         src_conn.start()
+        check_time = time.time()
         chunks_val = src_conn.checkChunks(fl)
+        check_time = time.time() - check_time
         src_conn.disconnect()
-        if chunks_val:
+        if chunks_val is True:
             primary.append(s)
+        elif chunks_val:
+            partial[s] = chunks_val
+        elif chunks_val is False:
+            waiting.append(s)
+        if chunks_val:
+            rtt = max(rtt, check_time)
+
+    ## THE STATIC SCHEDULE SPLITS THE FILE AMONG SOURCES THAT HAVE ALL OF IT
+    if not primary and (not partial or args.schedule == 'static'):
+        logger.info(f'{"[NO SOURCES]":<26}{fl}')
+        print(f'\nNo source can serve {fl}, not downloading.')
+        return
     
     ### START DOWNLOAD USING WINDOWED ROUND ROBIN
     
-    ## GET META DATA FOR FILE
-    meta_conn = ConnThread(addr=primary[0])
-    meta_conn.start()
-    file_meta_data = meta_conn.fileMeta(fl)
-    meta_conn.disconnect()
-
-    ## ALGORITHM TO DECIDE WHERE TO DOWNLOAD CHUNKS FROM 
+    ## GET META DATA FOR FILE, FROM A SOURCE WITH THE WHOLE FILE IF THERE IS ONE, A SOURCE THAT DOES NOT ANSWER IS DROPPED
+    file_meta_data = None
+    for meta_src in primary + (list(partial) if args.schedule == 'dynamic' else []):
+        try:
+            meta_conn = ConnThread(addr=meta_src)
+        except OSError as e:
+            logger.info(f'{"[ERROR]":<26}Fetching meta data from {meta_src}: {e}')
+        else:
+            meta_conn.start()
+            file_meta_data = meta_conn.fileMeta(fl, len(primary) + len(partial), rtt)
+            meta_conn.disconnect()
+        if file_meta_data:
+            break
+        logger.info(f'{"[NO META DATA]":<26}{fl} from {meta_src}')
+        if meta_src in primary:
+            primary.remove(meta_src)
+        partial.pop(meta_src, None)
+    if not file_meta_data:
+        logger.info(f'{"[NO SOURCES]":<26}{fl}')
+        print(f'\nNo source can serve {fl}, not downloading.')
+        return
+
+    ## THE CHUNK DIGESTS OF THE MANIFEST MUST ADD UP TO ITS MERKLE ROOT
+    digests = file_meta_data['digests']
+    chunk_size = file_meta_data['chunk_size']
+    if file_meta_data['chunks'] != math.ceil(file_meta_data['fsize']/chunk_size) or \
+            len(digests) != 16 * file_meta_data['chunks'] or merkleRoot(digests) != file_meta_data['root']:
+        logger.info(f'{"[MANIFEST MISMATCH]":<26}{fl} from {meta_src}')
+        print(f'\nManifest of {fl} does not match its root, not downloading.')
+        return
+
+    ## PREALLOCATE THE FILE, CHUNKS ARE WRITTEN INTO IT AS THEY ARRIVE AND SERVED TO OTHER DOWNLOADERS
+    dir_loc = f'{args.dir}/{args.port}/'
+    target = ChunkFile(os.path.join(dir_loc,fl), file_meta_data['fsize'], chunk_size, digests, file_meta_data['root'])
+    PARTIALS[fl] = target
+    # other downloaders find this node as a maybe source of the file from now on
+    threading.Thread(target=publishDHT, daemon=True).start()
+
+    ## DYNAMIC SCHEDULE - SOURCES PULL CHUNKS FROM A SHARED QUEUE, PEERS STILL DOWNLOADING ONLY THE CHUNKS THEY HAVE
+    if args.schedule == 'dynamic':
+        print(f'\nTotal chunks: {file_meta_data["chunks"]} of {chunk_size} Bytes. Downloading from {len(primary)} source(s) '
+              f'and {len(partial) + len(waiting)} downloading peer(s) using a shared chunk queue, {args.select} first.')
+        down_start_time = time.time()
+        scheduler = ChunkScheduler(target)
+        for s in partial:
+            scheduler.offer(s, partial[s])
+        # a peer without chunks yet is asked again as it may be downloading the file by now
+        for s in waiting:
+            scheduler.offer(s, False)
+        sources = primary + list(partial) + waiting
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(sources)) as executor:
+            for s in sources:
+                executor.submit(downloadWorker, s, fl, scheduler, digests)
+        for s in sources:
+            logger.info(f'{"[SOURCE STAT]":<26}{s} served {scheduler.counts[s]} chunk(s)')
+        return saveDownload(fl, target, digests, down_start_time)
+
+    ## STATIC SCHEDULE - ALGORITHM TO DECIDE WHERE TO DOWNLOAD CHUNKS FROM 
     available_srcs = len(primary)
     down_chunks = [0 for _ in range(available_srcs+1)]
     down_chunks[1] = math.floor(file_meta_data['chunks']/available_srcs) + file_meta_data['chunks']%available_srcs
@@ -583,7 +1278,7 @@ def downloadHandler(fl, slist):
             down_chunks[i] = down_chunks[i-1] + math.floor(file_meta_data['chunks']/available_srcs)
     
     ## DISPLAY DOWNLOAD SOURCES
-    print(f'\nTotal chunks: {file_meta_data["chunks"]}. Downloading using Windowed Round-Robin.')
+    print(f'\nTotal chunks: {file_meta_data["chunks"]} of {chunk_size} Bytes. Downloading using Windowed Round-Robin.')
     for i in range(1,available_srcs+1):
         print(f'From: {primary[i-1]} downloading: {down_chunks[i-1]} - {down_chunks[i]} chunks')
     if not TEST_START:
@@ -591,53 +1286,89 @@ def downloadHandler(fl, slist):
 
     ## START DOWNLOAD
     down_start_time = time.time()
-    # To reconstruct file, make an array for binary data
-    complete_data_array = [b'' for _ in range(available_srcs)]
+    # every source works through its own window, the last chunks of a slow one are also requested from the others
+    windows = {}
+    for i in range(available_srcs):
+        windows.setdefault(primary[i], []).extend(range(down_chunks[i], down_chunks[i+1]))
+    scheduler = ChunkScheduler(target, windows)
     # Thread(1st degree) the parallel connections to concurrently download chunks from different nodes
-    with concurrent.futures.ThreadPoolExecutor() as executor:
-        threads = [executor.submit(downloadFrom, i, primary[i], fl, down_chunks[i],down_chunks[i+1]) for i in range(available_srcs)]
-        # as soon as any download ends, take action
-        for down in concurrent.futures.as_completed(threads):
-            index, chunk_data = down.result()
-            complete_data_array[index] = chunk_data
-
-    ## RECONSTRUCT FILE
-    complete_data = b''
-    for fblock in complete_data_array:
-        complete_data += fblock
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(windows)) as executor:
+        threads = [executor.submit(downloadWorker, s, fl, scheduler, digests) for s in windows]
+        concurrent.futures.wait(threads)
+    return saveDownload(fl, target, digests, down_start_time)
+
+### FUNCTION TO SAVE A DOWNLOADED FILE WITH ITS MANIFEST ONCE EVERY CHUNK IS IN
+### Each chunk was checked against its digest and the digests against the Merkle root, so the file is not hashed again.
+def saveDownload(fl, target, digests, down_start_time):
+    ## DROP THE FILE IF ANY CHUNK IS MISSING
+    if not target.complete():
+        target.discard()
+        PARTIALS.pop(fl, None)
+        # this node is no maybe source of the file any more
+        publishDHT()
+        logger.info(f'{"[DOWNLOAD FAILED]":<26}{fl} {target.count}/{target.chunks} chunks')
+        print(f'\n{fl} could not be downloaded, every source failed.')
+        return
     
-    ## SAVE FILE
-    dir_loc = f'{args.dir}/{args.port}/'
-    file_mirror = open(os.path.join(dir_loc,fl), 'wb')
-    file_mirror.write(complete_data)
-    file_mirror.close()
+    ## SAVE FILE AND ITS MANIFEST, SO THIS NODE SERVES IT WITHOUT HASHING IT AGAIN
+    target.commit()
+    MANIFESTS.store(target.path, target.chunk_size, digests)
+    PARTIALS.pop(fl, None)
 
     ## COMPLETION
-    print(f'\nDownloaded {len(complete_data)} Bytes in {time.time()-down_start_time} Seconds')
-
-### FUNCTION TO HANDLE INDIVIDUAL CHUNK DOWNLOADS - LOWER LEVEL. TAKES NODE AND CHUNK NUMBERS AS INPUT.
-def downloadFrom(index, src, fname, cstart, cend):
-    # buffer
-    load = b''
-    # connect to remote node through independent thread(2nd degree)
-    src_conn = ConnThread(addr=src)
-    src_conn.start()
-    # for each chunk number from window in RR download the chunk
-    for cnumber in range(cstart,cend):
-        success = False
-        while not success:
-            # FUNCTION TO DOWNLOAD SINGLE CHUNK OF A FILE(function of class ConnThread)
-            success, chunk_data = src_conn.downloadChunk(fname, cnumber)
-            # if failed then try again
-            if not success:
-                print(f'{fname}#{cnumber} failed retrying...')
+    print(f'\nDownloaded {target.size} Bytes in {time.time()-down_start_time} Seconds')
+
+### FUNCTION TO DOWNLOAD CHUNKS FROM ONE SOURCE UNTIL THE FILE IS DONE - LOWER LEVEL.
+### A source that fails SOURCE_FAILURES chunks in a row is dropped, its chunks go to the others. A source
+### still downloading the file is asked for its bitmap every BITMAP_REFRESH seconds, that keeps what it can
+### serve and the rarest first counts up to date.
+def downloadWorker(src, fname, scheduler, digests):
+    cnumber = None
+    try:
+        # connect to remote node through independent thread(2nd degree)
+        src_conn = ConnThread(addr=src)
+        src_conn.start()
+        # agree on a compression codec for the chunks
+        src_conn.negotiate()
+        failures = 0
+        refreshed = idle = time.time()
+        while not scheduler.finished() and failures < SOURCE_FAILURES:
+            if scheduler.partial(src) and time.time() - refreshed > BITMAP_REFRESH:
+                have = src_conn.checkChunks(fname)
+                refreshed = time.time()
+                # the source did not answer or had nothing for us for a long time
+                if have is None or refreshed - idle > REQUEST_TIMEOUT:
+                    break
+                scheduler.offer(src, have)
+            # queue empty, left to faster sources or not at the source yet, wait until that changes
+            # or it is time to ask a source still downloading the file for its bitmap again
+            cnumber = scheduler.next(src, BITMAP_REFRESH)
+            if cnumber is None:
                 continue
-            # if success, add to buffer
-            load += chunk_data
-            print(f'{fname}#{cnumber} done.')
-    # close connection to node and end thread
-    src_conn.disconnect()
-    return (index, load)
+            idle = time.time()
+            chunk_time = time.time()
+            success, chunk_data = src_conn.downloadChunk(fname, cnumber, digests[16*cnumber:16*cnumber+16], scheduler.target.chunk_size,
+                                                         lambda rid: scheduler.track(src, cnumber, src_conn, rid))
+            if success:
+                # publish the download in progress again every DHT_REFRESH_CHUNKS chunks, a new leader may not know it
+                if scheduler.done(src, cnumber, chunk_data, time.time() - chunk_time) and scheduler.target.count % DHT_REFRESH_CHUNKS == 0:
+                    threading.Thread(target=publishDHT, daemon=True).start()
+                failures = 0
+                print(f'{fname}#{cnumber} done.')
+            # a duplicate request of the end game lost to another source
+            elif scheduler.failed(src, cnumber):
+                failures += 1
+                print(f'{fname}#{cnumber} failed retrying...')
+            cnumber = None
+        # close connection to node and end thread
+        src_conn.disconnect()
+    except OSError as e:
+        logger.info(f'{"[ERROR]":<26}Downloading from {src}: {e}')
+        # give back the chunk in flight
+        if cnumber is not None:
+            scheduler.failed(src, cnumber)
+    finally:
+        scheduler.retire(src)
 
 ### FUNC TO SCAN FOR NODES IN NETWORK
 def updateNodeList():
@@ -657,6 +1388,18 @@ def updateNodeList():
             pass
     logger.info(f'{"[NODES DISCOVERED]":<26}{len(NODE_LIST)} Node(s) in Network')
 
+### PUBLISH THE HOSTED FILES AND THE DOWNLOADS IN PROGRESS OF THIS NODE TO THE DHT, SKIPPED WHILE NO LEADER IS KNOWN
+def publishDHT():
+    if DHT_ADDR is None:
+        return
+    try:
+        n = ConnThread(addr=DHT_ADDR)
+        n.start()
+        n.updateDHT()
+        n.disconnect()
+    except OSError as e:
+        logger.info(f'{"[ERROR]":<26}Publishing to DHT {DHT_ADDR}: {e}')
+
 ### NOTIFY ALL NODES IN NETWORK FOR LEADER UPDATE
 def notifyAll():
     for noti in NODE_LIST:
@@ -838,13 +1581,15 @@ if __name__ == "__main__":
             n = ConnThread(addr=DHT_ADDR)
             n.start()
             fl = n.getFileList()
-            primary, _ = n.getFileSources(fl[0])
-            downloadHandler(fl[0], primary)
+            primary, secondary = n.getFileSources(fl[0])
+            test_time = time.time()
+            downloadHandler(fl[0], primary + (secondary or []))
+            test_time = time.time() - test_time
             n.updateDHT()
             n.disconnect()
 
-            ## REPORT BANDWIDTH OBSERVATIONS
-            logger.info(f'{"[TEST RESULTS]":<26}DOWNLOAD: {TOTAL_DOWN} Bytes; UPLOAD: {TOTAL_UP} Bytes')
+            ## REPORT BANDWIDTH OBSERVATIONS, THE LONGEST DOWNLOAD IS THE SWARM COMPLETION TIME AND A SEEDER'S UPLOAD ITS LOAD
+            logger.info(f'{"[TEST RESULTS]":<26}DOWNLOAD: {TOTAL_DOWN} Bytes in {test_time} Seconds; UPLOAD: {TOTAL_UP} Bytes, {UP_CHUNKS} chunks; SELECT: {args.select}')
 
             print('\nTEST OVER')
 
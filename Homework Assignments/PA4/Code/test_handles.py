@@ -0,0 +1,38 @@
+### CHECKS THAT THE FILE HANDLE CACHE KEEPS SERVING CORRECT BYTES PAST ITS SIZE LIMIT
+### RUN: python -m pytest -q test_handles.py
+import os
+import sys
+import tempfile
+
+WORK = tempfile.mkdtemp()
+os.chdir(WORK)
+sys.argv = [sys.argv[0], '--ip', '127.0.0.1', '--port', '9990', '--dir', WORK]
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import node
+
+def files(n):
+    paths = []
+    for i in range(n):
+        path = os.path.join(WORK, f'f{i}')
+        with open(path, 'wb') as f:
+            f.write(bytes([i % 256]) * 1024)
+        paths.append(path)
+    return paths
+
+def test_reads_past_cache_size():
+    handles = node.FileHandles(node.HANDLE_CACHE, node.HANDLE_IDLE)
+    paths = files(node.HANDLE_CACHE + 6)
+    for _ in range(2):
+        for i, path in enumerate(paths):
+            assert handles.read(path, 512, 16) == bytes([i % 256]) * 16
+    assert len(handles.handles) == node.HANDLE_CACHE
+
+def test_in_use_handles_are_not_closed():
+    handles = node.FileHandles(4, node.HANDLE_IDLE)
+    paths = files(8)
+    held = [(path, handles.acquire(path)) for path in paths]
+    for i, (path, h) in enumerate(held):
+        assert os.pread(h['fd'], 4, 0) == bytes([i % 256]) * 4
+    for path, h in held:
+        handles.release(path, h)
+    assert len(handles.handles) == 4